@@ -0,0 +1,150 @@
+"""整理redis中的购物车：删除失效的商品，把长时间没有使用的购物车归档到数据库，释放redis内存
+
+定时任务celery_tasks.tasks.compact_carts调用compact()扫描所有购物车：
+1. 删除已经下线或者已经删除的商品
+2. 登陆用户超过ARCHIVE_IDLE没有使用的购物车写入CartArchive，从redis中删除（未登录用户的购物车直接过期）
+用户登陆或者打开购物车页面时，调用restore()把归档的购物车恢复到redis中
+
+archived_carts    set，有归档的用户id；restore()只在用户在集合中时查询数据库，
+                  大部分用户没有归档，登陆、打开空购物车都不用查询数据库；compact()每次从数据库补全，防止redis数据丢失
+"""
+import json
+
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from cart import operations
+from cart.models import CartArchive
+from goods import snapshots
+
+# 超过这个时间没有使用的登陆用户购物车归档到数据库（秒），需要比operations.USER_TTL短
+ARCHIVE_IDLE = 30 * 24 * 3600
+
+ARCHIVED_KEY = 'archived_carts'
+
+
+def idle_seconds(ttl, owner):
+    """根据key剩余的过期时间计算没有使用的时间，每次使用购物车都会重新设置过期时间"""
+    return operations.key_ttl(owner) - ttl
+
+
+def archive(redis_conn, user_id):
+    """把用户的购物车写入数据库，从redis中删除，返回归档的商品数量，期间购物车被修改时放弃归档返回0"""
+    keys = [operations.cart_key(user_id), operations.total_key(user_id)]
+
+    with redis_conn.pipeline() as pipe:
+        try:
+            # 监视购物车，归档期间用户修改了购物车时，删除会失败，数据库也一起回滚
+            pipe.watch(*keys)
+            cart_dict = pipe.hgetall(keys[0])
+            cart = dict((int(sku_id), int(count)) for sku_id, count in cart_dict.items())
+
+            with transaction.atomic():
+                if cart:
+                    archived, created = CartArchive.objects.select_for_update().get_or_create(
+                        user_id=user_id, defaults={'cart': '{}'})
+                    # 已经有归档时合并数量
+                    for sku_id, count in json.loads(archived.cart).items():
+                        cart[int(sku_id)] = cart.get(int(sku_id), 0) + count
+                    archived.cart = json.dumps(cart)
+                    archived.save()
+
+                pipe.multi()
+                pipe.delete(*keys)
+                if cart:
+                    pipe.sadd(ARCHIVED_KEY, user_id)
+                pipe.execute()
+        except WatchError:
+            return 0
+
+    return len(cart)
+
+
+def restore(redis_conn, user_id):
+    """把归档的购物车恢复到redis中，和当前购物车中的数量相加，没有归档时不做任何事情
+
+    用户不在archived_carts中时直接返回，不查询数据库
+    """
+    if not redis_conn.sismember(ARCHIVED_KEY, user_id):
+        return
+
+    with transaction.atomic():
+        try:
+            archived = CartArchive.objects.select_for_update().get(user_id=user_id)
+        except CartArchive.DoesNotExist:
+            archived = None
+
+        if archived is not None:
+            # redis写入失败时，归档也不会被删除
+            archived.delete()
+            operations.restore(redis_conn, user_id, json.loads(archived.cart))
+
+    redis_conn.srem(ARCHIVED_KEY, user_id)
+
+
+def compact(redis_conn=None, batch_size=500):
+    """扫描所有购物车，删除失效的商品，归档长时间没有使用的购物车，返回统计信息"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    stats = {'carts': 0, 'removed_lines': 0, 'archived_carts': 0}
+
+    # 从数据库补全有归档的用户（redis数据丢失、加上标记以前的归档）
+    user_ids = list(CartArchive.objects.values_list('user_id', flat=True))
+    for i in range(0, len(user_ids), batch_size):
+        redis_conn.sadd(ARCHIVED_KEY, *user_ids[i:i + batch_size])
+
+    owners = []
+    for key in redis_conn.scan_iter(match='cart_*', count=1000):
+        if key.decode().startswith('cart_total_'):
+            continue
+        owner = operations.owner_of_key(key)
+        if owner is None:
+            continue
+
+        owners.append(owner)
+        if len(owners) >= batch_size:
+            compact_batch(redis_conn, owners, stats)
+            owners = []
+
+    if owners:
+        compact_batch(redis_conn, owners, stats)
+
+    return stats
+
+
+def compact_batch(redis_conn, owners, stats):
+    """整理一批购物车，所有商品一次查询"""
+    pipe = redis_conn.pipeline()
+    for owner in owners:
+        pipe.hgetall(operations.cart_key(owner))
+        pipe.ttl(operations.cart_key(owner))
+    values = pipe.execute()
+    carts = values[0::2]
+    ttls = values[1::2]
+
+    sku_ids = set()
+    for cart_dict in carts:
+        sku_ids.update(int(sku_id) for sku_id in cart_dict)
+    sku_dict = snapshots.get_many(sku_ids)
+
+    for owner, cart_dict, ttl in zip(owners, carts, ttls):
+        stats['carts'] += 1
+
+        # 删除已经下线或者已经删除的商品，不重新计算过期时间
+        invalid = [int(sku_id) for sku_id in cart_dict
+                   if int(sku_id) not in sku_dict or not sku_dict[int(sku_id)].status]
+        if invalid:
+            operations.remove(redis_conn, owner, invalid, refresh=False)
+            stats['removed_lines'] += len(invalid)
+
+        if ttl is None or ttl < 0:
+            # 加上过期时间以前保存的购物车，从现在开始计时
+            redis_conn.expire(operations.cart_key(owner), operations.key_ttl(owner))
+            redis_conn.expire(operations.total_key(owner), operations.key_ttl(owner))
+            continue
+
+        if not operations.is_anonymous(owner) and idle_seconds(ttl, owner) > ARCHIVE_IDLE:
+            if archive(redis_conn, owner):
+                stats['archived_carts'] += 1
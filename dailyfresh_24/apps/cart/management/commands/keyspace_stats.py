@@ -0,0 +1,129 @@
+import re
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+
+# 元素数量的分布区间
+SIZE_BUCKETS = (1, 5, 10, 50, 100)
+
+# 读取元素数量的命令
+SIZE_COMMANDS = {
+    'hash': 'HLEN',
+    'list': 'LLEN',
+    'set': 'SCARD',
+    'zset': 'ZCARD',
+    'string': 'STRLEN',
+}
+
+
+class Command(BaseCommand):
+    """统计redis中每一类key的数量、内存和元素数量分布，用来估算redis需要的内存
+
+    key中的数字和未登录购物车的标识替换成*，例如 cart_1、cart_2 都属于 cart_*
+    python manage.py keyspace_stats                   统计所有key
+    python manage.py keyspace_stats -m 'cart_*'       只统计匹配的key
+    python manage.py keyspace_stats --sample 10000    最多统计10000个key
+    """
+    help = '统计redis中每一类key的数量、内存和大小分布'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-m', '--match', dest='match', default='*', help='只统计匹配的key')
+        parser.add_argument('--sample', type=int, dest='sample', default=0, help='最多统计的key数量，默认全部')
+
+    def handle(self, *args, **options):
+        redis_conn = get_redis_connection('default')
+        self.memory_supported = True
+
+        stats = {}
+        keys = []
+        scanned = 0
+        for key in redis_conn.scan_iter(match=options['match'], count=1000):
+            keys.append(key)
+            scanned += 1
+            if len(keys) >= 500:
+                self.collect(redis_conn, keys, stats)
+                keys = []
+            if options['sample'] and scanned >= options['sample']:
+                break
+        if keys:
+            self.collect(redis_conn, keys, stats)
+
+        self.report(stats, scanned)
+
+    def keyspace(self, key):
+        """key所属的分类"""
+        key = key.decode()
+        key = re.sub(r'anon_[0-9a-f]+', 'anon_*', key)
+        return re.sub(r'\d+', '*', key)
+
+    def collect(self, redis_conn, keys, stats):
+        """统计一批key：一次pipeline读取类型，一次pipeline读取大小和内存"""
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        types = [key_type.decode() for key_type in pipe.execute()]
+
+        pipe = redis_conn.pipeline(transaction=False)
+        for key, key_type in zip(keys, types):
+            pipe.execute_command(SIZE_COMMANDS.get(key_type, 'EXISTS'), key)
+            if self.memory_supported:
+                pipe.execute_command('MEMORY', 'USAGE', key)
+        try:
+            values = pipe.execute()
+        except ResponseError:
+            # redis 4.0以前没有MEMORY USAGE命令，只统计数量和大小
+            self.memory_supported = False
+            return self.collect(redis_conn, keys, stats)
+
+        step = 2 if self.memory_supported else 1
+        for i, (key, key_type) in enumerate(zip(keys, types)):
+            size = values[i * step] or 0
+            memory = (values[i * step + 1] or 0) if self.memory_supported else 0
+
+            item = stats.setdefault(self.keyspace(key), {
+                'type': key_type,
+                'keys': 0,
+                'memory': 0,
+                'max_size': 0,
+                'buckets': OrderedDict((limit, 0) for limit in SIZE_BUCKETS + (None,)),
+            })
+            item['keys'] += 1
+            item['memory'] += memory
+            item['max_size'] = max(item['max_size'], size)
+            for limit in item['buckets']:
+                if limit is None or size <= limit:
+                    item['buckets'][limit] += 1
+                    break
+
+    def report(self, stats, scanned):
+        total_memory = sum(item['memory'] for item in stats.values())
+        self.stdout.write('共统计%s个key，%s类，内存%s' % (scanned, len(stats), self.format_bytes(total_memory)))
+        if not self.memory_supported:
+            self.stdout.write('redis不支持MEMORY USAGE，没有统计内存')
+
+        for name, item in sorted(stats.items(), key=lambda pair: pair[1]['memory'], reverse=True):
+            self.stdout.write('')
+            self.stdout.write('%s (%s)' % (name, item['type']))
+            self.stdout.write('  数量：%s  内存：%s  平均：%s  最大元素数：%s' % (
+                item['keys'], self.format_bytes(item['memory']),
+                self.format_bytes(item['memory'] // item['keys']), item['max_size']))
+
+            buckets = []
+            lower = 0
+            for limit, count in item['buckets'].items():
+                if count:
+                    label = '%s-%s' % (lower, limit) if limit is not None else '>%s' % lower
+                    buckets.append('%s:%s' % (label, count))
+                if limit is not None:
+                    lower = limit + 1
+            self.stdout.write('  元素数分布：%s' % '  '.join(buckets))
+
+    def format_bytes(self, size):
+        for unit in ('B', 'KB', 'MB'):
+            if size < 1024:
+                return '%s%s' % (size, unit)
+            size //= 1024
+        return '%sGB' % size
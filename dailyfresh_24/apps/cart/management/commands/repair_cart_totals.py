@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+
+from cart import operations
+
+
+class Command(BaseCommand):
+    """根据redis中的购物车重新计算每个购物车的总数量，或者只校验是否一致，包括未登录用户的购物车
+
+    python manage.py repair_cart_totals            重新计算所有购物车
+    python manage.py repair_cart_totals -u 1 -u 2  重新计算指定用户
+    python manage.py repair_cart_totals --check    只校验，不修改数据
+    """
+    help = '重新计算或者校验redis中的购物车总数量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-u', '--user', action='append', type=int, dest='users',
+                            help='用户id，可以指定多个，默认所有购物车')
+        parser.add_argument('--check', action='store_true', dest='check', default=False,
+                            help='只校验总数量和购物车是否一致，不修改数据')
+
+    def handle(self, *args, **options):
+        redis_conn = get_redis_connection('default')
+
+        owners = options['users']
+        if not owners:
+            owners = self.all_owners(redis_conn)
+
+        errors = 0
+        for owner in sorted(owners, key=str):
+            total = redis_conn.get(operations.total_key(owner))
+            expected = sum(int(count) for count in redis_conn.hvals(operations.cart_key(owner)))
+
+            if total is not None and int(total) == expected:
+                continue
+
+            errors += 1
+            self.stdout.write('%s：总数量%s 购物车中%s' % (operations.cart_key(owner), total, expected))
+            if not options['check']:
+                operations.repair_total(redis_conn, owner)
+
+        if options['check'] and errors:
+            raise CommandError('共有%s个购物车的总数量不一致，可以去掉--check修复' % errors)
+        self.stdout.write('共修复%s个购物车的总数量' % errors if errors else '所有购物车的总数量都正确')
+
+    def all_owners(self, redis_conn):
+        """redis中所有有购物车或者有总数量的所有者"""
+        owners = set()
+        for key in redis_conn.scan_iter(match='cart_*', count=1000):
+            owner = operations.owner_of_key(key)
+            if owner is not None:
+                owners.add(owner)
+        return owners
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartArchive',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(verbose_name='更新时间', auto_now=True)),
+                ('cart', models.TextField(verbose_name='购物车', help_text='json字符串，{sku_id: 数量}')),
+                ('user', models.OneToOneField(verbose_name='用户', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'df_cart_archive',
+                'verbose_name': '购物车归档',
+                'verbose_name_plural': '购物车归档',
+            },
+        ),
+    ]
@@ -1,3 +1,16 @@
 from django.db import models
+from utils.models import BaseModel
+from users.models import User
 
 # Create your models here.
+
+
+class CartArchive(BaseModel):
+    """长时间没有使用的购物车，从redis归档到数据库中，用户再次使用时恢复"""
+    user = models.OneToOneField(User, verbose_name="用户")
+    cart = models.TextField(verbose_name="购物车", help_text="json字符串，{sku_id: 数量}")
+
+    class Meta:
+        db_table = "df_cart_archive"
+        verbose_name = "购物车归档"
+        verbose_name_plural = verbose_name
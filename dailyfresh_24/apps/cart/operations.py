@@ -0,0 +1,305 @@
+"""购物车的redis操作
+
+购物车的所有者(owner)：登陆用户是用户id，未登录用户是 anon_<标识>，标识保存在签名cookie中（见cart.owners）
+购物车保存在hash cart_<owner> 中，field是sku_id，value是数量
+购物车中商品的总数量保存在 cart_total_<owner> 中，每次修改购物车时同步修改，
+页面上展示购物车数量时只需要一次GET，不用再读取整个购物车求和
+购物车有过期时间，每次访问时重新计时，长时间没有使用的用户购物车由定时任务归档到数据库（见cart.archive）
+
+修改购物车时使用Lua脚本，在redis中原子地完成"读取-校验库存-写入-修改总数"，
+每次修改只需要一次网络往返，并发添加同一个商品也不会丢失数据
+库存从redis中的库存镜像读取（见goods.stock），镜像中没有时使用调用者传入的库存
+"""
+from goods.stock import STOCK_KEY
+from utils.redis_scripts import get_script
+
+# 未登录用户购物车的过期时间
+ANONYMOUS_TTL = 7 * 24 * 3600
+
+# 登陆用户购物车和浏览记录的过期时间，比归档的时间长，归档任务没有执行时兜底释放内存
+USER_TTL = 60 * 24 * 3600
+
+
+def cart_script(body):
+    """购物车脚本 KEYS[1]是购物车，KEYS[2]是总数量，KEYS[3]是库存镜像，ARGV的最后一个参数是过期时间（0表示不修改）
+
+    总数量还不存在时（老数据），先根据购物车初始化，执行完成后重新设置过期时间
+    stock_of(sku_id, 默认库存)读取库存镜像
+    """
+    return """
+local ttl = tonumber(table.remove(ARGV))
+local function stock_of(sku_id, default)
+    local stock = redis.call('HGET', KEYS[3], sku_id)
+    if stock then
+        return tonumber(stock)
+    end
+    return tonumber(default)
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    local total = 0
+    for _, value in ipairs(redis.call('HVALS', KEYS[1])) do
+        total = total + tonumber(value)
+    end
+    redis.call('SET', KEYS[2], total)
+end
+local function main()
+%s
+end
+local result = main()
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+return result
+""" % body
+
+# 增加商品数量 KEYS: 购物车, 总数量, 库存镜像  ARGV: sku_id, 增加的数量, 默认库存
+# 返回 {状态, 商品数量, 购物车总数}，状态0表示成功，1表示库存不足（此时不修改购物车）
+ADD_LUA = cart_script("""
+    local origin = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+    local count = origin + tonumber(ARGV[2])
+    if count > stock_of(ARGV[1], ARGV[3]) then
+        return {1, origin, tonumber(redis.call('GET', KEYS[2]))}
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], count)
+    return {0, count, redis.call('INCRBY', KEYS[2], count - origin)}
+""")
+
+# 设置商品数量 KEYS: 购物车, 总数量, 库存镜像  ARGV: sku_id, 数量, 默认库存
+# 返回值同ADD_LUA
+SET_LUA = cart_script("""
+    local origin = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+    local count = tonumber(ARGV[2])
+    if count > stock_of(ARGV[1], ARGV[3]) then
+        return {1, origin, tonumber(redis.call('GET', KEYS[2]))}
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], count)
+    return {0, count, redis.call('INCRBY', KEYS[2], count - origin)}
+""")
+
+# 删除商品 KEYS: 购物车, 总数量, 库存镜像  ARGV: sku_id, sku_id, ...
+# 返回购物车总数
+REMOVE_LUA = cart_script("""
+    local removed = 0
+    for _, sku_id in ipairs(ARGV) do
+        local count = redis.call('HGET', KEYS[1], sku_id)
+        if count then
+            removed = removed + tonumber(count)
+            redis.call('HDEL', KEYS[1], sku_id)
+        end
+    end
+    return redis.call('DECRBY', KEYS[2], removed)
+""")
+
+# 批量修改 KEYS: 购物车, 总数量, 库存镜像  ARGV: 每4个一组，操作(add/set/delete), sku_id, 数量, 默认库存
+# 按顺序执行所有修改，返回 {状态1, 商品数量1, 状态2, 商品数量2, ..., 购物车总数}，超出库存的修改不执行
+BATCH_LUA = cart_script("""
+    local results = {}
+    local total = tonumber(redis.call('GET', KEYS[2]))
+    for i = 1, #ARGV, 4 do
+        local op, sku_id = ARGV[i], ARGV[i + 1]
+        local origin = tonumber(redis.call('HGET', KEYS[1], sku_id) or 0)
+        local status, count = 0, 0
+        if op == 'delete' then
+            redis.call('HDEL', KEYS[1], sku_id)
+        else
+            count = tonumber(ARGV[i + 2])
+            if op == 'add' then
+                count = origin + count
+            end
+            if count > stock_of(sku_id, ARGV[i + 3]) then
+                status, count = 1, origin
+            else
+                redis.call('HSET', KEYS[1], sku_id, count)
+            end
+        end
+        total = total + count - origin
+        table.insert(results, status)
+        table.insert(results, count)
+    end
+    redis.call('SET', KEYS[2], total)
+    table.insert(results, total)
+    return results
+""")
+
+# 合并购物车（登陆时把未登录时的购物车合并到用户的购物车）
+# KEYS: 用户购物车, 用户总数量, 库存镜像, 未登录购物车, 未登录总数量  ARGV: 每2个一组，sku_id, 默认库存
+# 相同商品的数量相加，超出库存时取库存（已经超出的不减少），镜像中没有并且没有传入库存的商品不限制，返回合并后的总数量
+MERGE_LUA = cart_script("""
+    local stocks = {}
+    for i = 1, #ARGV, 2 do
+        stocks[ARGV[i]] = tonumber(ARGV[i + 1])
+    end
+
+    local total = tonumber(redis.call('GET', KEYS[2]))
+    local values = redis.call('HGETALL', KEYS[4])
+    for i = 1, #values, 2 do
+        local sku_id = values[i]
+        local origin = tonumber(redis.call('HGET', KEYS[1], sku_id) or 0)
+        local count = origin + tonumber(values[i + 1])
+        local stock = stock_of(sku_id, stocks[sku_id])
+        if stock ~= nil and count > stock then
+            count = math.max(origin, stock)
+        end
+        if count > origin then
+            redis.call('HSET', KEYS[1], sku_id, count)
+            total = total + count - origin
+        end
+    end
+    redis.call('DEL', KEYS[4], KEYS[5])
+    redis.call('SET', KEYS[2], total)
+    return total
+""")
+
+# 恢复归档的购物车 KEYS: 购物车, 总数量, 库存镜像  ARGV: 每2个一组，sku_id, 数量
+# 和当前购物车中的数量相加，返回购物车总数
+RESTORE_LUA = cart_script("""
+    local added = 0
+    for i = 1, #ARGV, 2 do
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+        added = added + tonumber(ARGV[i + 1])
+    end
+    return redis.call('INCRBY', KEYS[2], added)
+""")
+
+
+def anonymous_owner(token):
+    """未登录用户购物车的所有者"""
+    return 'anon_%s' % token
+
+
+def is_anonymous(owner):
+    return str(owner).startswith('anon_')
+
+
+def key_ttl(owner):
+    """购物车的过期时间"""
+    return ANONYMOUS_TTL if is_anonymous(owner) else USER_TTL
+
+
+def owner_of_key(key):
+    """从购物车或者总数量的key解析出所有者，不是购物车的key返回None"""
+    if isinstance(key, bytes):
+        key = key.decode()
+    for prefix in ('cart_total_', 'cart_'):
+        if key.startswith(prefix):
+            owner = key[len(prefix):]
+            if owner.isdigit():
+                return int(owner)
+            if is_anonymous(owner):
+                return owner
+            return None
+    return None
+
+
+def cart_key(owner):
+    """购物车的key"""
+    return 'cart_%s' % owner
+
+
+def total_key(owner):
+    """购物车总数量的key"""
+    return 'cart_total_%s' % owner
+
+
+def run_script(redis_conn, lua, owner, *args, refresh=True):
+    """执行购物车脚本，refresh为False时不重新计算过期时间（后台任务修改购物车时使用）"""
+    keys = [cart_key(owner), total_key(owner), STOCK_KEY]
+    ttl = key_ttl(owner) if refresh else 0
+    return get_script(redis_conn, lua)(keys=keys, args=args + (ttl,), client=redis_conn)
+
+
+def run_line_script(redis_conn, lua, owner, *args):
+    """执行修改一个商品的脚本，返回 (是否成功, 商品数量, 购物车总数)"""
+    status, count, total = run_script(redis_conn, lua, owner, *args)
+    return status == 0, int(count), int(total)
+
+
+def add(redis_conn, owner, sku_id, count, stock):
+    """增加购物车中商品的数量，超出库存时不修改，返回 (是否成功, 商品数量, 购物车总数)
+
+    stock是库存镜像中没有这个商品时使用的库存
+    """
+    return run_line_script(redis_conn, ADD_LUA, owner, sku_id, count, stock)
+
+
+def set_count(redis_conn, owner, sku_id, count, stock):
+    """设置购物车中商品的数量，超出库存时不修改，返回 (是否成功, 商品数量, 购物车总数)"""
+    return run_line_script(redis_conn, SET_LUA, owner, sku_id, count, stock)
+
+
+def remove(redis_conn, owner, sku_ids, refresh=True):
+    """从购物车中删除商品，返回购物车总数"""
+    if not sku_ids:
+        return get_total(redis_conn, owner)
+    return int(run_script(redis_conn, REMOVE_LUA, owner, *sku_ids, refresh=refresh))
+
+
+def restore(redis_conn, owner, cart_dict):
+    """把归档的购物车 {sku_id: 数量} 加回到购物车中，返回购物车总数"""
+    args = []
+    for sku_id, count in cart_dict.items():
+        args.extend([sku_id, count])
+    return int(run_script(redis_conn, RESTORE_LUA, owner, *args))
+
+
+def batch(redis_conn, owner, lines):
+    """一次原子操作执行多个修改，lines是 (操作, sku_id, 数量, 库存) 的列表，操作是add、set、delete
+
+    返回 (每个修改的 (是否成功, 商品数量) 列表, 购物车总数)
+    """
+    args = []
+    for op, sku_id, count, stock in lines:
+        args.extend([op, sku_id, count, stock])
+
+    values = run_script(redis_conn, BATCH_LUA, owner, *args)
+    results = [(values[i] == 0, int(values[i + 1])) for i in range(0, len(values) - 1, 2)]
+    return results, int(values[-1])
+
+
+def merge(redis_conn, source, target, stocks=None):
+    """把source的购物车合并到target中，删除source的购物车，返回合并后的总数量
+
+    相同商品的数量相加，超出库存的数量取库存，库存为0的商品不合并
+    stocks是 {sku_id: 库存}，库存镜像中没有的商品使用这里的库存
+    """
+    args = []
+    for sku_id, stock in (stocks or {}).items():
+        args.extend([sku_id, stock])
+
+    keys = [cart_key(target), total_key(target), STOCK_KEY, cart_key(source), total_key(source)]
+    return int(get_script(redis_conn, MERGE_LUA)(keys=keys, args=args + [key_ttl(target)], client=redis_conn))
+
+
+def get_cart(redis_conn, owner):
+    """读取整个购物车，返回 {sku_id(bytes): 数量(bytes)}，同时重新计算过期时间"""
+    ttl = key_ttl(owner)
+    pipe = redis_conn.pipeline()
+    pipe.hgetall(cart_key(owner))
+    pipe.expire(cart_key(owner), ttl)
+    pipe.expire(total_key(owner), ttl)
+    return pipe.execute()[0]
+
+
+def get_total(redis_conn, owner):
+    """购物车中商品的总数量，一次GET，同时重新计算过期时间"""
+    ttl = key_ttl(owner)
+    pipe = redis_conn.pipeline()
+    pipe.get(total_key(owner))
+    pipe.expire(cart_key(owner), ttl)
+    pipe.expire(total_key(owner), ttl)
+    total = pipe.execute()[0]
+
+    if total is None:
+        # 老数据还没有总数量，根据购物车计算一次
+        total = repair_total(redis_conn, owner)
+    return int(total)
+
+
+def repair_total(redis_conn, owner):
+    """根据购物车重新计算总数量，返回总数量"""
+    total = 0
+    for count in redis_conn.hvals(cart_key(owner)):
+        total += int(count)
+    redis_conn.set(total_key(owner), total, ex=key_ttl(owner))
+    return total
@@ -0,0 +1,105 @@
+"""购物车的所有者
+
+登陆用户的购物车属于用户id；未登录用户的购物车也保存在redis中，属于一个随机标识，
+cookie中只保存签名后的标识，不再保存整个购物车的json，请求头不会随着购物车变大
+每次访问购物车时重新设置cookie，和redis中的过期时间一起滑动过期
+以前保存在cookie中的购物车json，在访问购物车、登陆时合并到redis中，合并以后才删除cookie
+"""
+import json
+import uuid
+
+from django_redis import get_redis_connection
+
+from cart import operations
+from goods import snapshots
+
+# 保存未登录用户购物车标识的cookie
+COOKIE_NAME = 'cart_id'
+COOKIE_SALT = 'cart'
+
+# 以前保存整个购物车json的cookie {sku_id: 数量}，合并到redis以后删除
+LEGACY_COOKIE_NAME = 'cart'
+
+
+def get_token(request):
+    """cookie中未登录用户购物车的标识，没有或者签名错误时返回None"""
+    if not hasattr(request, '_cart_token'):
+        request._cart_token = request.get_signed_cookie(COOKIE_NAME, default=None, salt=COOKIE_SALT,
+                                                        max_age=operations.ANONYMOUS_TTL)
+    return request._cart_token
+
+
+def get_owner(request, create=False):
+    """当前请求的购物车所有者，未登录用户还没有购物车时，create为True时创建标识，否则返回None"""
+    if request.user.is_authenticated():
+        return request.user.id
+
+    token = get_token(request)
+    if token is None:
+        if not create:
+            return None
+        token = request._cart_token = uuid.uuid4().hex
+
+    return operations.anonymous_owner(token)
+
+
+def legacy_lines(request):
+    """以前的cookie中的购物车，返回 {sku_id: 数量}，格式错误的内容忽略"""
+    try:
+        cart_dict = json.loads(request.COOKIES.get(LEGACY_COOKIE_NAME, ''))
+    except ValueError:
+        return {}
+    if not isinstance(cart_dict, dict):
+        return {}
+
+    lines = {}
+    for sku_id, count in cart_dict.items():
+        try:
+            sku_id, count = int(sku_id), int(count)
+        except (TypeError, ValueError):
+            continue
+        if count > 0:
+            lines[sku_id] = count
+    return lines
+
+
+def migrate_legacy(request, redis_conn=None):
+    """以前的cookie中的购物车合并到当前所有者的购物车中（未登录时创建标识），一个请求只合并一次
+
+    相同商品的数量相加，超出库存的商品不合并，已经删除的商品跳过；合并以后set_cookie才删除以前的cookie
+    """
+    if LEGACY_COOKIE_NAME not in request.COOKIES or getattr(request, '_legacy_cart_migrated', False):
+        return
+
+    lines = legacy_lines(request)
+    sku_dict = snapshots.get_many(lines.keys()) if lines else {}
+    if sku_dict:
+        if redis_conn is None:
+            redis_conn = get_redis_connection('default')
+        owner = get_owner(request, create=True)
+        operations.batch(redis_conn, owner, [('add', sku_id, lines[sku_id], sku.stock)
+                                             for sku_id, sku in sku_dict.items()])
+
+    request._legacy_cart_migrated = True
+
+
+def set_cookie(request, response):
+    """未登录用户访问过购物车时，重新设置cookie，延长过期时间"""
+    if not request.user.is_authenticated() and getattr(request, '_cart_token', None):
+        response.set_signed_cookie(COOKIE_NAME, request._cart_token, salt=COOKIE_SALT,
+                                   max_age=operations.ANONYMOUS_TTL, httponly=True)
+
+    # 以前的cookie已经合并到redis中
+    if getattr(request, '_legacy_cart_migrated', False):
+        response.delete_cookie(LEGACY_COOKIE_NAME)
+
+    return response
+
+
+class CartOwnerMixin(object):
+    """使用购物车的视图，先合并以前的cookie中的购物车，响应时刷新未登录用户购物车的cookie"""
+
+    def dispatch(self, request, *args, **kwargs):
+        migrate_legacy(request)
+        response = super(CartOwnerMixin, self).dispatch(request, *args, **kwargs)
+        return set_cookie(request, response)
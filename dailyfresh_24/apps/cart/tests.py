@@ -1,3 +1,95 @@
+import json
+import uuid
+
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from cart import operations, owners
+from cart.views import AddCartView, CartInfoView, UpdateCartView
+from goods import snapshots
+from utils.testing import RedisTestMixin, create_skus
 
 # Create your tests here.
+
+# 购物车中的商品数量
+CART_LINES = 50
+
+
+class CartQueriesTest(RedisTestMixin, TestCase):
+    """渲染一个有很多商品的购物车页面，检查数据库查询次数，防止购物车页面退化成每个商品查询一次"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sku_ids = [sku.id for sku in create_skus(CART_LINES)]
+
+    def setUp(self):
+        super(CartQueriesTest, self).setUp()
+        self.token = uuid.uuid4().hex
+        owner = operations.anonymous_owner(self.token)
+        operations.restore(self.redis_conn, owner, dict((sku_id, 1) for sku_id in self.sku_ids))
+        # 清除进程内缓存中其他测试留下的快照
+        snapshots.invalidate(self.sku_ids)
+
+    def render(self):
+        """渲染购物车页面，返回数据库查询次数"""
+        request = RequestFactory().get(reverse('cart:info'))
+        signer = signing.get_cookie_signer(salt=owners.COOKIE_NAME + owners.COOKIE_SALT)
+        request.COOKIES[owners.COOKIE_NAME] = signer.sign(self.token)
+        request.user = AnonymousUser()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = CartInfoView.as_view()(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode().count('class="cart_list_td'), len(self.sku_ids))
+        return len(queries)
+
+    def test_cold_snapshots(self):
+        """快照缓存全部失效时最多查询一次数据库"""
+        self.assertLessEqual(self.render(), 1)
+
+    def test_warm_snapshots(self):
+        """快照缓存命中时不查询数据库"""
+        self.render()
+        self.assertEqual(self.render(), 0)
+
+
+class CartLineViewsTest(RedisTestMixin, TestCase):
+    """添加、修改购物车：数量必须是正整数，sku_id统一使用校验过的商品id"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sku = create_skus(1)[0]
+
+    def setUp(self):
+        super(CartLineViewsTest, self).setUp()
+        self.token = uuid.uuid4().hex
+        self.owner = operations.anonymous_owner(self.token)
+        snapshots.invalidate([self.sku.id])
+
+    def post(self, view, sku_id, count):
+        """请求添加或者修改购物车的接口，返回code"""
+        request = RequestFactory().post('/', {'sku_id': sku_id, 'count': count})
+        signer = signing.get_cookie_signer(salt=owners.COOKIE_NAME + owners.COOKIE_SALT)
+        request.COOKIES[owners.COOKIE_NAME] = signer.sign(self.token)
+        request.user = AnonymousUser()
+        return json.loads(view.as_view()(request).content.decode())['code']
+
+    def test_reject_non_positive_count(self):
+        """数量是0或者负数时不修改购物车"""
+        self.assertEqual(self.post(AddCartView, self.sku.id, 2), 0)
+        self.assertEqual(self.post(AddCartView, self.sku.id, -1), 4)
+        self.assertEqual(self.post(UpdateCartView, self.sku.id, 0), 3)
+        self.assertEqual(operations.get_cart(self.redis_conn, self.owner), {str(self.sku.id).encode(): b'2'})
+        self.assertEqual(operations.get_total(self.redis_conn, self.owner), 2)
+
+    def test_normalize_sku_id(self):
+        """'01'和'1'是同一个商品"""
+        self.post(AddCartView, self.sku.id, 1)
+        self.post(AddCartView, '0%s' % self.sku.id, 1)
+        self.assertEqual(operations.get_cart(self.redis_conn, self.owner), {str(self.sku.id).encode(): b'2'})
@@ -13,5 +13,11 @@ urlpatterns = [
     url(r'^update$', views.UpdateCartView.as_view(), name='update'),
 
     # 删除购物车
-    url(r'^delete$', views.DeleteCartView.as_view(), name='delete')
+    url(r'^delete$', views.DeleteCartView.as_view(), name='delete'),
+
+    # 购物车数量 http://127.0.0.1:8000/cart/count
+    url(r'^count$', views.CartCountView.as_view(), name='count'),
+
+    # 批量修改购物车 http://127.0.0.1:8000/cart/batch
+    url(r'^batch$', views.BatchCartView.as_view(), name='batch')
 ]
\ No newline at end of file
@@ -1,12 +1,54 @@
 from django.shortcuts import render, redirect
 from django.views.generic import View
 from django.http import JsonResponse
-from goods.models import GoodsSKU
+from goods import snapshots
+from cart import archive, operations
+from cart.owners import CartOwnerMixin, get_owner
+from goods.views import BaseCartView
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import ensure_csrf_cookie
 from django_redis import get_redis_connection
 import json
+from decimal import Decimal
 # Create your views here.
 
-class DeleteCartView(View):
+class CartCountView(CartOwnerMixin, BaseCartView):
+    """购物车数量和登陆状态：主页、列表页、详情页异步加载，使这些页面对所有用户都是相同的内容"""
+
+    @method_decorator(never_cache)
+    @method_decorator(ensure_csrf_cookie)
+    def get(self, request):
+        """查询购物车数量，详情页传入sku_id时记录浏览记录"""
+
+        # 查询购物车信息
+        cart_num = self.get_cart_num(request)
+
+        username = ''
+        if request.user.is_authenticated():
+            username = request.user.username
+
+            # 记录详情页的浏览记录
+            sku_id = request.GET.get('sku_id')
+            if sku_id and sku_id.isdigit():
+                redis_conn = get_redis_connection('default')
+                user_id = request.user.id
+
+                pipe = redis_conn.pipeline()
+                # 删除重复的sku_id
+                pipe.lrem('history_%s' % user_id, 0, sku_id)
+                # 记录浏览信息
+                pipe.lpush('history_%s' % user_id, sku_id)
+                # 最多保存5条记录
+                pipe.ltrim('history_%s' % user_id, 0, 4)
+                # 长时间没有浏览时过期
+                pipe.expire('history_%s' % user_id, operations.USER_TTL)
+                pipe.execute()
+
+        return JsonResponse({'code': 0, 'message': 'OK', 'cart_num': cart_num, 'username': username})
+
+
+class DeleteCartView(CartOwnerMixin, View):
     """删除购物车记录：一次删除一个"""
     def post(self, request):
 
@@ -18,37 +60,22 @@ class DeleteCartView(View):
             return JsonResponse({'code': 1, 'message': '用户不存在'})
 
         # 判断sku_id是否合法
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        sku = snapshots.get(sku_id)
+        if sku is None:
             return JsonResponse({'code': 2, 'message': '删除的商品不存在'})
 
-        # 判断用户是否登陆
-        if request.user.is_authenticated():
-            # 如果是登陆用户，删除redis中的购物车信息
-            redis_conn = get_redis_connection('default')
-            user_id = request.user.id
-            redis_conn.hdel('cart_%s' % user_id, sku_id)
-
-        else:
-            # 如果是未登录用户，删除cookie中的购物车信息
-            cart_json = request.COOKIES.get('cart')
-            if cart_json is not None:
-                cart_dict = json.loads(cart_json)
-
-                del cart_dict[sku_id]
-
-                new_cart_json = json.dumps(cart_dict)
-
-                response = JsonResponse({'code':0, 'message':'删除成功'})
-                response.set_cookie('cart', new_cart_json)
+        # 删除redis中的购物车信息，登陆和未登录用户相同
+        owner = get_owner(request)
+        if owner is None:
+            return JsonResponse({'code': 0, 'message': '删除成功', 'cart_num': 0})
 
-                return response
+        redis_conn = get_redis_connection('default')
+        cart_num = operations.remove(redis_conn, owner, [sku.id])
 
-        return JsonResponse({'code': 0, 'message': '删除成功'})
+        return JsonResponse({'code': 0, 'message': '删除成功', 'cart_num': cart_num})
 
 
-class UpdateCartView(View):
+class UpdateCartView(CartOwnerMixin, View):
     """更新购物车信息"""
     def post(self, request):
         """+ - 手动输入"""
@@ -62,81 +89,62 @@ class UpdateCartView(View):
             return JsonResponse({'code':1, 'message':'缺少参数'})
 
         # 判断商品是否存在
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        sku = snapshots.get(sku_id)
+        if sku is None:
             return JsonResponse({'code': 2, 'message': '商品不存在'})
 
-        # 判断count是否是整数
+        # 判断count是否是正整数，和批量修改的校验相同
         try:
             count = int(count)
         except Exception:
+            count = 0
+        if count <= 0:
             return JsonResponse({'code': 3, 'message': '商品数量错误'})
 
-        # 判断库存
-        if count > sku.stock:
+        # 将修改的购物车数据存储到redis中，同时返回购物车中的商品数量，登陆和未登录用户相同
+        # 库存在同一个脚本中从redis的库存镜像读取并判断
+        # 使用校验过的sku.id，'01'和'1'不会成为购物车中两个不同的字段
+        redis_conn = get_redis_connection('default')
+        owner = get_owner(request, create=True)
+        success, count, cart_num = operations.set_count(redis_conn, owner, sku.id, count, sku.stock)
+        if not success:
             return JsonResponse({'code': 4, 'message': '库存不足'})
 
-        # 判断用户是否登陆
-        if request.user.is_authenticated():
-            # 如果用户登陆，将修改的购物车数据存储到redis中
-            redis_conn = get_redis_connection('default')
-            user_id = request.user.id
-            redis_conn.hset('cart_%s' % user_id, sku_id, count)
-            return JsonResponse({'code': 0, 'message': '更新购物车成功'})
-
-        else:
-            # 如果用户未登录，将修改的购物车数据存储到cookie中
-            cart_json = request.COOKIES.get('cart')
-            if cart_json is not None:
-                cart_dict = json.loads(cart_json)
-            else:
-                cart_dict = {}
+        return JsonResponse({'code': 0, 'message': '更新购物车成功', 'cart_num': cart_num})
 
-            cart_dict[sku_id] = count
 
-            new_cart_json = json.dumps(cart_dict)
-
-            # 更新cookie中的购物车信息
-            response = JsonResponse({'code': 0, 'message': '更新购物车成功'})
-            response.set_cookie('cart', new_cart_json)
-
-            return response
-
-
-class CartInfoView(View):
+class CartInfoView(CartOwnerMixin, View):
     """购物车信息"""
     def get(self, request):
         """查询登陆和未登录时购物车信息，并且渲染"""
-        if request.user.is_authenticated():
-            # 用户已登陆，查询redis中购物车信息
+        # 查询redis中购物车信息，登陆和未登录用户相同
+        # 字典是通过hgetall得到的，key和value都是bytes类型
+        owner = get_owner(request)
+        if owner is not None:
             redis_conn = get_redis_connection('default')
-            user_id = request.user.id
-
-            # cart_dict如果字典是通过redis_conn.hgetall得到的，那么字典的key和value信息是bytes类型
-            cart_dict = redis_conn.hgetall('cart_%s' % user_id)
+            cart_dict = operations.get_cart(redis_conn, owner)
 
+            # 登陆用户的购物车是空的时候，可能是长时间没有使用已经归档，恢复以后重新读取
+            if not cart_dict and request.user.is_authenticated():
+                archive.restore(redis_conn, owner)
+                cart_dict = operations.get_cart(redis_conn, owner)
         else:
-            # 用户未登陆时，要查询cookie中的数据
-            cart_json = request.COOKIES.get('cart')
-
-            # 如果cart_dict通过cookie中得到，那么key是字符串类型，count是int类型
-            if cart_json is not None:
-                cart_dict = json.loads(cart_json)
-            else:
-                cart_dict = {}
+            cart_dict = {}
 
         # 定义临时变量
         skus = []
         total_count = 0   # 记录件数
-        total_sku_amount = 0  # 记录总金额
+        total_sku_amount = Decimal('0')  # 记录总金额，价格是Decimal，避免浮点误差
         # 运费默认为10元
 
+        # 一次查询出购物车中所有的商品（进程内缓存 -> redis -> 最多一次数据库查询），已经删除的商品不在结果中
+        sku_dict = snapshots.get_many(cart_dict.keys())
+
+        # 按照购物车中的顺序展示
         for sku_id, count in cart_dict.items():
-            try:
-                sku = GoodsSKU.objects.get(id=sku_id)
-            except GoodsSKU.DoesNotExist:
-                continue  # 有异常跳过，展示没有异常的数据
+            sku = sku_dict.get(int(sku_id))
+            if sku is None:
+                continue  # 商品不存在跳过，展示没有异常的数据
 
             # 统一count的数据类型为int类型
             count = int(count)
@@ -165,7 +173,7 @@ class CartInfoView(View):
         return render(request, 'cart.html', context)
 
 
-class AddCartView(View):
+class AddCartView(CartOwnerMixin, View):
     """添加到购物车"""
 
     def post(self, request):
@@ -185,82 +193,111 @@ class AddCartView(View):
             return JsonResponse({'code': 2, 'message': '缺少参数'})
 
         # 判断sku_id是否合法
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+        sku = snapshots.get(sku_id)
+        if sku is None:
             return JsonResponse({'code': 3, 'message': '商品不存在'})
 
-        # 判断count是否合法
+        # 判断count是否合法，和批量修改的校验相同
         try:
             count = int(count)
         except Exception:
+            count = 0
+        if count <= 0:
             return JsonResponse({'code': 4, 'message': '商品数量错误'})
 
+        # 保存购物车数据到redis：累加数量、判断库存（redis的库存镜像）、查询购物车中的商品数量，一次原子操作完成
+        # 登陆和未登录用户相同，未登录用户第一次添加时创建购物车标识
+        redis_conn = get_redis_connection('default')
+        owner = get_owner(request, create=True)
+        success, count, cart_num = operations.add(redis_conn, owner, sku.id, count, sku.stock)
+
         # 判断库存是否超出
-        if count > sku.stock:
+        if not success:
             return JsonResponse({'code': 5, 'message': '库存不足'})
 
-        if request.user.is_authenticated():
+        # 响应结果
+        return JsonResponse({'code': 0, 'message': '添加购物车成功', 'cart_num':cart_num})
 
-            # 获取user_id
-            user_id = request.user.id
 
-            # 保存购物车数据到redis
-            redis_conn = get_redis_connection('default')
+class BatchCartView(CartOwnerMixin, View):
+    """批量修改购物车：购物车页面把一段时间内的增加、修改、删除合并成一个请求
 
-            # 需要查询要保存的购物车的商品数据是否存在
-            orgin_count = redis_conn.hget('cart_%s' % user_id, sku_id)
-            if orgin_count is not None:
-                count += int(orgin_count)
+    请求体是json：{"ops": [{"op": "add"/"set"/"delete", "sku_id": 1, "count": 2}, ...]}
+    所有商品一次查询校验，所有修改在redis中一次原子操作完成
+    """
 
-            # 再次判断库存是否超出
-            if count > sku.stock:
-                return JsonResponse({'code': 5, 'message': '库存不足'})
+    # 一次最多修改的数量
+    MAX_OPS = 50
 
-            redis_conn.hset('cart_%s' % user_id, sku_id, count)
+    def post(self, request):
+
+        # 解析参数
+        try:
+            ops = json.loads(request.body.decode())['ops']
+        except Exception:
+            return JsonResponse({'code': 1, 'message': '参数错误'})
 
-            # 查询购物车中的商品数量，响应给前端
-            cart_num = 0
-            cart_dict = redis_conn.hgetall('cart_%s' % user_id)
-            for val in cart_dict.values():
-                cart_num += int(val)
+        if not isinstance(ops, list) or not ops:
+            return JsonResponse({'code': 1, 'message': '参数错误'})
 
-            # 响应结果
-            return JsonResponse({'code': 0, 'message': '添加购物车成功', 'cart_num':cart_num})
+        if len(ops) > self.MAX_OPS:
+            return JsonResponse({'code': 1, 'message': '一次最多修改%s个商品' % self.MAX_OPS})
 
-        else:
-            # 用户未登陆，保存购物车数据到cookie中
-            # 读取cookie中的购物车数据
-            cart_json = request.COOKIES.get('cart')
-            if cart_json is not None:
-                # 把cart_json转成字典
-                cart_dict = json.loads(cart_json)
-            else:
-                cart_dict = {}
+        # 一次查询出所有商品
+        sku_ids = [op.get('sku_id') for op in ops if isinstance(op, dict)]
+        sku_dict = snapshots.get_many([sku_id for sku_id in sku_ids if str(sku_id).isdigit()])
+
+        # 校验每一个修改，results和ops一一对应，校验通过的修改记录在lines中
+        results = []
+        lines = []
+        for op in ops:
+            result, line = self.check_op(op, sku_dict)
+            results.append(result)
+            if line is not None:
+                lines.append((result, line))
 
-            # 判断要存储的商品信息，是否已经存在
-            if sku_id in cart_dict:
-                orgin_count = cart_dict[sku_id]
-                count += orgin_count
+        # 所有修改一次原子操作完成，登陆和未登录用户相同
+        redis_conn = get_redis_connection('default')
+        owner = get_owner(request, create=True)
+        line_results, cart_num = operations.batch(redis_conn, owner, [line for result, line in lines])
+        for (result, line), (success, count) in zip(lines, line_results):
+            self.set_result(result, sku_dict[line[1]], success, count)
 
-            # 再次判断库存是否超出
-            if count > sku.stock:
-                return JsonResponse({'code': 5, 'message': '库存不足'})
+        return JsonResponse({'code': 0, 'message': 'OK', 'results': results, 'cart_num': cart_num})
 
-            cart_dict[sku_id] = count
+    def check_op(self, op, sku_dict):
+        """校验一个修改，返回 (结果, (操作, sku_id, 数量, 库存))，校验失败时第二项为None"""
+        if not isinstance(op, dict) or op.get('op') not in ('add', 'set', 'delete'):
+            return {'code': 1, 'message': '参数错误'}, None
 
-            # 在写入cookie之前，将cart_dict转出json字符串
-            new_cart_json = json.dumps(cart_dict)
+        result = {'op': op['op'], 'sku_id': op.get('sku_id')}
 
-            # 为了方便前端展示最新的购物车数量
-            cart_num = 0
-            for val in cart_dict.values():
-                cart_num += val
+        try:
+            sku = sku_dict.get(int(op.get('sku_id')))
+        except Exception:
+            sku = None
+        if sku is None:
+            result.update({'code': 2, 'message': '商品不存在'})
+            return result, None
+
+        if op['op'] == 'delete':
+            return result, ('delete', sku.id, 0, 0)
 
-            # 创建response
-            response = JsonResponse({'code':0, 'message':'添加购物车成功', 'cart_num': cart_num})
+        try:
+            count = int(op.get('count'))
+        except Exception:
+            count = 0
+        if count <= 0:
+            result.update({'code': 3, 'message': '商品数量错误'})
+            return result, None
 
-            # 写入cookie
-            response.set_cookie('cart', new_cart_json)
+        return result, (op['op'], sku.id, count, sku.stock)
 
-            return response
+    def set_result(self, result, sku, success, count):
+        """记录执行结果：修改后的商品数量和小计，超出库存时是修改前的数量"""
+        if success:
+            result.update({'code': 0, 'message': 'OK'})
+        else:
+            result.update({'code': 4, 'message': '库存不足'})
+        result['count'] = count
+        result['amount'] = str(count * sku.price)
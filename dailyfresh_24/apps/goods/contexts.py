@@ -0,0 +1,179 @@
+"""构造商品页面的上下文数据，返回的都是可以直接缓存的普通字典和列表，不包含查询集"""
+from django.core.cache import cache
+from django.core.paginator import Paginator, EmptyPage
+from goods.models import GoodsCategory, GoodsSKU, IndexPromotionBanner, IndexGoodsBanner, IndexCategoryGoodsBanner
+from goods import listing, reviews
+
+# 详情页数据的缓存key和过期时间：秒数
+# 主页数据的缓存，数据变化时由last_modified.touch删除
+INDEX_CACHE_KEY = 'index_page_data'
+INDEX_CACHE_TIMEOUT = 3600
+
+DETAIL_CACHE_KEY = 'detail_page_data_%s'
+DETAIL_CACHE_TIMEOUT = 3600
+
+
+def image_data(image):
+    """图片字段转成字典，模板中继续使用 image.url"""
+    return {'url': image.url}
+
+
+def category_data(category):
+    """商品分类转成字典"""
+    return {
+        'id': category.id,
+        'name': category.name,
+        'logo': category.logo,
+        'image': image_data(category.image),
+    }
+
+
+def sku_data(sku):
+    """商品SKU转成字典，只保留列表、推荐位需要展示的字段"""
+    return {
+        'id': sku.id,
+        'name': sku.name,
+        'price': sku.price,
+        'unit': sku.unit,
+        'default_image': image_data(sku.default_image),
+    }
+
+
+def build_index_context():
+    """查询主页需要的数据：分类、轮播、活动、分类展示商品，不管有多少分类，固定执行4次查询"""
+
+    # 查询商品分类信息
+    categorys = [category_data(category) for category in GoodsCategory.objects.all()]
+
+    # 查询图片轮播信息 需求：根据index从小到大排序
+    goods_banners = [
+        {'id': banner.id, 'image': image_data(banner.image)}
+        for banner in IndexGoodsBanner.objects.all().order_by('index')
+    ]
+
+    # 查询商品活动信息
+    promotionbanners = [
+        {'id': banner.id, 'name': banner.name, 'url': banner.url, 'image': image_data(banner.image)}
+        for banner in IndexPromotionBanner.objects.all().order_by('index')
+    ]
+
+    # 一次查询出所有分类的展示商品，连同sku一起查询，再按分类和展示类型分组
+    category_dict = {}
+    for category in categorys:
+        category['title_banners'] = []
+        category['image_banners'] = []
+        category_dict[category['id']] = category
+
+    category_banners = IndexCategoryGoodsBanner.objects.select_related('sku').order_by('index')
+    for banner in category_banners:
+        category = category_dict.get(banner.category_id)
+        if category is None:
+            continue
+
+        if banner.display_type == 0:
+            category['title_banners'].append({'sku': sku_data(banner.sku)})
+        else:
+            category['image_banners'].append({'sku': sku_data(banner.sku)})
+
+    return {
+        'categorys': categorys,
+        'goods_banners': goods_banners,
+        'promotionbanners': promotionbanners,
+    }
+
+
+def build_list_context(category, sort, page_num):
+    """查询列表页数据：分类、新品推荐、排序分页后的商品，页码超出范围时展示第一页"""
+
+    # 查询所有的商品分类
+    categorys = GoodsCategory.objects.all()
+
+    # 查询新品推荐：从redis排行中读取
+    new_skus = listing.new_skus(category.id)
+
+    # 查询category_id 对应 的sku信息, 并且排序：从redis排序索引中读取
+    if sort not in listing.SORTS:
+        sort = 'default'
+    skus = listing.SortedSKUList(category.id, sort)
+
+    # 查询分页数据
+    paginator = Paginator(skus, listing.PAGE_SIZE)
+    try:
+        page_skus = paginator.page(page_num)
+    except EmptyPage:
+        page_skus = paginator.page(1)
+
+    # 获取页码列表
+    page_list = paginator.page_range
+
+    return {
+        'category': category,
+        'categorys': categorys,
+        'new_skus': new_skus,
+        'page_skus': page_skus,
+        'page_list': page_list,
+        'sort': sort,
+    }
+
+
+def build_detail_context(sku):
+    """查询详情页中和用户无关、只随这个商品变化的数据：商品、分类、评论、其他规格
+
+    新品推荐随分类中其他商品变化，不在这里查询，由get_detail_context每次读取
+    """
+
+    # 查询商品分类信息:6大分类
+    categorys = [category_data(category) for category in GoodsCategory.objects.all()]
+
+    # 查询商品评价信息：评论数量和最新的评论保存在redis中，更多评论通过goods:reviews分页加载
+    review_stats = reviews.review_stats(sku.id)
+
+    # 查询其他规格商品信息
+    other_skus = [{'id': other_sku.id, 'price': other_sku.price, 'unit': other_sku.unit}
+                  for other_sku in GoodsSKU.objects.filter(goods_id=sku.goods_id).exclude(id=sku.id)]
+
+    # 商品信息，补充详情页需要的分类名称和商品详情介绍
+    data = sku_data(sku)
+    data.update({
+        'title': sku.title,
+        'category': {'id': sku.category.id, 'name': sku.category.name},
+        'goods': {'id': sku.goods.id, 'desc': sku.goods.desc},
+    })
+
+    return {
+        'sku': data,
+        'categorys': categorys,
+        'sku_orders': review_stats['latest'],
+        'review_count': review_stats['count'],
+        'review_cursor': review_stats['cursor'],
+        'other_skus': other_skus,
+    }
+
+
+def get_detail_context(sku_id):
+    """读取详情页数据，优先读取缓存，商品不存在时返回None
+
+    新品推荐不放在缓存中：分类中其他商品上架、修改时不会清除这个商品的缓存，每次从redis排行中读取
+    """
+    context = cache.get(DETAIL_CACHE_KEY % sku_id)
+    if context is None:
+        try:
+            sku = GoodsSKU.objects.select_related('category', 'goods').get(id=sku_id)
+        except GoodsSKU.DoesNotExist:
+            return None
+
+        context = build_detail_context(sku)
+        cache.set(DETAIL_CACHE_KEY % sku_id, context, DETAIL_CACHE_TIMEOUT)
+
+    # 查询最新推荐商品信息: 从redis排行中获取最新发布的两件商品
+    category_id = context['sku']['category']['id']
+    context['new_skus'] = [sku_data(new_sku) for new_sku in listing.new_skus(category_id)]
+
+    return context
+
+
+def clear_detail_context(sku_ids):
+    """商品、同一SPU下的其他规格或者评论发生变化时，删除详情页缓存"""
+    keys = [DETAIL_CACHE_KEY % sku_id for sku_id in sku_ids]
+    if keys:
+        cache.delete_many(keys)
@@ -0,0 +1,122 @@
+"""商品页面数据的最后修改时间，提供给条件请求(Last-Modified/ETag)和整页缓存使用
+
+每一类数据一个缓存key，保存对应数据行的最大update_time
+数据保存、删除时由goods.signals在事务提交以后刷新为当前时间，缓存过期或丢失时从数据库重新计算
+分类、商品不存在时不计算也不缓存，任意的id不会在缓存中留下key
+"""
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+
+from goods.models import GoodsCategory, Goods, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexCategoryGoodsBanner
+from goods import snapshots
+from goods.contexts import INDEX_CACHE_KEY
+from orders.models import OrderGoods
+
+# 所有页面都展示了商品分类
+CATEGORY_KEY = 'last_modified_category'
+# 主页轮播、活动、分类展示商品
+INDEX_KEY = 'last_modified_index'
+# 分类下的商品：列表页，详情页的新品推荐
+LIST_KEY = 'last_modified_list_%s'
+# 商品、同一SPU下的其他规格、商品详情介绍、评论
+DETAIL_KEY = 'last_modified_detail_%s'
+
+# 数据库中没有数据时使用的时间
+EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+# 最后修改时间缓存的时间（秒），过期以后从数据库重新计算
+TIMEOUT = 24 * 3600
+
+
+def _max_update_time(*querysets):
+    """多个查询集中最大的update_time"""
+    times = [queryset.aggregate(Max('update_time'))['update_time__max'] for queryset in querysets]
+    times = [value for value in times if value is not None]
+    return max(times) if times else EPOCH
+
+
+def _compute(key):
+    """缓存丢失时，从数据库计算最后修改时间，分类或者商品不存在时返回None"""
+    if key == CATEGORY_KEY:
+        return _max_update_time(GoodsCategory.objects.all())
+
+    if key == INDEX_KEY:
+        return _max_update_time(IndexGoodsBanner.objects.all(),
+                                IndexPromotionBanner.objects.all(),
+                                IndexCategoryGoodsBanner.objects.all(),
+                                GoodsSKU.objects.all())
+
+    if key.startswith('last_modified_list_'):
+        category_id = key[len('last_modified_list_'):]
+        if not GoodsCategory.objects.filter(id=category_id).exists():
+            return None
+        return _max_update_time(GoodsSKU.objects.filter(category_id=category_id))
+
+    sku_id = key[len('last_modified_detail_'):]
+    goods_ids = list(GoodsSKU.objects.filter(id=sku_id).values_list('goods_id', flat=True))
+    if not goods_ids:
+        return None
+    return _max_update_time(GoodsSKU.objects.filter(goods_id__in=goods_ids),
+                            Goods.objects.filter(id__in=goods_ids),
+                            OrderGoods.objects.filter(sku_id=sku_id))
+
+
+def _latest(*keys):
+    """读取多个key的最后修改时间，返回其中最大的一个，分类或者商品不存在时返回None"""
+    values = cache.get_many(keys)
+
+    missing = {}
+    for key in keys:
+        if key not in values:
+            value = _compute(key)
+            if value is None:
+                return None
+            missing[key] = value
+    if missing:
+        cache.set_many(missing, TIMEOUT)
+        values.update(missing)
+
+    return max(values.values())
+
+
+def touch(*keys):
+    """数据发生变化，刷新最后修改时间，需要在事务提交以后调用
+
+    主页和分类变化时同时删除主页数据的缓存，否则新的最后修改时间下渲染的还是缓存中的旧数据
+    """
+    if keys:
+        now = timezone.now()
+        cache.set_many(dict((key, now) for key in keys), TIMEOUT)
+        if INDEX_KEY in keys or CATEGORY_KEY in keys:
+            cache.delete(INDEX_CACHE_KEY)
+
+
+def touch_lists(category_ids):
+    """分类下的商品发生变化"""
+    touch(*[LIST_KEY % category_id for category_id in set(category_ids)])
+
+
+def touch_details(sku_ids):
+    """商品详情页的数据发生变化"""
+    touch(*[DETAIL_KEY % sku_id for sku_id in set(sku_ids)])
+
+
+def index_last_modified(request):
+    """主页数据的最后修改时间"""
+    return _latest(INDEX_KEY, CATEGORY_KEY)
+
+
+def list_last_modified(request, category_id, page_num):
+    """列表页数据的最后修改时间"""
+    return _latest(LIST_KEY % category_id, CATEGORY_KEY)
+
+
+def detail_last_modified(request, sku_id):
+    """详情页数据的最后修改时间，商品不存在时返回None，由视图处理"""
+    sku = snapshots.get(sku_id)
+    if sku is None:
+        return None
+    return _latest(DETAIL_KEY % sku_id, LIST_KEY % sku.category_id, CATEGORY_KEY)
@@ -0,0 +1,215 @@
+"""商品列表页的排序索引：每个分类、每种排序规则一个redis有序集合，member是sku_id
+
+list_<category_id>_price        按价格排序
+list_<category_id>_sales        按销量排序
+list_<category_id>_create_time  按上架时间排序
+
+分页时直接按排名读取有序集合，第500页和第1页的代价一样，不再需要COUNT(*)和OFFSET
+GoodsSKU保存或删除时，由goods.signals更新对应的有序集合，下单成功后增加销量的分数
+新品推荐也直接读取这些有序集合
+"""
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from goods import snapshots
+
+# 每一页展示的商品数量
+PAGE_SIZE = 2
+
+# 有序集合的排序字段
+SORT_KEYS = ('price', 'sales', 'create_time')
+
+# 页面上的排序规则 -> (排序字段, 是否从大到小)
+SORTS = {
+    'default': ('create_time', False),
+    'price': ('price', False),
+    'hot': ('sales', True),
+}
+
+# 已经建立了索引的分类id集合
+BUILT_KEY = 'list_built'
+
+# sku_id -> category_id，商品修改分类时，用来从原来分类的索引中删除
+CATEGORY_KEY = 'list_sku_category'
+
+
+def list_key(category_id, sort_key):
+    """分类排序索引的key"""
+    return 'list_%s_%s' % (category_id, sort_key)
+
+
+def zadd(redis_conn, key, score, member):
+    """ZADD，直接发送命令，兼容不同版本redis-py的参数顺序"""
+    return redis_conn.execute_command('ZADD', key, score, member)
+
+
+def sku_scores(sku):
+    """商品在各个排序索引中的分数"""
+    return {
+        'price': float(sku.price),
+        'sales': sku.sales,
+        'create_time': sku.create_time.timestamp(),
+    }
+
+
+def zincrby(redis_conn, key, amount, member):
+    """ZINCRBY，直接发送命令，兼容不同版本redis-py的参数顺序"""
+    return redis_conn.execute_command('ZINCRBY', key, amount, member)
+
+
+def incr_sales(sales):
+    """下单成功后增加商品的销量排名，sales: [(category_id, sku_id, count), ...]"""
+    if not sales:
+        return
+
+    redis_conn = get_redis_connection('default')
+    pipe = redis_conn.pipeline()
+    for category_id, sku_id, count in sales:
+        zincrby(pipe, list_key(category_id, 'sales'), count, sku_id)
+    pipe.execute()
+
+
+def top(category_id, sort_key, count):
+    """分类中分数最高的count个商品，按分数从高到低排列"""
+    redis_conn = get_redis_connection('default')
+    ensure_built(category_id, redis_conn)
+
+    sku_ids = redis_conn.zrevrange(list_key(category_id, sort_key), 0, count - 1)
+    return list(snapshots.get_many(sku_ids).values())
+
+
+def new_skus(category_id, count=2):
+    """新品推荐：分类中最新上架的商品"""
+    return top(category_id, 'create_time', count)
+
+
+def rebuild(category_id, redis_conn=None):
+    """从数据库重建一个分类的全部排序索引"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    skus = GoodsSKU.objects.filter(category_id=category_id).only('id', 'category', 'price', 'sales', 'create_time')
+
+    # 在一个事务中删除旧索引、写入新索引，避免读到一半的数据
+    pipe = redis_conn.pipeline()
+    for sort_key in SORT_KEYS:
+        pipe.delete(list_key(category_id, sort_key))
+
+    for sku in skus:
+        for sort_key, score in sku_scores(sku).items():
+            zadd(pipe, list_key(category_id, sort_key), score, sku.id)
+        pipe.hset(CATEGORY_KEY, sku.id, category_id)
+
+    pipe.sadd(BUILT_KEY, category_id)
+    pipe.execute()
+
+
+def ensure_built(category_id, redis_conn=None):
+    """分类的索引还没有建立时（redis数据丢失、第一次访问），从数据库建立"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    if not redis_conn.sismember(BUILT_KEY, category_id):
+        rebuild(category_id, redis_conn)
+
+
+def is_built(category_id, redis_conn=None):
+    """分类的索引是否已经建立，只有存在的分类才会建立索引"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    return bool(redis_conn.sismember(BUILT_KEY, category_id))
+
+
+def update_sku(sku):
+    """商品新增或修改后，更新它所在分类的排序索引"""
+    redis_conn = get_redis_connection('default')
+
+    # 商品换了分类，先从原来分类的索引中删除
+    old_category_id = redis_conn.hget(CATEGORY_KEY, sku.id)
+
+    pipe = redis_conn.pipeline()
+    if old_category_id is not None and int(old_category_id) != sku.category_id:
+        for sort_key in SORT_KEYS:
+            pipe.zrem(list_key(int(old_category_id), sort_key), sku.id)
+
+    for sort_key, score in sku_scores(sku).items():
+        zadd(pipe, list_key(sku.category_id, sort_key), score, sku.id)
+    pipe.hset(CATEGORY_KEY, sku.id, sku.category_id)
+    pipe.execute()
+
+
+def remove_sku(sku):
+    """商品删除后，从排序索引中删除"""
+    redis_conn = get_redis_connection('default')
+
+    pipe = redis_conn.pipeline()
+    for sort_key in SORT_KEYS:
+        pipe.zrem(list_key(sku.category_id, sort_key), sku.id)
+    pipe.hdel(CATEGORY_KEY, sku.id)
+    pipe.execute()
+
+
+class SortedSKUList(object):
+    """按照redis排序索引读取的商品列表，可以直接交给Paginator分页，切片时只读取一页的商品"""
+
+    def __init__(self, category_id, sort):
+        self.redis_conn = get_redis_connection('default')
+        ensure_built(category_id, self.redis_conn)
+
+        sort_key, self.reverse = SORTS[sort]
+        self.key = list_key(category_id, sort_key)
+
+    def count(self):
+        """商品总数，Paginator计算页数时使用"""
+        return self.redis_conn.zcard(self.key)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        """Paginator读取一页数据时使用，object_list[bottom:top]"""
+        if isinstance(index, slice):
+            start = index.start or 0
+            stop = index.stop if index.stop is not None else self.count()
+            if stop <= start:
+                return []
+            return self.skus(self.ids(start, stop - 1))
+
+        skus = self.skus(self.ids(index, index))
+        if not skus:
+            raise IndexError(index)
+        return skus[0]
+
+    def ids(self, start, end):
+        """按排名读取sku_id，end包含在内，-1表示最后一个"""
+        if self.reverse:
+            return self.redis_conn.zrevrange(self.key, start, end)
+        return self.redis_conn.zrange(self.key, start, end)
+
+    def rank(self, sku_id):
+        """商品的排名，从0开始，不在索引中时返回None"""
+        if self.reverse:
+            return self.redis_conn.zrevrank(self.key, sku_id)
+        return self.redis_conn.zrank(self.key, sku_id)
+
+    def skus(self, sku_ids):
+        """读取商品快照，已经删除的商品直接跳过"""
+        return list(snapshots.get_many(sku_ids).values())
+
+    def after(self, cursor, size=PAGE_SIZE):
+        """读取排在cursor（sku_id）之后的size个商品，cursor为空时从头读取
+
+        返回 (商品列表, 下一页的cursor)，已经是最后一页时cursor为None
+        cursor不在索引中（不是这个分类的商品、商品已经删除）时抛出ValueError，不会重新从第一页开始
+        """
+        start = 0
+        if cursor:
+            rank = self.rank(cursor)
+            if rank is None:
+                raise ValueError('cursor %s 不在索引中' % cursor)
+            start = rank + 1
+
+        sku_ids = self.ids(start, start + size - 1)
+        next_cursor = int(sku_ids[-1]) if len(sku_ids) == size else None
+        return self.skus(sku_ids), next_cursor
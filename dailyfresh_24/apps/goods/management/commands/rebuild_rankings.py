@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+
+from goods.models import GoodsCategory, GoodsSKU
+from goods import listing
+
+
+class Command(BaseCommand):
+    """从MySQL重建redis中的分类排行（价格、销量、上架时间），或者只校验redis中的数据是否正确
+
+    python manage.py rebuild_rankings              重建所有分类
+    python manage.py rebuild_rankings -c 1 -c 2    重建指定分类
+    python manage.py rebuild_rankings --check      只校验，不修改数据
+    """
+    help = '从MySQL重建或者校验redis中的分类排行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--category', action='append', type=int, dest='categories',
+                            help='分类id，可以指定多个，默认所有分类')
+        parser.add_argument('--check', action='store_true', dest='check', default=False,
+                            help='只校验redis和MySQL是否一致，不修改数据')
+
+    def handle(self, *args, **options):
+        category_ids = options['categories']
+        if not category_ids:
+            category_ids = list(GoodsCategory.objects.values_list('id', flat=True))
+
+        redis_conn = get_redis_connection('default')
+
+        if not options['check']:
+            for category_id in category_ids:
+                listing.rebuild(category_id, redis_conn)
+                self.stdout.write('分类%s：重建完成' % category_id)
+            return
+
+        errors = 0
+        for category_id in category_ids:
+            errors += self.check_category(redis_conn, category_id)
+
+        if errors:
+            raise CommandError('共有%s个排行和MySQL不一致，可以去掉--check重建' % errors)
+        self.stdout.write('所有排行和MySQL一致')
+
+    def check_category(self, redis_conn, category_id):
+        """比较一个分类的排行和MySQL中的数据，返回不一致的排行数量"""
+        skus = GoodsSKU.objects.filter(category_id=category_id).only('id', 'category', 'price', 'sales', 'create_time')
+
+        expected = dict((sort_key, {}) for sort_key in listing.SORT_KEYS)
+        for sku in skus:
+            for sort_key, score in listing.sku_scores(sku).items():
+                expected[sort_key][sku.id] = score
+
+        errors = 0
+        for sort_key in listing.SORT_KEYS:
+            key = listing.list_key(category_id, sort_key)
+            actual = dict((int(member), score) for member, score in redis_conn.zrange(key, 0, -1, withscores=True))
+
+            missing = set(expected[sort_key]) - set(actual)
+            extra = set(actual) - set(expected[sort_key])
+            wrong = [sku_id for sku_id in set(actual) & set(expected[sort_key])
+                     if abs(actual[sku_id] - expected[sort_key][sku_id]) > 0.001]
+
+            if missing or extra or wrong:
+                errors += 1
+                self.stdout.write('%s：缺少%s 多余%s 分数错误%s' % (key, sorted(missing), sorted(extra), sorted(wrong)))
+
+        return errors
@@ -0,0 +1,111 @@
+"""商品评论：按(create_time, id)游标分页读取，只返回有内容的评论，下单用户和评论一次查询出来
+
+每个商品的评论数量和最新评论保存在redis中，详情页直接读取，不再查询订单商品表：
+review_count          hash，field是sku_id，value是评论数量
+review_latest_<sku>   最新评论的json字符串
+评论提交后由orders.views.CommentView刷新
+"""
+import json
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from orders.models import OrderGoods
+
+# 每一页评论的数量，也是详情页直接展示的最新评论数量
+PAGE_SIZE = 10
+
+COUNT_KEY = 'review_count'
+LATEST_KEY = 'review_latest_%s'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(create_time, order_goods_id):
+    """游标：微秒时间戳_订单商品id"""
+    delta = create_time - EPOCH
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return '%d_%d' % (microseconds, order_goods_id)
+
+
+def decode_cursor(cursor):
+    """解析游标，格式错误、时间超出范围时抛出ValueError"""
+    microseconds, order_goods_id = cursor.split('_')
+    try:
+        create_time = EPOCH + timedelta(microseconds=int(microseconds))
+    except OverflowError:
+        raise ValueError('cursor时间超出范围：%s' % microseconds)
+    return create_time, int(order_goods_id)
+
+
+def review_queryset(sku_id):
+    """商品所有有内容的评论，按照时间从新到旧排列，连同下单用户一起查询"""
+    return OrderGoods.objects.filter(sku_id=sku_id).exclude(comment='').order_by('-create_time', '-id').values(
+        'id', 'comment', 'create_time', 'order__user__username')
+
+
+def review_data(row):
+    """评论转成字典，模板和json中都可以直接使用"""
+    return {
+        'id': row['id'],
+        'comment': row['comment'],
+        'username': row['order__user__username'],
+        'ctime': timezone.localtime(row['create_time']).strftime('%Y-%m-%d %H-%M-%S'),
+    }
+
+
+def review_page(sku_id, cursor=None, size=PAGE_SIZE):
+    """读取游标之后的一页评论，返回 (评论列表, 下一页的游标)，已经是最后一页时游标为None"""
+    queryset = review_queryset(sku_id)
+    if cursor:
+        create_time, order_goods_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(create_time__lt=create_time) | Q(create_time=create_time, id__lt=order_goods_id))
+
+    # 多查一条，判断是否还有下一页
+    rows = list(queryset[:size + 1])
+
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_cursor = encode_cursor(rows[-1]['create_time'], rows[-1]['id'])
+
+    return [review_data(row) for row in rows], next_cursor
+
+
+def refresh(sku_ids, redis_conn=None):
+    """从数据库重新计算商品的评论数量和最新评论，保存到redis中"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    stats = {}
+    pipe = redis_conn.pipeline()
+    for sku_id in set(sku_ids):
+        count = review_queryset(sku_id).count()
+        latest, next_cursor = review_page(sku_id)
+        stats[sku_id] = {'count': count, 'latest': latest, 'cursor': next_cursor}
+
+        pipe.hset(COUNT_KEY, sku_id, count)
+        pipe.set(LATEST_KEY % sku_id, json.dumps({'latest': latest, 'cursor': next_cursor}))
+    pipe.execute()
+
+    return stats
+
+
+def review_stats(sku_id):
+    """商品的评论数量、最新评论、下一页的游标：{'count':..., 'latest': [...], 'cursor':...}"""
+    redis_conn = get_redis_connection('default')
+
+    pipe = redis_conn.pipeline()
+    pipe.hget(COUNT_KEY, sku_id)
+    pipe.get(LATEST_KEY % sku_id)
+    count, latest = pipe.execute()
+
+    if count is None or latest is None:
+        # redis中还没有数据
+        return refresh([sku_id], redis_conn)[sku_id]
+
+    stats = json.loads(latest.decode())
+    stats['count'] = int(count)
+    return stats
@@ -0,0 +1,83 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from goods.models import GoodsCategory, Goods, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexCategoryGoodsBanner
+from goods import snapshots, listing, last_modified, stock
+from goods.contexts import clear_detail_context
+from utils.transactions import after_commit
+
+
+def sku_html_changed(sku_id, category_id, goods_id, created=False):
+    """事务提交以后再发送任务，否则celery可能读到还没有提交的数据
+
+    任务模块在这里才导入：celery_tasks.tasks导入了很多应用的模块，信号模块在应用加载时就会导入
+    """
+    from celery_tasks.tasks import update_static_sku_html
+    update_static_sku_html.delay(sku_id, category_id, goods_id, created)
+
+
+def goods_html_changed(goods_id):
+    """事务提交以后重新生成SPU下所有SKU的静态详情页"""
+    from celery_tasks.tasks import update_static_goods_html
+    update_static_goods_html.delay(goods_id)
+
+
+def goods_changed(goods_id):
+    """同一SPU下所有SKU的详情页都发生了变化（其他规格、商品详情介绍会展示在每个SKU的详情页中）"""
+    sku_ids = list(GoodsSKU.objects.filter(goods_id=goods_id).values_list('id', flat=True))
+    clear_detail_context(sku_ids)
+    last_modified.touch_details(sku_ids)
+
+
+@receiver(post_save, sender=GoodsSKU)
+def sku_saved(sender, instance, created, **kwargs):
+    """商品SKU保存后，清除对应的快照和详情页缓存，更新列表页排序索引和库存镜像
+
+    在事务中保存时（例如admin），等到事务提交以后，避免其他请求在提交之前读到旧数据重新写入缓存
+    """
+    after_commit(snapshots.invalidate, [instance.id])
+    after_commit(stock.set_stock, {instance.id: instance.stock})
+    after_commit(listing.update_sku, instance)
+    after_commit(goods_changed, instance.goods_id)
+    after_commit(last_modified.touch, last_modified.INDEX_KEY, last_modified.LIST_KEY % instance.category_id)
+
+    # 重新生成受影响的静态页面
+    after_commit(sku_html_changed, instance.id, instance.category_id, instance.goods_id, created)
+
+
+@receiver(post_delete, sender=GoodsSKU)
+def sku_deleted(sender, instance, **kwargs):
+    """商品SKU删除后，清除对应的快照和详情页缓存，从列表页排序索引和库存镜像中删除"""
+    after_commit(snapshots.invalidate, [instance.id])
+    after_commit(stock.remove, [instance.id])
+    after_commit(listing.remove_sku, instance)
+    after_commit(clear_detail_context, [instance.id])
+    after_commit(goods_changed, instance.goods_id)
+    after_commit(last_modified.touch, last_modified.INDEX_KEY, last_modified.LIST_KEY % instance.category_id)
+
+    # 删除静态详情页，重新生成受影响的静态列表页
+    after_commit(sku_html_changed, instance.id, instance.category_id, instance.goods_id)
+
+
+@receiver(post_save, sender=Goods)
+def goods_saved(sender, instance, **kwargs):
+    """商品SPU保存后，清除它下面所有SKU的详情页缓存，重新生成静态详情页"""
+    after_commit(goods_changed, instance.id)
+    after_commit(goods_html_changed, instance.id)
+
+
+@receiver(post_save, sender=GoodsCategory)
+@receiver(post_delete, sender=GoodsCategory)
+def category_changed(sender, instance, **kwargs):
+    """商品分类展示在所有的商品页面中"""
+    after_commit(last_modified.touch, last_modified.CATEGORY_KEY)
+
+
+@receiver(post_save, sender=IndexGoodsBanner)
+@receiver(post_delete, sender=IndexGoodsBanner)
+@receiver(post_save, sender=IndexPromotionBanner)
+@receiver(post_delete, sender=IndexPromotionBanner)
+@receiver(post_save, sender=IndexCategoryGoodsBanner)
+@receiver(post_delete, sender=IndexCategoryGoodsBanner)
+def index_changed(sender, instance, **kwargs):
+    """主页展示的数据发生变化"""
+    after_commit(last_modified.touch, last_modified.INDEX_KEY)
@@ -0,0 +1,193 @@
+"""GoodsSKU的只读快照：购物车、订单确认、浏览记录等只需要读取商品基本信息的地方使用
+
+查询顺序：进程内LRU -> redis hash -> 一次in_bulk查询数据库
+GoodsSKU保存或删除时，由goods.signals清除对应的快照
+
+goods_sku_snapshot_version  每次清除快照时加一。查询数据库之前读取版本号，写回redis时版本号变了就不写：
+                            查询期间商品被修改、快照被清除时，不会把查到的旧数据写回hash（hash没有过期时间，写回就一直是旧的）
+"""
+import json
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.core.files.storage import default_storage
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from goods.models import GoodsSKU
+from utils.cache import LRUCache
+
+# redis中保存所有SKU快照的hash，field是sku_id，value是json字符串
+SNAPSHOT_KEY = 'goods_sku_snapshot'
+
+# 快照的版本号，每次清除快照时加一
+VERSION_KEY = 'goods_sku_snapshot_version'
+
+# 进程内缓存的条数和有效期（秒）
+# 其他进程修改商品时本进程收不到信号，所以有效期设置得比较短，兜底数据一致性
+LRU_SIZE = 2048
+LRU_TTL = 10
+
+_lru = LRUCache(LRU_SIZE, LRU_TTL)
+
+# 查询数据库时只读取快照需要的字段
+SNAPSHOT_FIELDS = ('id', 'category', 'goods', 'name', 'title', 'unit', 'price', 'stock', 'sales', 'default_image', 'status')
+
+
+class SKUImage(object):
+    """模拟ImageField，模板中可以继续使用 sku.default_image.url"""
+
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def url(self):
+        return default_storage.url(self.name)
+
+    def __str__(self):
+        return self.name
+
+
+class SKUSnapshot(object):
+    """GoodsSKU的快照，字段名和GoodsSKU保持一致，视图中可以给它绑定count、amount等属性"""
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.category_id = data['category_id']
+        self.goods_id = data['goods_id']
+        self.name = data['name']
+        self.title = data['title']
+        self.unit = data['unit']
+        self.price = Decimal(data['price'])
+        self.stock = data['stock']
+        self.sales = data['sales']
+        self.default_image = SKUImage(data['default_image'])
+        self.status = data['status']
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return self.name
+
+
+def _to_data(sku):
+    """把GoodsSKU对象转成可以json序列化的字典"""
+    return {
+        'id': sku.id,
+        'category_id': sku.category_id,
+        'goods_id': sku.goods_id,
+        'name': sku.name,
+        'title': sku.title,
+        'unit': sku.unit,
+        'price': str(sku.price),
+        'stock': sku.stock,
+        'sales': sku.sales,
+        'default_image': sku.default_image.name,
+        'status': sku.status,
+    }
+
+
+def _clean_ids(sku_ids):
+    """统一sku_id为int类型（redis中取出的是bytes，cookie中是str），去重并保持顺序，非法的id直接丢弃"""
+    ids = []
+    seen = set()
+    for sku_id in sku_ids:
+        try:
+            sku_id = int(sku_id)
+        except (TypeError, ValueError):
+            continue
+        if sku_id not in seen:
+            seen.add(sku_id)
+            ids.append(sku_id)
+    return ids
+
+
+def get_many(sku_ids):
+    """批量查询SKU快照，返回 {sku_id: SKUSnapshot} 的有序字典，顺序和sku_ids一致，不存在的商品不在结果中"""
+    ids = _clean_ids(sku_ids)
+
+    # 先查进程内缓存
+    found = {}
+    missing = []
+    for sku_id in ids:
+        data = _lru.get(sku_id)
+        if data is None:
+            missing.append(sku_id)
+        else:
+            found[sku_id] = data
+
+    if missing:
+        # 再查redis，一次请求读取快照和版本号
+        redis_conn = get_redis_connection('default')
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hmget(SNAPSHOT_KEY, missing)
+        pipe.get(VERSION_KEY)
+        values, version = pipe.execute()
+
+        db_ids = []
+        for sku_id, value in zip(missing, values):
+            if value is None:
+                db_ids.append(sku_id)
+                continue
+            data = json.loads(value.decode())
+            found[sku_id] = data
+            _lru.set(sku_id, data)
+
+        if db_ids:
+            # 最后查数据库，不管缺多少条都只查一次，只读取快照需要的字段
+            mapping = {}
+            for sku_id, sku in GoodsSKU.objects.only(*SNAPSHOT_FIELDS).in_bulk(db_ids).items():
+                data = _to_data(sku)
+                found[sku_id] = data
+                _lru.set(sku_id, data)
+                mapping[sku_id] = json.dumps(data)
+
+            if mapping:
+                _write_back(redis_conn, mapping, version)
+
+    # 每次都构造新的快照对象，避免视图绑定的属性在请求之间串用
+    snapshots = OrderedDict()
+    for sku_id in ids:
+        if sku_id in found:
+            snapshots[sku_id] = SKUSnapshot(found[sku_id])
+    return snapshots
+
+
+def _write_back(redis_conn, mapping, version):
+    """把数据库中查到的快照写回redis，版本号和查询之前读到的不一样时放弃写入"""
+    with redis_conn.pipeline() as pipe:
+        try:
+            # 监视版本号，读取版本号之后、写入之前有快照被清除时，写入会失败
+            pipe.watch(VERSION_KEY)
+            if pipe.get(VERSION_KEY) != version:
+                return
+            pipe.multi()
+            pipe.hmset(SNAPSHOT_KEY, mapping)
+            pipe.execute()
+        except WatchError:
+            pass
+
+
+def get(sku_id):
+    """查询单个SKU快照，不存在时返回None"""
+    for snapshot in get_many([sku_id]).values():
+        return snapshot
+    return None
+
+
+def invalidate(sku_ids):
+    """商品信息发生变化时，清除进程内缓存和redis中的快照"""
+    ids = _clean_ids(sku_ids)
+    if not ids:
+        return
+
+    for sku_id in ids:
+        _lru.delete(sku_id)
+
+    redis_conn = get_redis_connection('default')
+    pipe = redis_conn.pipeline()
+    pipe.hdel(SNAPSHOT_KEY, *ids)
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
@@ -0,0 +1,196 @@
+"""商品页面静态化：把列表页和详情页渲染成html文件保存到静态文件夹，由nginx直接提供给用户
+
+list/<category_id>/<page_num>_<sort>.html  列表页，例如 list/1/3_price.html
+detail/<sku_id>.html                      详情页
+
+渲染时记录每个页面包含了哪些商品（依赖关系），商品变化时只重新渲染受影响的页面：
+static_deps_<sku_id>  包含该商品的页面路径集合
+static_page_<path>    页面包含的sku_id集合，重新渲染时用来删除过期的依赖关系
+"""
+import os
+import re
+
+from django.conf import settings
+from django.template import loader
+from django_redis import get_redis_connection
+
+from goods.models import GoodsCategory, GoodsSKU
+from goods.contexts import build_list_context, get_detail_context, clear_detail_context
+from goods import listing
+
+LIST_PATH = 'list/%s/%s_%s.html'
+DETAIL_PATH = 'detail/%s.html'
+
+LIST_PATH_RE = re.compile(r'^list/(\d+)/(\d+)_(\w+)\.html$')
+DETAIL_PATH_RE = re.compile(r'^detail/(\d+)\.html$')
+
+
+def deps_key(sku_id):
+    return 'static_deps_%s' % sku_id
+
+
+def page_key(path):
+    return 'static_page_%s' % path
+
+
+def write_html(path, html_data):
+    """保存静态页面，先写临时文件再替换，nginx不会读到写了一半的文件"""
+    file_path = os.path.join(settings.STATICFILES_DIRS[0], path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(html_data)
+    os.replace(tmp_path, file_path)
+
+
+def remove_html(path):
+    """删除已经不存在的页面"""
+    file_path = os.path.join(settings.STATICFILES_DIRS[0], path)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+def record_deps(path, sku_ids):
+    """记录页面包含的商品，替换掉上一次渲染时记录的依赖关系"""
+    redis_conn = get_redis_connection('default')
+
+    sku_ids = set(int(sku_id) for sku_id in sku_ids)
+    old_ids = set(int(sku_id) for sku_id in redis_conn.smembers(page_key(path)))
+
+    pipe = redis_conn.pipeline()
+    for sku_id in old_ids - sku_ids:
+        pipe.srem(deps_key(sku_id), path)
+    for sku_id in sku_ids - old_ids:
+        pipe.sadd(deps_key(sku_id), path)
+
+    pipe.delete(page_key(path))
+    if sku_ids:
+        pipe.sadd(page_key(path), *sku_ids)
+    pipe.execute()
+
+
+def render_list_page(category_id, page_num, sort):
+    """渲染一个列表页，页码已经超出范围时删除该页面"""
+    path = LIST_PATH % (category_id, page_num, sort)
+
+    try:
+        category = GoodsCategory.objects.get(id=category_id)
+    except GoodsCategory.DoesNotExist:
+        remove_html(path)
+        record_deps(path, [])
+        return
+
+    context = build_list_context(category, sort, page_num)
+    page_skus = context['page_skus']
+    if page_skus.number != page_num:
+        # 商品减少以后，最后几页已经不存在了
+        remove_html(path)
+        record_deps(path, [])
+        return
+
+    context.update(async_cart=True)
+    html_data = loader.get_template('list.html').render(context)
+    write_html(path, html_data)
+
+    sku_ids = [sku.id for sku in page_skus] + [sku.id for sku in context['new_skus']]
+    record_deps(path, sku_ids)
+
+
+def render_detail_page(sku_id):
+    """渲染一个详情页，商品已经删除时删除该页面"""
+    path = DETAIL_PATH % sku_id
+
+    # 静态化时重新查询数据，顺便刷新详情页缓存
+    clear_detail_context([sku_id])
+    context = get_detail_context(sku_id)
+    if context is None:
+        remove_html(path)
+        record_deps(path, [])
+        return
+
+    context.update(async_cart=True)
+    html_data = loader.get_template('detail.html').render(context)
+    write_html(path, html_data)
+
+    sku_ids = [sku_id]
+    sku_ids += [other_sku['id'] for other_sku in context['other_skus']]
+    sku_ids += [new_sku['id'] for new_sku in context['new_skus']]
+    record_deps(path, sku_ids)
+
+
+def category_list_pages(category_id):
+    """一个分类所有排序规则的所有列表页：[(category_id, page_num, sort), ...]"""
+    pages = []
+    for sort in listing.SORTS:
+        count = listing.SortedSKUList(category_id, sort).count()
+        num_pages = max(1, (count + listing.PAGE_SIZE - 1) // listing.PAGE_SIZE)
+        for page_num in range(1, num_pages + 1):
+            pages.append((category_id, page_num, sort))
+    return pages
+
+
+def all_pages():
+    """所有的列表页和详情页，全量静态化时使用"""
+    list_pages = []
+    for category_id in GoodsCategory.objects.values_list('id', flat=True):
+        list_pages += category_list_pages(category_id)
+
+    detail_ids = list(GoodsSKU.objects.values_list('id', flat=True))
+    return list_pages, detail_ids
+
+
+def pages_for_sku(sku_id, category_id, goods_id, created=False):
+    """商品新增、修改、删除以后需要重新渲染的页面：(列表页集合, 详情页sku_id集合)
+
+    category_id、goods_id是商品当前（删除前）的分类和SPU，列表页的排序索引需要已经更新
+    """
+    list_pages = set()
+    detail_ids = {sku_id}
+
+    # 同一SPU下的其他规格，详情页中展示了该商品
+    detail_ids.update(GoodsSKU.objects.filter(goods_id=goods_id).values_list('id', flat=True))
+
+    if created:
+        # 新增的商品是最新的商品，会出现在分类所有页面的新品推荐中
+        list_pages.update(category_list_pages(category_id))
+        detail_ids.update(GoodsSKU.objects.filter(category_id=category_id).values_list('id', flat=True))
+        return list_pages, detail_ids
+
+    # 上一次渲染时包含该商品的页面
+    redis_conn = get_redis_connection('default')
+    old_pages = {}
+    for path in redis_conn.smembers(deps_key(sku_id)):
+        path = path.decode()
+        match = LIST_PATH_RE.match(path)
+        if match:
+            key = (int(match.group(1)), match.group(3))
+            old_pages.setdefault(key, []).append(int(match.group(2)))
+            continue
+
+        match = DETAIL_PATH_RE.match(path)
+        if match:
+            detail_ids.add(int(match.group(1)))
+
+    # 商品的排名变化以后，原来的位置和新位置之间的商品都会移动一个位置，这些页面都需要重新渲染
+    category_ids = {category_id} | set(key[0] for key in old_pages)
+    for list_category_id in category_ids:
+        for sort in listing.SORTS:
+            skus = listing.SortedSKUList(list_category_id, sort)
+            pages = list(old_pages.get((list_category_id, sort), []))
+
+            rank = skus.rank(sku_id)
+            if rank is None:
+                # 商品已经不在这个分类中，后面的商品都会前移，最后一页可能已经不存在
+                if not pages:
+                    continue
+                count = skus.count()
+                last_page = (count + listing.PAGE_SIZE - 1) // listing.PAGE_SIZE + 1
+            else:
+                pages.append(rank // listing.PAGE_SIZE + 1)
+                last_page = max(pages)
+
+            for page_num in range(min(pages), last_page + 1):
+                list_pages.add((list_category_id, page_num, sort))
+
+    return list_pages, detail_ids
@@ -0,0 +1,113 @@
+"""GoodsSKU库存在redis中的镜像：购物车校验库存时在修改购物车的同一个脚本中读取，不再查询MySQL
+
+sku_stock  hash，field是sku_id，value是库存
+后台修改、删除商品时由goods.signals同步，下单时由orders.checkout.order_created同步
+定时任务celery_tasks.tasks.reconcile_stock和MySQL对账，修正遗漏或者并发造成的偏差
+镜像中没有的商品，购物车脚本使用快照中的库存
+"""
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from utils.redis_scripts import get_script
+
+STOCK_KEY = 'sku_stock'
+
+# 减少库存 KEYS: 库存镜像  ARGV: 每2个一组，sku_id, 数量
+# 镜像中没有的商品不处理，等待读取或者对账时从MySQL加载，避免写入负数
+DECR_LUA = """
+for i = 1, #ARGV, 2 do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+    end
+end
+"""
+
+
+def set_stock(stocks, redis_conn=None):
+    """写入库存，stocks是 {sku_id: 库存}"""
+    if not stocks:
+        return
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+    redis_conn.hmset(STOCK_KEY, stocks)
+
+
+def remove(sku_ids, redis_conn=None):
+    """商品删除后，从镜像中删除"""
+    if not sku_ids:
+        return
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+    redis_conn.hdel(STOCK_KEY, *sku_ids)
+
+
+def decr(lines, redis_conn=None):
+    """下单后减少库存，lines是 [(sku_id, 数量), ...]
+
+    使用相对的减少而不是写入下单时看到的库存，并发下单时写入的顺序不影响结果
+    """
+    if not lines:
+        return
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    args = []
+    for sku_id, count in lines:
+        args.extend([sku_id, count])
+    get_script(redis_conn, DECR_LUA)(keys=[STOCK_KEY], args=args, client=redis_conn)
+
+
+def get_many(sku_ids, redis_conn=None):
+    """一次HMGET读取多个商品的库存，返回 {sku_id: 库存}，镜像中没有的从MySQL加载，不存在的商品不返回"""
+    ids = sorted(set(int(sku_id) for sku_id in sku_ids))
+    if not ids:
+        return {}
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    result = {}
+    misses = []
+    for sku_id, value in zip(ids, redis_conn.hmget(STOCK_KEY, ids)):
+        if value is None:
+            misses.append(sku_id)
+        else:
+            result[sku_id] = int(value)
+
+    if misses:
+        loaded = dict(GoodsSKU.objects.filter(id__in=misses).values_list('id', 'stock'))
+        set_stock(loaded, redis_conn)
+        result.update(loaded)
+
+    return result
+
+
+def reconcile(redis_conn=None, batch_size=1000):
+    """和MySQL对账：修正不一致的库存，删除已经不存在的商品，返回 (修正的数量, 删除的数量)
+
+    对账时正在下单的商品可能被写回下单前的库存，偏差会在下一次对账时修正
+    """
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    fixed = 0
+    existing = set()
+    last_id = 0
+    while True:
+        rows = list(GoodsSKU.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'stock')[:batch_size])
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        ids = [sku_id for sku_id, stock in rows]
+        existing.update(ids)
+        wrong = {}
+        for (sku_id, stock), value in zip(rows, redis_conn.hmget(STOCK_KEY, ids)):
+            if value is None or int(value) != stock:
+                wrong[sku_id] = stock
+        set_stock(wrong, redis_conn)
+        fixed += len(wrong)
+
+    removed = [sku_id for sku_id in redis_conn.hkeys(STOCK_KEY) if int(sku_id) not in existing]
+    remove(removed, redis_conn)
+
+    return fixed, len(removed)
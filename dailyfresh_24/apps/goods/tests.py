@@ -1,3 +1,150 @@
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from goods.models import GoodsSKU, IndexCategoryGoodsBanner
+from goods import listing, snapshots
+from orders.models import OrderInfo, OrderGoods
+from users.models import User, Address
+from utils.testing import RedisTestMixin, create_skus
 
 # Create your tests here.
+
+# 每个分类的商品数量：数据太少时MySQL会认为全表扫描更快，执行计划没有参考价值
+SKUS_PER_CATEGORY = 100
+USERS = 10
+ORDERS_PER_USER = 20
+PASSWORD = 'query_plan'
+
+
+@skipUnless(connection.vendor == 'mysql', '执行计划只在MySQL上检查')
+class QueryPlanTest(RedisTestMixin, TestCase):
+    """请求页面，对页面真正执行的带条件的查询执行EXPLAIN，出现全表扫描(type=ALL)或者文件排序(Using filesort)时失败
+
+    不带条件的查询（分类、轮播、活动、分类展示商品）本来就读取整张表，这些是后台维护的小表，结果有缓存，不检查
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # 多个用户、SPU、商品的数据，每个查询条件只命中一小部分行
+        users = [User.objects.create_user('query_plan_%s' % i, password=PASSWORD) for i in range(USERS)]
+        addresses = [Address.objects.create(user=user, receive_name='测试', receive_mobile='13800000000',
+                                            detail_addr='测试地址', zip_code='100000') for user in users]
+
+        skus = create_skus(SKUS_PER_CATEGORY, categorys=4, goods=SKUS_PER_CATEGORY,
+                           price=lambda i: Decimal(i % 50 + 1), sales=lambda i: i)
+        categorys = [skus[i * SKUS_PER_CATEGORY].category for i in range(4)]
+
+        IndexCategoryGoodsBanner.objects.bulk_create([
+            IndexCategoryGoodsBanner(category=category, sku=skus[0], display_type=display_type, index=index)
+            for category in categorys for display_type in (0, 1) for index in range(4)
+        ])
+
+        orders = [OrderInfo(order_id='query_plan_%s_%s' % (user.id, i), user=user, address=address,
+                            total_amount=Decimal('20.00'), trans_cost=Decimal('10.00'))
+                  for user, address in zip(users, addresses) for i in range(ORDERS_PER_USER)]
+        OrderInfo.objects.bulk_create(orders)
+        OrderGoods.objects.bulk_create([
+            OrderGoods(order=order, sku=skus[i % len(skus)], count=1, price=Decimal('10.00'), comment='评论')
+            for i, order in enumerate(orders)
+        ])
+
+        cls.user = users[0]
+        cls.category = categorys[0]
+        cls.sku = skus[0]
+
+        # 更新统计信息，优化器按照真实的行数选择索引
+        with connection.cursor() as cursor:
+            for model in (GoodsSKU, IndexCategoryGoodsBanner, OrderInfo, OrderGoods, Address):
+                cursor.execute('ANALYZE TABLE %s' % model._meta.db_table)
+
+    def explain(self, sql):
+        """执行EXPLAIN，返回发现的问题列表"""
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql)
+            columns = [column[0].lower() for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        problems = []
+        for row in rows:
+            extra = row.get('extra') or ''
+            if row.get('type') == 'ALL':
+                problems.append('%s 全表扫描' % row.get('table'))
+            if 'Using filesort' in extra:
+                problems.append('%s 文件排序' % row.get('table'))
+        return problems
+
+    def assertUsesIndexes(self, url):
+        """请求页面，记录执行的查询，检查每一个带条件的查询，返回检查的查询数量"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+
+        checked = 0
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or ' WHERE ' not in sql:
+                continue
+            problems = self.explain(sql)
+            self.assertEqual(problems, [], '%s：%s\n%s' % (url, '；'.join(problems), sql))
+            checked += 1
+        return checked
+
+    def test_index_queries(self):
+        """主页：全部是读取整张表的查询"""
+        self.assertEqual(self.assertUsesIndexes(reverse('goods:index')), 0)
+
+    def test_list_queries(self):
+        """列表页：建立排序索引、最后修改时间；排序分页和新品推荐读取redis"""
+        for sort in listing.SORTS:
+            self.assertUsesIndexes(reverse('goods:list', args=(self.category.id, 1)) + '?sort=' + sort)
+            self.assertUsesIndexes(reverse('goods:more', args=(self.category.id,)) + '?sort=' + sort)
+
+    def test_detail_queries(self):
+        """详情页：商品、其他规格、评论、最后修改时间"""
+        self.assertGreater(self.assertUsesIndexes(reverse('goods:detail', args=(self.sku.id,))), 0)
+        self.assertUsesIndexes(reverse('goods:reviews', args=(self.sku.id,)))
+
+    def test_user_queries(self):
+        """用户订单页、用户中心、收货地址"""
+        self.assertTrue(self.client.login(username=self.user.username, password=PASSWORD))
+        self.assertGreater(self.assertUsesIndexes(reverse('orders:info', kwargs={'page': 1})), 0)
+        self.assertGreater(self.assertUsesIndexes(reverse('users:info')), 0)
+        self.assertGreater(self.assertUsesIndexes(reverse('users:address')), 0)
+
+
+class SnapshotTest(RedisTestMixin, TestCase):
+    """商品快照写回redis：查询数据库期间快照被清除时，不能把查到的旧数据写回去"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sku = create_skus(1)[0]
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        # 清除进程内缓存中其他测试留下的快照
+        snapshots.invalidate([self.sku.id])
+
+    def cached(self):
+        return self.redis_conn.hget(snapshots.SNAPSHOT_KEY, self.sku.id)
+
+    def test_write_back(self):
+        """数据库中查到的快照写回redis"""
+        self.assertEqual(snapshots.get(self.sku.id).name, self.sku.name)
+        self.assertIsNotNone(self.cached())
+
+    def test_invalidated_during_read(self):
+        """查询数据库之后、写回之前快照被清除，放弃写回"""
+        to_data = snapshots._to_data
+
+        def invalidate_and_convert(sku):
+            snapshots.invalidate([sku.id])
+            return to_data(sku)
+
+        with mock.patch.object(snapshots, '_to_data', side_effect=invalidate_and_convert):
+            self.assertIsNotNone(snapshots.get(self.sku.id))
+        self.assertIsNone(self.cached())
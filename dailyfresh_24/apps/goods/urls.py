@@ -1,14 +1,23 @@
 from django.conf.urls import url
 from goods import views
+from goods import last_modified, listing
+from utils.views import conditional_page
 
 
+# 主页、列表页、详情页对所有用户都是相同的内容，可以整页缓存，并且支持条件请求
 urlpatterns = [
     # 主页 http://127.0.0.1:8000/index
-    url(r'^index$', views.IndexView.as_view(), name='index'),
+    url(r'^index$', conditional_page(last_modified.index_last_modified)(views.IndexView.as_view()), name='index'),
 
     # 商品详情页面
-    url(r'^detail/(?P<sku_id>\d+)$', views.DetailView.as_view(), name='detail'),
+    url(r'^detail/(?P<sku_id>\d+)$', conditional_page(last_modified.detail_last_modified)(views.DetailView.as_view()), name='detail'),
+
+    # 商品评论 http://127.0.0.1:8000/detail/sku_id/reviews?cursor=cursor
+    url(r'^detail/(?P<sku_id>\d+)/reviews$', views.ReviewsView.as_view(), name='reviews'),
 
     # 列表页 http://127.0.0.1:8000/list/category_id/page_num?sort='default'
-    url(r'^list/(?P<category_id>\d+)/(?P<page_num>\d+)$', views.ListView.as_view(), name='list')
+    url(r'^list/(?P<category_id>\d+)/(?P<page_num>\d+)$', conditional_page(last_modified.list_last_modified, cache_params={'sort': listing.SORTS})(views.ListView.as_view()), name='list'),
+
+    # 列表页下一页 http://127.0.0.1:8000/list/category_id/more?sort=default&cursor=sku_id
+    url(r'^list/(?P<category_id>\d+)/more$', views.ListMoreView.as_view(), name='more')
 ]
\ No newline at end of file
@@ -1,10 +1,14 @@
 from django.shortcuts import render, redirect
 from django.views.generic import View
 from goods.models import GoodsCategory, Goods, GoodsSKU, IndexPromotionBanner, IndexGoodsBanner, IndexCategoryGoodsBanner
+from goods.contexts import build_index_context, build_list_context, get_detail_context, INDEX_CACHE_KEY, INDEX_CACHE_TIMEOUT
+from goods import listing, reviews
+from cart import operations
+from cart.owners import get_owner
 from django.core.cache import cache
 from django_redis import get_redis_connection
 from django.core.urlresolvers import reverse
-from django.core.paginator import Paginator, EmptyPage
+from django.http import JsonResponse
 import json
 
 # Create your views here.
@@ -14,37 +18,17 @@ class BaseCartView(View):
 
     def get_cart_num(self, request):
 
-        cart_num = 0
+        # 登陆和未登录用户的购物车都保存在redis中，未登录用户还没有购物车时数量是0
+        owner = get_owner(request)
+        if owner is None:
+            return 0
 
-        # 如果是登陆用户，读取购物车数据
-        if request.user.is_authenticated():
-            # 创建链接到redis的对象
-            redis_conn = get_redis_connection('default')
+        # 购物车总数量在修改购物车时维护，这里只需要一次GET
+        redis_conn = get_redis_connection('default')
+        return operations.get_total(redis_conn, owner)
 
-            # 调用hgetall()方法，读取所有的购物车数据
-            user_id = request.user.id
-            cart_dict = redis_conn.hgetall('cart_%s' % user_id)
 
-            # 遍历数量，累加求和
-            for val in cart_dict.values():
-                cart_num += int(val)
-
-        else:
-            # cookie中存储的是json字符串
-            cart_json = request.COOKIES.get('cart')
-            if cart_json is not None:
-                cart_dict = json.loads(cart_json)
-            else:
-                cart_dict = {}
-
-            # 遍历cart_dict,取出count，求和
-            for val in cart_dict.values():
-                cart_num += int(val)  # val 是int类型
-
-        return cart_num
-
-
-class ListView(BaseCartView):
+class ListView(View):
     """列表页"""
     def get(self, request, category_id, page_num):
         """查询数据，渲染模板，实现分页和排序"""
@@ -59,171 +43,111 @@ class ListView(BaseCartView):
         except GoodsCategory.DoesNotExist:
             return redirect(reverse('goods:index'))
 
-        # 查询所有的商品分类
-        categorys = GoodsCategory.objects.all()
+        # 查询分类、新品推荐和排序分页后的商品
+        context = build_list_context(category, sort, int(page_num))
 
-        # 查询新品推荐
-        new_skus = GoodsSKU.objects.filter(category=category).order_by('-create_time')[:2]
+        # 页码超出范围时跳转到第一页，不在整页缓存中为每一个无效的页码保存一份第一页
+        if context['page_skus'].number != int(page_num):
+            return redirect(reverse('goods:list', args=(category.id, 1)) + '?sort=' + context['sort'])
 
-        # 查询category_id 对应 的sku信息, 并且排序
-        if sort == 'price':
-            skus = GoodsSKU.objects.filter(category=category).order_by('price')
-        elif sort == 'hot':
-            skus = GoodsSKU.objects.filter(category=category).order_by('-sales')
-        else:
-            skus = GoodsSKU.objects.filter(category=category)
-            sort = 'default'
-
-        # 查询购物车信息
-        cart_num = self.get_cart_num(request)
-
-        # 如果是登陆用户，读取购物车数据
-        if request.user.is_authenticated():
-            # 创建链接到redis的对象
-            redis_conn = get_redis_connection('default')
-
-            # 调用hgetall()方法，读取所有的购物车数据
-            user_id = request.user.id
-
-        # 查询分页数据
-        # paginator = [GoodsSKU,GoodsSKU,GoodsSKU,GoodsSKU,GoodsSKU,...]
-        paginator = Paginator(skus, 2)
-        # 获取用户要看的那一页
-        page_num = int(page_num)
-        try:
-            page_skus = paginator.page(page_num)
-        except EmptyPage:
-            page_skus = paginator.page(1)
-
-        # 获取页码列表
-        page_list = paginator.page_range
-
-        # 构造上下文
-        context = {
-            'category':category,
-            'categorys':categorys,
-            'new_skus':new_skus,
-            'page_skus':page_skus,
-            'page_list':page_list,
-            'sort':sort,
-            'cart_num':cart_num
-        }
+        # 购物车数量异步加载，页面内容和用户无关
+        context.update(async_cart=True)
 
         # 渲染模板
         return render(request, 'list.html', context)
 
 
-class DetailView(BaseCartView):
-    """详情页面"""
-    def get(self, request, sku_id):
-        """查询详情页面数据，渲染模板"""
-
-        # 查询商品SKU信息
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
-            return redirect(reverse('goods:index'))
-
-        # 查询商品分类信息:6大分类
-        categorys = GoodsCategory.objects.all()
-
-        # 查询商品详情介绍信息
-        # 查询商品评价信息，从订单中获取评论信息
-        sku_orders = sku.ordergoods_set.all().order_by('-create_time')[:30]
-        if sku_orders:
-            for sku_order in sku_orders:
-                sku_order.ctime = sku_order.create_time.strftime('%Y-%m-%d %H-%M-%S')
-                sku_order.username = sku_order.order.user.username
-        else:
-            sku_orders = []
+class ListMoreView(View):
+    """列表页加载下一页，提供给无限滚动使用"""
+    def get(self, request, category_id):
+        """根据cursor（上一页最后一个sku_id）读取下一页商品"""
 
-        # 查询最新推荐商品信息: 从数据库中获取最新发布的两件商品
-        new_skus = GoodsSKU.objects.filter(category=sku.category).order_by('-create_time')[:2]
-
-        # 查询其他规格商品信息
-        other_skus = sku.goods.goodssku_set.exclude(id=sku.id)
+        # 获取排序规则和cursor
+        sort = request.GET.get('sort', 'default')
+        if sort not in listing.SORTS:
+            sort = 'default'
 
-        # 查询购物车信息
-        cart_num = self.get_cart_num(request)
+        cursor = request.GET.get('cursor')
+        if cursor:
+            try:
+                cursor = int(cursor)
+            except ValueError:
+                return JsonResponse({'code': 1, 'message': 'cursor错误'})
 
-        # 如果是登陆用户，读取购物车数据
-        if request.user.is_authenticated():
-            # 创建链接到redis的对象
-            redis_conn = get_redis_connection('default')
+        # 分类不存在时不建立索引：已经建立过索引的分类不用查询数据库
+        if not listing.is_built(category_id) and not GoodsCategory.objects.filter(id=category_id).exists():
+            return JsonResponse({'code': 2, 'message': '分类不存在'}, status=404)
 
-            # 调用hgetall()方法，读取所有的购物车数据
-            user_id = request.user.id
+        # 读取下一页数据
+        skus = listing.SortedSKUList(category_id, sort)
+        try:
+            page_skus, next_cursor = skus.after(cursor)
+        except ValueError:
+            # 上一页的最后一个商品已经不在这个分类中，前端重新加载列表页
+            return JsonResponse({'code': 3, 'message': 'cursor已失效'})
+
+        sku_list = []
+        for sku in page_skus:
+            sku_list.append({
+                'id': sku.id,
+                'name': sku.name,
+                'price': str(sku.price),
+                'unit': sku.unit,
+                'image': sku.default_image.url,
+                'url': reverse('goods:detail', args=(sku.id,))
+            })
+
+        return JsonResponse({'code': 0, 'message': 'OK', 'skus': sku_list, 'cursor': next_cursor})
+
+
+class ReviewsView(View):
+    """商品评论分页，详情页加载更多评论时使用"""
+    def get(self, request, sku_id):
+        """根据cursor读取下一页评论"""
+        cursor = request.GET.get('cursor')
+        try:
+            review_list, next_cursor = reviews.review_page(sku_id, cursor)
+        except ValueError:
+            return JsonResponse({'code': 1, 'message': 'cursor错误'})
 
-            # 删除重复的sku_id
-            redis_conn.lrem('history_%s' % user_id, 0, sku_id)
+        return JsonResponse({'code': 0, 'message': 'OK', 'reviews': review_list, 'cursor': next_cursor})
 
-            # 记录浏览信息
-            redis_conn.lpush('history_%s' % user_id, sku_id)
 
-            # 最多保存5条记录
-            redis_conn.ltrim('history_%s' % user_id, 0, 4)
+class DetailView(View):
+    """详情页面"""
+    def get(self, request, sku_id):
+        """查询详情页面数据，渲染模板"""
 
-        # 构造上下文
-        context = {
-            'sku':sku,
-            'categorys':categorys,
-            'sku_orders':sku_orders,
-            'new_skus':new_skus,
-            'other_skus':other_skus,
-            'cart_num':cart_num
-        }
+        # 查询商品SKU、分类、评论、新品推荐、其他规格信息，和用户无关，读取缓存
+        context = get_detail_context(sku_id)
+        if context is None:
+            return redirect(reverse('goods:index'))
 
-        # 更新context
-        # context.update(cart_num=cart_num)
+        # 购物车数量和浏览记录由cart:count异步处理，页面内容和用户无关
+        context.update(async_cart=True)
 
         # 渲染模板
         return render(request, 'detail.html', context)
 
 
-class IndexView(BaseCartView):
+class IndexView(View):
     """主页"""
     def get(self, request):
         """查询主页商品数据，渲染模板"""
 
         # 读取缓存的数据
-        context = cache.get('index_page_data')
+        context = cache.get(INDEX_CACHE_KEY)
         if context is None:
             print('没有缓存，查询数据')
 
-            # 查询用户user信息
-            # 查询商品分类信息
-            categorys = GoodsCategory.objects.all()
-
-            # 查询图片轮播信息 需求：根据index从小到大排序
-            goods_banners = IndexGoodsBanner.objects.all().order_by('index')
-
-            # 查询商品活动信息
-            promotionbanners = IndexPromotionBanner.objects.all().order_by('index')
-
-            # 查询主页分类列表信息
-            for category in categorys:
-
-                title_banners = IndexCategoryGoodsBanner.objects.filter(category=category, display_type=0)
-                category.title_banners = title_banners
-
-                image_banners = IndexCategoryGoodsBanner.objects.filter(category=category, display_type=1)
-                category.image_banners = image_banners
-
-            # 构造上下文
-            context = {
-                'categorys':categorys,
-                'goods_banners':goods_banners,
-                'promotionbanners':promotionbanners,
-            }
+            # 一次性构造主页数据，查询次数固定，和分类、商品的数量无关
+            context = build_index_context()
 
             # 缓存上下文，缓存的key  要缓存的数据  过期的时间：秒数
-            cache.set('index_page_data', context, 3600)
-
-        # 查询购物车信息
-        cart_num = self.get_cart_num(request)
+            cache.set(INDEX_CACHE_KEY, context, INDEX_CACHE_TIMEOUT)
 
-        # 更新context
-        context.update(cart_num=cart_num)
+        # 购物车数量异步加载，页面内容和用户无关
+        context.update(async_cart=True)
 
         # 渲染模板
         return render(request, 'index.html', context)
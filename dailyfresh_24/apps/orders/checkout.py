@@ -0,0 +1,222 @@
+"""下单：创建订单、扣减库存，以及可选的异步下单队列
+
+同步下单（默认）：CommitOrderView在请求中调用create_order
+异步下单（settings.ASYNC_CHECKOUT = True）：CommitOrderView只做简单的校验，订单按照商品分片放入redis队列，
+立即返回排队号(ticket)，由celery任务process_checkout_shard按分片批量创建订单，前端轮询/orders/commit/status
+
+checkout_queue_<shard>             list，等待创建的订单（json）
+checkout_processing_<shard>        list，正在创建的订单，任务中断时下一次重新处理
+checkout_lock_<shard>              每个分片同时只有一个任务在处理
+checkout_scheduled_<shard>         已经安排了处理任务，避免每个订单都发送一个任务
+checkout_ticket_<ticket>           排队号对应的状态（json）：queued排队中、success成功、failed失败
+订单按照其中id最小的商品分片：只有一个商品的订单、最小商品相同的订单在同一个分片中按顺序处理；
+包含热门商品的订单仍然可能分布在多个分片中，同一个商品最多有NUM_SHARDS个任务同时等待行锁，
+而不是每个web线程一个；所有任务都按照id顺序锁定商品行，不会死锁
+"""
+import json
+import uuid
+
+from django.db import transaction
+from django.db.models import F
+from django_redis import get_redis_connection
+
+from cart import operations
+from goods import last_modified, listing, snapshots, stock
+from goods.models import GoodsSKU
+from orders import order_counts, queues
+from orders.models import OrderInfo, OrderGoods
+
+# 分片数量
+NUM_SHARDS = 8
+
+QUEUE_KEY = 'checkout_queue_%s'
+PROCESSING_KEY = 'checkout_processing_%s'
+LOCK_KEY = 'checkout_lock_%s'
+SCHEDULED_KEY = 'checkout_scheduled_%s'
+TICKET_KEY = 'checkout_ticket_%s'
+
+# 排队号状态保存的时间（秒）
+TICKET_TTL = 24 * 3600
+
+# 每一批创建的订单数量
+BATCH_SIZE = 100
+
+# 运费
+TRANS_COST = 10
+
+
+class CheckoutError(Exception):
+    """下单失败，code和message直接返回给前端"""
+
+    def __init__(self, code, message):
+        super(CheckoutError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def create_order(order_id, user_id, address_id, pay_method, sku_ids, counts):
+    """在当前事务中创建订单、扣减库存，返回销量变化 [(category_id, sku_id, 数量), ...]
+
+    sku_ids需要按照id排序：所有请求都按照相同的顺序锁定商品行，避免死锁
+    商品不存在、库存不足时抛出CheckoutError，调用者负责回滚
+    """
+    # 一次查询出所有商品
+    sku_dict = GoodsSKU.objects.only('id', 'category', 'price').in_bulk(sku_ids)
+    if len(sku_dict) != len(sku_ids):
+        raise CheckoutError(5, '商品不存在')
+
+    # 创建OrederInfo
+    order = OrderInfo.objects.create(
+        order_id=order_id,
+        user_id=user_id,
+        address_id=address_id,
+        total_amount=0,
+        trans_cost=TRANS_COST,
+        pay_method=pay_method,
+    )
+
+    # 定义临时变量
+    total_count = 0
+    total_sku_amount = 0
+    sales = []
+    order_goods = []
+
+    for sku_id, sku_count in zip(sku_ids, counts):
+        sku = sku_dict[sku_id]
+
+        # 减少库存，增加销量：库存足够时才更新，一条UPDATE完成判断和修改，不需要重试
+        result = GoodsSKU.objects.filter(id=sku_id, stock__gte=sku_count).update(
+            stock=F('stock') - sku_count, sales=F('sales') + sku_count)
+        if 0 == result:
+            raise CheckoutError(6, '库存不足')
+
+        # 订单商品最后一次插入
+        order_goods.append(OrderGoods(order=order, sku=sku, count=sku_count, price=sku.price))
+
+        # 计算总数和总金额
+        total_count += sku_count
+        total_sku_amount += sku_count * sku.price
+        sales.append((sku.category_id, sku.id, sku_count))
+
+    # 保存订单商品数据OrderGoods
+    OrderGoods.objects.bulk_create(order_goods)
+
+    # 修改订单信息里面的总数和总金额(OrderInfo)
+    order.total_count = total_count
+    order.total_amount = total_sku_amount + TRANS_COST
+    order.save(update_fields=['total_count', 'total_amount', 'update_time'])
+
+    return sales
+
+
+def order_created(redis_conn, sales):
+    """订单提交以后，同步redis中和商品库存、销量相关的数据"""
+    sku_ids = [sku_id for category_id, sku_id, count in sales]
+
+    # update()不会触发信号，手动清除库存和销量已经变化的商品快照
+    snapshots.invalidate(sku_ids)
+
+    # 同步库存镜像，购物车校验库存时读取
+    stock.decr([(sku_id, count) for category_id, sku_id, count in sales], redis_conn)
+
+    # 增加销量排行，销量变化会改变列表页按人气的排序
+    listing.incr_sales(sales)
+    last_modified.touch_lists([category_id for category_id, sku_id, count in sales])
+
+
+def shard_of(sku_ids):
+    """订单所在的分片：按照订单中id最小的商品分片，不保证包含同一个商品的订单在同一个分片中"""
+    return min(sku_ids) % NUM_SHARDS
+
+
+def enqueue(redis_conn, order_id, user_id, address_id, pay_method, sku_ids, counts):
+    """订单放入队列，返回 (排队号, 分片, 是否需要安排处理任务)"""
+    ticket = uuid.uuid4().hex
+    shard = shard_of(sku_ids)
+    data = {
+        'ticket': ticket,
+        'order_id': order_id,
+        'user_id': user_id,
+        'address_id': address_id,
+        'pay_method': pay_method,
+        'sku_ids': sku_ids,
+        'counts': counts,
+    }
+
+    pipe = redis_conn.pipeline()
+    pipe.set(TICKET_KEY % ticket, json.dumps({'status': 'queued', 'user_id': user_id}), ex=TICKET_TTL)
+    pipe.rpush(QUEUE_KEY % shard, json.dumps(data))
+    pipe.set(SCHEDULED_KEY % shard, 1, nx=True, ex=queues.LOCK_TTL)
+    scheduled = pipe.execute()[-1]
+
+    return ticket, shard, bool(scheduled)
+
+
+def ticket_status(redis_conn, ticket):
+    """排队号的状态，不存在或者已经过期时返回None"""
+    value = redis_conn.get(TICKET_KEY % ticket)
+    return json.loads(value.decode()) if value is not None else None
+
+
+def process_shard(shard, redis_conn=None, batch_size=BATCH_SIZE):
+    """按批创建一个分片中的订单，直到队列为空，返回 (成功的数量, 失败的数量)；其他任务正在处理时直接返回"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    # 之后放入队列的订单会重新安排任务
+    redis_conn.delete(SCHEDULED_KEY % shard)
+
+    return queues.consume(redis_conn, QUEUE_KEY % shard, PROCESSING_KEY % shard, LOCK_KEY % shard,
+                          process_batch, batch_size)
+
+
+def process_batch(redis_conn, orders):
+    """一个事务创建一批订单，每个订单一个保存点，一个订单失败不影响其他订单，返回 (成功的数量, 失败的数量)"""
+    # 已经创建过的订单（上一次任务在提交以后中断）不再创建
+    order_ids = [order['order_id'] for order in orders]
+    existing = set(OrderInfo.objects.filter(order_id__in=order_ids).values_list('order_id', flat=True))
+
+    results = {}
+    sales = []
+    with transaction.atomic():
+        for order in orders:
+            if order['order_id'] in existing:
+                results[order['ticket']] = {'status': 'success', 'code': 0, 'message': '下单成功'}
+                continue
+
+            save_point = transaction.savepoint()
+            try:
+                sales += create_order(order['order_id'], order['user_id'], order['address_id'],
+                                      order['pay_method'], order['sku_ids'], order['counts'])
+            except CheckoutError as e:
+                transaction.savepoint_rollback(save_point)
+                results[order['ticket']] = {'status': 'failed', 'code': e.code, 'message': e.message}
+                continue
+            except Exception:
+                transaction.savepoint_rollback(save_point)
+                results[order['ticket']] = {'status': 'failed', 'code': 7, 'message': '下单失败'}
+                continue
+
+            transaction.savepoint_commit(save_point)
+            results[order['ticket']] = {'status': 'success', 'code': 0, 'message': '下单成功'}
+
+    if sales:
+        order_created(redis_conn, sales)
+        order_counts.invalidate([order['user_id'] for order in orders])
+
+    succeeded = 0
+    pipe = redis_conn.pipeline()
+    for order in orders:
+        result = results[order['ticket']]
+        result.update({'user_id': order['user_id'], 'order_id': order['order_id']})
+        pipe.set(TICKET_KEY % order['ticket'], json.dumps(result), ex=TICKET_TTL)
+        if result['status'] == 'success':
+            succeeded += 1
+    pipe.execute()
+
+    # 下单失败的商品放回购物车（排队时已经从购物车中删除）
+    for order in orders:
+        if results[order['ticket']]['status'] == 'failed':
+            operations.restore(redis_conn, order['user_id'], dict(zip(order['sku_ids'], order['counts'])))
+
+    return succeeded, len(orders) - succeeded
@@ -0,0 +1,352 @@
+"""秒杀：参加秒杀的商品在redis中扣减库存，订单由celery异步批量写入MySQL
+
+flash_sale_skus            set，参加秒杀的sku_id
+flash_stock                hash，field是sku_id，value是redis中剩余的秒杀库存
+flash_orders               list，已经扣减库存、等待写入MySQL的订单（json）
+flash_orders_processing    list，正在写入MySQL的订单，写入过程中断时下一次重新处理
+flash_orders_scheduled     已经安排了写入任务，避免每个订单都发送一个任务；beat只作为兜底
+flash_order_<order_id>     订单状态（json）：{'status': pending等待写入 | success已写入 | failed写入失败, 'user_id': 用户}，
+                           前端通过/orders/commit/status?order_id=轮询
+
+下单时Lua脚本一次完成"判断库存-扣减库存-订单入队"，MySQL只在celery任务中批量写入：
+同一批订单一个事务，每个商品一条UPDATE；批量写入失败时逐个写入，仍然失败的订单放回购物车：
+- MySQL库存不足：redis中的秒杀库存多于MySQL，不退回库存，按照MySQL的库存修正，否则会不停地扣减-失败
+- 其他错误：退回redis中的秒杀库存
+开始、结束秒杀和对账使用 python manage.py flash_sale
+"""
+import json
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+from django_redis import get_redis_connection
+
+from cart import operations
+from goods import last_modified, listing, snapshots, stock
+from goods.models import GoodsSKU
+from orders import order_counts, queues
+from orders.checkout import TRANS_COST
+from orders.models import OrderInfo, OrderGoods
+from utils.redis_scripts import get_script
+
+SKUS_KEY = 'flash_sale_skus'
+STOCK_KEY = 'flash_stock'
+QUEUE_KEY = 'flash_orders'
+PROCESSING_KEY = 'flash_orders_processing'
+STATUS_KEY = 'flash_order_%s'
+LOCK_KEY = 'flash_orders_lock'
+SCHEDULED_KEY = 'flash_orders_scheduled'
+
+# 订单状态保存的时间（秒）
+STATUS_TTL = 24 * 3600
+
+# 每一批写入的订单数量
+BATCH_SIZE = 500
+
+# 扣减库存并且订单入队 KEYS: 秒杀库存, 订单队列, 订单状态, 已经安排任务的标记
+# ARGV: 订单json, 订单状态json, 状态有效期, 之后每2个一组 sku_id, 数量
+# 所有商品的库存都足够时才扣减，返回1，需要安排写入任务时返回2；否则不做任何修改，返回0
+RESERVE_LUA = """
+for i = 4, #ARGV, 2 do
+    local stock = tonumber(redis.call('HGET', KEYS[1], ARGV[i]))
+    if stock == nil or stock < tonumber(ARGV[i + 1]) then
+        return 0
+    end
+end
+for i = 4, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+end
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('SET', KEYS[3], ARGV[2], 'EX', ARGV[3])
+if redis.call('SET', KEYS[4], 1, 'NX', 'EX', %d) then
+    return 2
+end
+return 1
+""" % queues.LOCK_TTL
+
+# 按照MySQL的库存修正秒杀库存 KEYS: 秒杀库存, 订单队列  ARGV: 每2个一组 sku_id, MySQL中的库存
+# 秒杀库存 = MySQL中的库存 - 还在队列中的订单的数量，在redis中一次完成，修正期间不会有新的订单扣减库存
+CORRECT_LUA = """
+local queued = {}
+for _, item in ipairs(redis.call('LRANGE', KEYS[2], 0, -1)) do
+    for _, line in ipairs(cjson.decode(item)['lines']) do
+        local sku_id = tostring(line[1])
+        queued[sku_id] = (queued[sku_id] or 0) + line[2]
+    end
+end
+for i = 1, #ARGV, 2 do
+    local stock = tonumber(ARGV[i + 1]) - (queued[ARGV[i]] or 0)
+    redis.call('HSET', KEYS[1], ARGV[i], math.max(stock, 0))
+end
+return 1
+"""
+
+class FlashStockError(Exception):
+    """写入MySQL时库存不足"""
+    pass
+
+
+def flagged(redis_conn):
+    """参加秒杀的sku_id集合"""
+    return set(int(sku_id) for sku_id in redis_conn.smembers(SKUS_KEY))
+
+
+def start(sku_ids, redis_conn=None):
+    """开始秒杀：把MySQL中的库存加载到redis，返回 {sku_id: 库存}"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    stocks = dict(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'))
+    if stocks:
+        pipe = redis_conn.pipeline()
+        pipe.hmset(STOCK_KEY, stocks)
+        pipe.sadd(SKUS_KEY, *stocks.keys())
+        pipe.execute()
+    return stocks
+
+
+def stop(sku_ids, redis_conn=None):
+    """结束秒杀：商品不再走秒杀下单，redis中的订单全部写入MySQL以后再删除秒杀库存"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+    redis_conn.srem(SKUS_KEY, *sku_ids)
+
+
+def clear_stock(redis_conn=None):
+    """删除已经结束秒杀的商品的秒杀库存，还有订单没有写入MySQL时不删除，返回删除的sku_id"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    if pending_counts(redis_conn):
+        return []
+
+    active = flagged(redis_conn)
+    ended = [int(sku_id) for sku_id in redis_conn.hkeys(STOCK_KEY) if int(sku_id) not in active]
+    if ended:
+        redis_conn.hdel(STOCK_KEY, *ended)
+    return ended
+
+
+def reserve(redis_conn, order_id, user_id, address_id, pay_method, skus):
+    """扣减redis中的秒杀库存，订单入队，skus是绑定了count的商品快照列表
+
+    返回 (是否成功, 是否需要安排写入任务)，库存不足时返回 (False, False)
+    """
+    data = {
+        'order_id': order_id,
+        'user_id': user_id,
+        'address_id': address_id,
+        'pay_method': pay_method,
+        # 下单时看到的价格只作记录，写入MySQL时按照当前的价格计算金额
+        'lines': [[sku.id, sku.count, str(sku.price), sku.category_id] for sku in skus],
+    }
+    status = json.dumps({'status': 'pending', 'user_id': user_id})
+    args = [json.dumps(data), status, STATUS_TTL]
+    for sku in skus:
+        args.extend([sku.id, sku.count])
+
+    keys = [STOCK_KEY, QUEUE_KEY, STATUS_KEY % order_id, SCHEDULED_KEY]
+    result = get_script(redis_conn, RESERVE_LUA)(keys=keys, args=args, client=redis_conn)
+    return result > 0, result == 2
+
+
+def schedule(redis_conn):
+    """写入任务结束以后，队列中还有订单并且没有安排任务时返回True，调用者再发送一个任务"""
+    return bool(redis_conn.llen(QUEUE_KEY)) and bool(redis_conn.set(SCHEDULED_KEY, 1, nx=True, ex=queues.LOCK_TTL))
+
+
+def order_status(redis_conn, order_id):
+    """秒杀订单的状态 {'status': 状态, 'user_id': 用户}，不是秒杀订单或者状态已经过期时返回None"""
+    value = redis_conn.get(STATUS_KEY % order_id)
+    return json.loads(value.decode()) if value is not None else None
+
+
+def set_status(pipe, order, status):
+    """在pipeline中写入订单状态"""
+    pipe.set(STATUS_KEY % order['order_id'], json.dumps({'status': status, 'user_id': order['user_id']}),
+             ex=STATUS_TTL)
+
+
+def pending_orders(redis_conn):
+    """还没有写入MySQL的订单"""
+    pipe = redis_conn.pipeline()
+    pipe.lrange(PROCESSING_KEY, 0, -1)
+    pipe.lrange(QUEUE_KEY, 0, -1)
+    processing, queued = pipe.execute()
+    return [json.loads(item.decode()) for item in processing + queued]
+
+
+def pending_counts(redis_conn):
+    """还没有写入MySQL的订单中每个商品的数量 {sku_id: 数量}"""
+    counts = defaultdict(int)
+    for order in pending_orders(redis_conn):
+        for sku_id, count, price, category_id in order['lines']:
+            counts[sku_id] += count
+    return dict(counts)
+
+
+def persist(redis_conn=None, batch_size=BATCH_SIZE):
+    """把队列中的订单批量写入MySQL，返回 (写入成功的数量, 失败的数量)；其他任务正在写入时直接返回"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    # 之后入队的订单会重新安排任务；其他任务正在写入时，由schedule()在结束以后重新安排
+    redis_conn.delete(SCHEDULED_KEY)
+
+    return queues.consume(redis_conn, QUEUE_KEY, PROCESSING_KEY, LOCK_KEY, persist_batch, batch_size)
+
+
+def persist_batch(redis_conn, orders):
+    """写入一批订单，返回 (成功的数量, 失败的数量)"""
+    # 已经写入过的订单（上一次任务在写入MySQL以后中断）不再写入
+    order_ids = [order['order_id'] for order in orders]
+    existing = set(OrderInfo.objects.filter(order_id__in=order_ids).values_list('order_id', flat=True))
+    if existing:
+        pipe = redis_conn.pipeline()
+        for order in orders:
+            if order['order_id'] in existing:
+                set_status(pipe, order, 'success')
+        pipe.execute()
+    orders = [order for order in orders if order['order_id'] not in existing]
+
+    try:
+        with transaction.atomic():
+            save_orders(orders)
+        succeeded, out_of_stock, failed = orders, [], []
+    except Exception:
+        # 批量写入失败，逐个写入，找出失败的订单
+        succeeded, out_of_stock, failed = [], [], []
+        for order in orders:
+            try:
+                with transaction.atomic():
+                    save_orders([order])
+                succeeded.append(order)
+            except FlashStockError:
+                out_of_stock.append(order)
+            except Exception:
+                failed.append(order)
+
+    # 锁过期以后其他任务可能同时在处理这批订单：它提交的订单在这里会因为主键重复而失败，
+    # 补偿之前再查询一次，已经写入的订单按照成功处理，不能放回购物车、退回库存
+    if out_of_stock or failed:
+        order_ids = [order['order_id'] for order in out_of_stock + failed]
+        existing = set(OrderInfo.objects.filter(order_id__in=order_ids).values_list('order_id', flat=True))
+        if existing:
+            pipe = redis_conn.pipeline()
+            for order in out_of_stock + failed:
+                if order['order_id'] in existing:
+                    set_status(pipe, order, 'success')
+            pipe.execute()
+            out_of_stock = [order for order in out_of_stock if order['order_id'] not in existing]
+            failed = [order for order in failed if order['order_id'] not in existing]
+
+    if succeeded:
+        order_saved(redis_conn, succeeded)
+    if out_of_stock or failed:
+        compensate(redis_conn, out_of_stock, failed)
+
+    return len(succeeded), len(out_of_stock) + len(failed)
+
+
+def save_orders(orders):
+    """在当前事务中写入订单和订单商品，每个商品一条UPDATE扣减库存，库存不足时抛出FlashStockError
+
+    金额使用MySQL中当前的价格：队列中的价格来自下单时的商品快照，可能是修改价格之前缓存的旧价格
+    """
+    if not orders:
+        return
+
+    counts = defaultdict(int)
+    for order in orders:
+        for sku_id, count, price, category_id in order['lines']:
+            counts[sku_id] += count
+
+    # 按照id顺序更新，避免和普通下单死锁；UPDATE以后商品行被锁定，事务提交之前价格不会再变化
+    for sku_id in sorted(counts):
+        result = GoodsSKU.objects.filter(id=sku_id, stock__gte=counts[sku_id]).update(
+            stock=F('stock') - counts[sku_id], sales=F('sales') + counts[sku_id])
+        if 0 == result:
+            raise FlashStockError(sku_id)
+
+    prices = dict(GoodsSKU.objects.filter(id__in=counts.keys()).values_list('id', 'price'))
+
+    infos = []
+    goods = []
+    for order in orders:
+        total_count = 0
+        total_amount = Decimal('0')
+        for sku_id, count, price, category_id in order['lines']:
+            price = prices[sku_id]
+            goods.append(OrderGoods(order_id=order['order_id'], sku_id=sku_id, count=count, price=price))
+            total_count += count
+            total_amount += count * price
+
+        infos.append(OrderInfo(
+            order_id=order['order_id'],
+            user_id=order['user_id'],
+            address_id=order['address_id'],
+            total_count=total_count,
+            total_amount=total_amount + TRANS_COST,
+            trans_cost=TRANS_COST,
+            pay_method=order['pay_method'],
+        ))
+
+    OrderInfo.objects.bulk_create(infos)
+    OrderGoods.objects.bulk_create(goods)
+
+
+def order_saved(redis_conn, orders):
+    """订单写入MySQL以后：修改订单状态，同步库存镜像、商品快照、销量排行"""
+    sales = []
+    for order in orders:
+        for sku_id, count, price, category_id in order['lines']:
+            sales.append((category_id, sku_id, count))
+
+    pipe = redis_conn.pipeline()
+    for order in orders:
+        set_status(pipe, order, 'success')
+    pipe.execute()
+
+    stock.decr([(sku_id, count) for category_id, sku_id, count in sales], redis_conn)
+    snapshots.invalidate([sku_id for category_id, sku_id, count in sales])
+    listing.incr_sales(sales)
+    last_modified.touch_lists([category_id for category_id, sku_id, count in sales])
+    order_counts.invalidate([order['user_id'] for order in orders])
+
+
+def compensate(redis_conn, out_of_stock, failed):
+    """订单写入MySQL失败：修改订单状态，商品放回购物车
+
+    out_of_stock是MySQL库存不足的订单，按照MySQL修正秒杀库存；failed是其他原因失败的订单，退回秒杀库存
+    已经结束秒杀的商品，秒杀库存不再使用，不用退回也不用修正
+    """
+    active = flagged(redis_conn)
+
+    pipe = redis_conn.pipeline()
+    for order in failed:
+        for sku_id, count, price, category_id in order['lines']:
+            if sku_id in active:
+                pipe.hincrby(STOCK_KEY, sku_id, count)
+    for order in out_of_stock + failed:
+        set_status(pipe, order, 'failed')
+    pipe.execute()
+
+    sku_ids = set(sku_id for order in out_of_stock for sku_id, count, price, category_id in order['lines'])
+    sku_ids &= active
+    if sku_ids:
+        correct_stock(redis_conn, sku_ids)
+
+    # 下单时已经从购物车中删除
+    for order in out_of_stock + failed:
+        operations.restore(redis_conn, order['user_id'],
+                           dict((sku_id, count) for sku_id, count, price, category_id in order['lines']))
+
+
+def correct_stock(redis_conn, sku_ids):
+    """按照MySQL中的库存修正秒杀库存，减去还在队列中等待写入的订单"""
+    args = []
+    for sku_id, db_stock in GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'):
+        args.extend([sku_id, db_stock])
+    if args:
+        get_script(redis_conn, CORRECT_LUA)(keys=[STOCK_KEY, QUEUE_KEY], args=args, client=redis_conn)
@@ -0,0 +1,58 @@
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from orders import payment
+from orders.models import OrderInfo
+
+
+class Command(BaseCommand):
+    """支付宝客户端的压测：比较每个请求新建客户端、签名，和共享客户端、使用缓存的签名的CPU时间
+
+    不请求支付宝，使用一个没有保存的订单，检查完成后删除缓存的签名
+    python manage.py bench_alipay_client
+    python manage.py bench_alipay_client -n 500
+    """
+    help = '支付宝客户端和支付签名缓存的压测'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, dest='number', default=200, help='每一项重复的次数')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        order = OrderInfo(order_id='bench%s' % uuid.uuid4().hex, total_amount=Decimal('100.00'),
+                          update_time=timezone.now())
+
+        def sign(client):
+            return client.api_alipay_trade_page_pay(out_trade_no=order.order_id, total_amount=str(order.total_amount),
+                                                    subject='天天生鲜', return_url=None, notify_url=None)
+
+        try:
+            results = [
+                # 修改以前：每个请求读取密钥文件、创建客户端、签名
+                ('每次新建客户端并签名', lambda: sign(payment.create_client())),
+                ('每次新建客户端', payment.create_client),
+                ('共享客户端并签名', lambda: sign(payment.alipay_client())),
+                # 修改以后：第一次签名以后使用缓存
+                ('共享客户端并使用缓存的签名', lambda: payment.page_pay_string(order)),
+            ]
+            timings = [(name, self.measure(func, number)) for name, func in results]
+        finally:
+            cache.delete(payment.pay_string_key(order))
+
+        baseline = timings[0][1]
+        for name, cpu in timings:
+            self.stdout.write('%s：每次%.3f毫秒CPU，速度是第一项的%.1f倍' % (name, cpu * 1000, baseline / cpu if cpu else 0))
+        self.stdout.write('每个支付请求节省%.3f毫秒CPU' % ((baseline - timings[-1][1]) * 1000))
+
+    def measure(self, func, number):
+        """重复执行，返回每次平均的CPU时间（秒）"""
+        func()
+        started = time.process_time()
+        for i in range(number):
+            func()
+        return (time.process_time() - started) / number
@@ -0,0 +1,72 @@
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+
+from orders import order_ids
+
+
+def generate(count):
+    """在子进程中使用new_order_id()连续生成订单号，返回 (worker id, 订单号列表, 耗时)
+
+    第一个订单号从redis租用worker id，和线上的进程一样，不计入耗时；结束以后释放租约
+    """
+    first = order_ids.new_order_id()
+    new_order_id = order_ids.new_order_id
+    started = time.time()
+    ids = [first] + [new_order_id() for i in range(count - 1)]
+    seconds = time.time() - started
+
+    worker_id = order_ids.get_generator().worker_id
+    get_redis_connection('default').delete(order_ids.WORKER_KEY % worker_id)
+    return worker_id, ids, seconds
+
+
+class Command(BaseCommand):
+    """订单号生成器的压测：多个进程同时生成订单号，检查是否有序、是否重复，统计每秒生成的数量
+
+    每个进程通过order_ids.new_order_id()从redis租用worker id，和线上的进程走同一条路径，结束以后释放租约
+    python manage.py bench_order_ids                  4个进程，每个进程100万个订单号
+    python manage.py bench_order_ids -p 8 -n 500000   8个进程，每个进程50万个订单号
+    """
+    help = '订单号生成器的压测'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--processes', type=int, dest='processes', default=4, help='进程数量')
+        parser.add_argument('-n', '--number', type=int, dest='number', default=1000000,
+                            help='每个进程生成的订单号数量')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        number = options['number']
+
+        # 每个任务一个新的进程，一个进程只使用一个worker id
+        pool = Pool(processes, maxtasksperchild=1)
+        started = time.time()
+        try:
+            results = pool.map(generate, [number] * processes, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - started
+
+        worker_ids = set(worker_id for worker_id, ids, seconds in results)
+        if len(worker_ids) != processes:
+            raise CommandError('多个进程租用了同一个worker id')
+
+        all_ids = set()
+        for worker_id, ids, seconds in results:
+            self.stdout.write('worker %s：%s个订单号，%.2f秒，每秒%d个' % (worker_id, len(ids), seconds, len(ids) / seconds))
+            # 同一个进程中生成的订单号需要严格递增
+            if any(ids[i] >= ids[i + 1] for i in range(len(ids) - 1)):
+                raise CommandError('worker %s生成的订单号不是递增的' % worker_id)
+            all_ids.update(ids)
+
+        total = processes * number
+        self.stdout.write('合计：%s个订单号，%.2f秒（包含进程启动和传输），每秒%d个' % (total, elapsed, total / elapsed))
+        self.stdout.write('各进程生成速度之和：每秒%d个' % sum(len(ids) / seconds for worker_id, ids, seconds in results))
+
+        if len(all_ids) != total:
+            raise CommandError('有%s个订单号重复' % (total - len(all_ids)))
+        self.stdout.write('没有重复的订单号')
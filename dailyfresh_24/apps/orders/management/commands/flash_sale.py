@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+
+from goods.models import GoodsSKU
+from orders import flash_sale
+
+
+class Command(BaseCommand):
+    """秒杀的开始、结束和对账
+
+    python manage.py flash_sale start -s 1 -s 2     开始秒杀：把MySQL中的库存加载到redis
+    python manage.py flash_sale stop -s 1           结束秒杀，订单全部写入MySQL以后删除秒杀库存
+    python manage.py flash_sale audit               对账：redis中的秒杀库存 + 没有写入MySQL的订单 = MySQL中的库存
+    python manage.py flash_sale audit --fix         对账并且按照MySQL修正redis中的秒杀库存（需要先暂停写入任务）
+    """
+    help = '秒杀的开始、结束和对账'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['start', 'stop', 'audit'])
+        parser.add_argument('-s', '--sku', action='append', type=int, dest='skus', help='sku_id，可以指定多个')
+        parser.add_argument('--fix', action='store_true', dest='fix', default=False,
+                            help='对账时按照MySQL修正redis中的秒杀库存')
+
+    def handle(self, *args, **options):
+        redis_conn = get_redis_connection('default')
+        action = options['action']
+
+        if action in ('start', 'stop') and not options['skus']:
+            raise CommandError('需要使用-s指定商品')
+
+        if action == 'start':
+            stocks = flash_sale.start(options['skus'], redis_conn)
+            for sku_id in options['skus']:
+                if sku_id in stocks:
+                    self.stdout.write('商品%s：开始秒杀，库存%s' % (sku_id, stocks[sku_id]))
+                else:
+                    self.stdout.write('商品%s：不存在' % sku_id)
+
+        elif action == 'stop':
+            flash_sale.stop(options['skus'], redis_conn)
+            self.stdout.write('商品%s：结束秒杀' % options['skus'])
+            ended = flash_sale.clear_stock(redis_conn)
+            if ended:
+                self.stdout.write('已经删除秒杀库存：%s' % ended)
+            else:
+                self.stdout.write('还有订单没有写入MySQL，写入完成以后再次执行stop删除秒杀库存')
+
+        else:
+            self.audit(redis_conn, options['fix'])
+
+    def audit(self, redis_conn, fix):
+        """比较redis和MySQL中的库存"""
+        redis_stocks = dict((int(sku_id), int(value)) for sku_id, value in redis_conn.hgetall(flash_sale.STOCK_KEY).items())
+        if not redis_stocks:
+            self.stdout.write('没有秒杀商品')
+            return
+
+        pending = flash_sale.pending_counts(redis_conn)
+        mysql_stocks = dict(GoodsSKU.objects.filter(id__in=redis_stocks.keys()).values_list('id', 'stock'))
+        active = flash_sale.flagged(redis_conn)
+
+        errors = 0
+        for sku_id in sorted(redis_stocks):
+            expected = mysql_stocks.get(sku_id, 0) - pending.get(sku_id, 0)
+            state = '秒杀中' if sku_id in active else '已结束'
+            line = '商品%s(%s)：redis %s  MySQL %s  未写入 %s' % (
+                sku_id, state, redis_stocks[sku_id], mysql_stocks.get(sku_id), pending.get(sku_id, 0))
+
+            if redis_stocks[sku_id] == expected:
+                self.stdout.write('[一致] ' + line)
+                continue
+
+            errors += 1
+            self.stdout.write('[不一致] ' + line)
+            if fix:
+                redis_conn.hset(flash_sale.STOCK_KEY, sku_id, max(expected, 0))
+                self.stdout.write('    已修正为%s' % max(expected, 0))
+
+        if errors and not fix:
+            raise CommandError('共有%s个商品的库存不一致，可以使用--fix修正' % errors)
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0002_auto_20180225_0325'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='ordergoods',
+            index_together=set([('sku', 'create_time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='orderinfo',
+            index_together=set([('user', 'create_time')]),
+        ),
+    ]
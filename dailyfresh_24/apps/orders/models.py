@@ -65,6 +65,10 @@ class OrderInfo(BaseModel):
 
     class Meta:
         db_table = "df_order_info"
+        # 用户订单页按下单时间排序
+        index_together = [
+            ('user', 'create_time'),
+        ]
 
 
 class OrderGoods(BaseModel):
@@ -77,5 +81,9 @@ class OrderGoods(BaseModel):
 
     class Meta:
         db_table = "df_order_goods"
+        # 详情页的评论按时间排序
+        index_together = [
+            ('sku', 'create_time'),
+        ]
 
 
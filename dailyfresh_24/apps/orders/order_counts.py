@@ -0,0 +1,28 @@
+"""用户的订单数量缓存：订单列表分页时使用，不用每次查询COUNT(*)
+
+同步下单、异步下单和秒杀订单写入MySQL以后删除缓存
+"""
+from django.core.cache import cache
+
+from orders.models import OrderInfo
+
+ORDER_COUNT_KEY = 'order_count_%s'
+
+# 缓存的有效期（秒），删除缓存和读取数量并发时可能缓存旧的数量，过期以后自动修正
+ORDER_COUNT_TIMEOUT = 600
+
+
+def get_count(user_id):
+    """用户的订单数量"""
+    count = cache.get(ORDER_COUNT_KEY % user_id)
+    if count is None:
+        count = OrderInfo.objects.filter(user_id=user_id).count()
+        cache.set(ORDER_COUNT_KEY % user_id, count, ORDER_COUNT_TIMEOUT)
+    return count
+
+
+def invalidate(user_ids):
+    """用户有了新的订单以后删除缓存"""
+    keys = [ORDER_COUNT_KEY % user_id for user_id in set(user_ids)]
+    if keys:
+        cache.delete_many(keys)
@@ -0,0 +1,101 @@
+"""订单号：时间有序，多个进程、多台机器同时生成也不会重复，生成时不访问数据库和redis
+
+订单号是25位数字：UTC时间到毫秒(17位，%Y%m%d%H%M%S + 毫秒) + worker id(4位) + 同一个毫秒内的序号(4位)
+worker id在进程第一次生成订单号时从redis分配（order_id_worker_<id>，带过期时间的租约），
+之后每隔WORKER_TTL/3续约一次；fork出的子进程会重新分配
+同一个毫秒内的序号用完、或者时钟回拨时，继续使用上一次的时间往后递增，订单号仍然有序并且不重复
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+from django_redis import get_redis_connection
+
+# worker id和序号的数量，都是4位数字
+MAX_WORKERS = 10000
+MAX_SEQUENCE = 10000
+
+# 分配worker id的计数器和租约
+WORKER_COUNTER_KEY = 'order_id_workers'
+WORKER_KEY = 'order_id_worker_%s'
+
+# worker id租约的有效期（秒），进程退出以后租约过期，worker id可以重新分配
+WORKER_TTL = 3600
+
+# 当前进程的生成器
+_generator = None
+_lock = threading.Lock()
+
+
+class OrderIdGenerator(object):
+    """一个worker id的订单号生成器，线程安全"""
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id < MAX_WORKERS:
+            raise ValueError('worker id需要在0到%s之间' % (MAX_WORKERS - 1))
+        self.worker_id = worker_id
+        self.pid = os.getpid()
+        self.leased = time.time()
+        self._worker = '%04d' % worker_id
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+        self._prefix = ''
+
+    def next_id(self):
+        """生成一个订单号"""
+        with self._lock:
+            ms = int(time.time() * 1000)
+            if ms > self._last_ms:
+                self._sequence = 0
+                self._set_time(ms)
+            else:
+                # 同一个毫秒内或者时钟回拨
+                self._sequence += 1
+                if self._sequence >= MAX_SEQUENCE:
+                    self._sequence = 0
+                    self._set_time(self._last_ms + 1)
+            return '%s%04d' % (self._prefix, self._sequence)
+
+    def _set_time(self, ms):
+        """时间变化时才重新格式化，同一个毫秒内只拼接序号"""
+        self._last_ms = ms
+        self._prefix = (datetime.utcfromtimestamp(ms // 1000).strftime('%Y%m%d%H%M%S') +
+                        '%03d' % (ms % 1000) + self._worker)
+
+
+def allocate_worker_id(redis_conn):
+    """从redis分配一个没有被其他进程使用的worker id"""
+    start = redis_conn.incr(WORKER_COUNTER_KEY)
+    for i in range(MAX_WORKERS):
+        worker_id = (start + i) % MAX_WORKERS
+        if redis_conn.set(WORKER_KEY % worker_id, os.getpid(), nx=True, ex=WORKER_TTL):
+            return worker_id
+    raise RuntimeError('没有可用的订单号worker id')
+
+
+def get_generator():
+    """当前进程的生成器，第一次使用、fork以后重新分配worker id，租约快过期时续约"""
+    global _generator
+    generator = _generator
+    if generator is not None and generator.pid == os.getpid() and time.time() - generator.leased < WORKER_TTL / 3:
+        return generator
+
+    with _lock:
+        generator = _generator
+        redis_conn = get_redis_connection('default')
+        elapsed = time.time() - generator.leased if generator is not None else None
+        if generator is None or generator.pid != os.getpid() or elapsed >= WORKER_TTL * 2 / 3:
+            # 长时间没有生成订单号时，租约可能已经过期并且被其他进程分配，重新分配
+            generator = OrderIdGenerator(allocate_worker_id(redis_conn))
+            _generator = generator
+        elif elapsed >= WORKER_TTL / 3:
+            redis_conn.expire(WORKER_KEY % generator.worker_id, WORKER_TTL)
+            generator.leased = time.time()
+    return generator
+
+
+def new_order_id():
+    """生成一个订单号"""
+    return get_generator().next_id()
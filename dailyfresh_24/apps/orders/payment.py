@@ -0,0 +1,255 @@
+"""支付宝支付结果：以异步通知为主，celery按照指数退避查询为辅，浏览器从redis轮询支付状态
+
+pay_status_<order_id>    json，{'user_id': 用户, 'status': pending等待支付 | paid已支付 | closed交易关闭}
+pay_notify_<order_id>    list，支付完成或者交易关闭时放入一个元素，唤醒正在等待的轮询请求（BLPOP）
+pay_polling_<order_id>   已经安排了查询任务，多次点击支付时不会重复查询
+
+1. PayView生成支付链接时，支付状态设置为pending，安排celery任务poll_payment
+2. 支付宝异步通知AlipayNotifyView，验证签名以后修改订单状态，通常在支付完成后几秒内到达
+3. 没有收到通知时（例如开发环境中支付宝访问不到通知地址），poll_payment按照指数退避查询支付宝
+4. CheckPayView只读取redis中的支付状态，最多等待LONG_POLL_TIMEOUT秒，不请求支付宝；
+   uwsgi的线程很少，不能长时间占用，浏览器收到等待支付以后间隔几秒再查询
+支付流程的测试见orders/tests.py（本地模拟的支付宝网关）
+"""
+import json
+import threading
+from decimal import Decimal, InvalidOperation
+
+from alipay import AliPay
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from orders.models import OrderInfo
+
+STATUS_KEY = 'pay_status_%s'
+NOTIFY_KEY = 'pay_notify_%s'
+POLLING_KEY = 'pay_polling_%s'
+
+PENDING = 'pending'
+PAID = 'paid'
+CLOSED = 'closed'
+
+# 支付状态保存的时间（秒）
+STATUS_TTL = 24 * 3600
+
+# 查询支付状态的请求最多等待的时间（秒），不能长时间占用uwsgi的线程
+LONG_POLL_TIMEOUT = 1
+
+# 查询支付宝的间隔：3秒开始每次翻倍，最长5分钟，最多查询15次（大约45分钟）
+POLL_BASE_DELAY = 3
+POLL_MAX_DELAY = 300
+POLL_MAX_ATTEMPTS = 15
+
+# 签名以后的支付参数缓存的时间（秒）
+PAY_STRING_KEY = 'pay_string_%s_%s_%s'
+PAY_STRING_TIMEOUT = 600
+
+# 支付宝交易状态
+TRADE_PAID = ('TRADE_SUCCESS', 'TRADE_FINISHED')
+TRADE_CLOSED = 'TRADE_CLOSED'
+
+# 进程内共享的支付宝客户端 (配置, 客户端)
+_client = None
+_client_lock = threading.Lock()
+
+
+def create_client():
+    """创建支付宝客户端，读取并解析密钥文件"""
+    client = AliPay(
+        appid=settings.ALIPAY_APPID,
+        app_notify_url=None,
+        app_private_key_path=settings.APP_PRIVATE_KEY_PATH,
+        alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH,
+        sign_type="RSA2",
+        debug=True
+    )
+    # 检查支付流程时指向本地模拟的网关
+    gateway = getattr(settings, 'ALIPAY_GATEWAY', None)
+    if gateway:
+        client._gateway = gateway
+    return client
+
+
+def alipay_client():
+    """进程内共享的支付宝客户端，密钥文件只在第一次使用时读取和解析
+
+    客户端创建以后只读，每次签名、验签都使用新的签名对象，可以在uwsgi的多个线程中共享
+    支付宝相关的配置变化时（例如测试修改了网关）重新创建
+    """
+    global _client
+    config = (settings.ALIPAY_APPID, settings.APP_PRIVATE_KEY_PATH, settings.ALIPAY_PUBLIC_KEY_PATH,
+              getattr(settings, 'ALIPAY_GATEWAY', None))
+    cached = _client
+    if cached is not None and cached[0] == config:
+        return cached[1]
+
+    with _client_lock:
+        cached = _client
+        if cached is None or cached[0] != config:
+            cached = (config, create_client())
+            _client = cached
+    return cached[1]
+
+
+def pay_string_key(order):
+    """支付参数缓存的key"""
+    return PAY_STRING_KEY % (order.order_id, '%x' % int(order.update_time.timestamp() * 1000000), order.total_amount)
+
+
+def page_pay_string(order):
+    """订单的支付参数（已经签名），订单修改以前重复点击支付时直接使用缓存，不再RSA签名
+
+    缓存的key包含订单的修改时间和金额，订单修改以后自动失效；签名中有时间戳，缓存时间不能太长
+    """
+    key = pay_string_key(order)
+    order_string = cache.get(key)
+    if order_string is None:
+        order_string = alipay_client().api_alipay_trade_page_pay(
+            out_trade_no=order.order_id,
+            total_amount=str(order.total_amount),
+            subject='天天生鲜',
+            return_url=None,
+            notify_url=settings.ALIPAY_NOTIFY_URL
+        )
+        cache.set(key, order_string, PAY_STRING_TIMEOUT)
+    return order_string
+
+
+def get_status(redis_conn, order_id):
+    """redis中的支付状态 {'user_id': 用户, 'status': 状态}，没有时返回None"""
+    value = redis_conn.get(STATUS_KEY % order_id)
+    return json.loads(value.decode()) if value is not None else None
+
+
+def set_status(redis_conn, order_id, user_id, status):
+    """写入支付状态，支付完成或者交易关闭时唤醒正在等待的请求
+
+    等待支付(pending)不放入通知，否则设置pending以后的第一次查询会立即返回
+    """
+    pipe = redis_conn.pipeline()
+    pipe.set(STATUS_KEY % order_id, json.dumps({'user_id': user_id, 'status': status}), ex=STATUS_TTL)
+    if status != PENDING:
+        pipe.rpush(NOTIFY_KEY % order_id, 1)
+        pipe.expire(NOTIFY_KEY % order_id, LONG_POLL_TIMEOUT * 2)
+    pipe.execute()
+
+
+def wait_status(redis_conn, order_id, timeout=None):
+    """还在等待支付时，等待支付状态变化，最多等待timeout秒（默认LONG_POLL_TIMEOUT），返回支付状态"""
+    if timeout is None:
+        timeout = LONG_POLL_TIMEOUT
+    status = get_status(redis_conn, order_id)
+    if status is not None and status['status'] == PENDING:
+        # 读取状态以后才写入的通知留在列表中，BLPOP会立即返回，不会错过
+        redis_conn.blpop(NOTIFY_KEY % order_id, timeout)
+        status = get_status(redis_conn, order_id)
+    return status
+
+
+def start_polling(redis_conn, order_id):
+    """开始查询支付结果，已经在查询时返回False"""
+    # 任务异常中断时，所有查询的时间过去以后可以重新开始
+    total = sum(poll_delay(attempt) for attempt in range(POLL_MAX_ATTEMPTS)) + POLL_MAX_DELAY
+    return bool(redis_conn.set(POLLING_KEY % order_id, 1, nx=True, ex=total))
+
+
+def stop_polling(redis_conn, order_id):
+    """查询结束"""
+    redis_conn.delete(POLLING_KEY % order_id)
+
+
+def poll_delay(attempt):
+    """第attempt次查询之前等待的时间（秒）"""
+    return min(POLL_BASE_DELAY * 2 ** attempt, POLL_MAX_DELAY)
+
+
+def apply_trade(redis_conn, order, trade_status, trade_no):
+    """根据支付宝的交易状态修改订单和支付状态，返回支付状态
+
+    只修改待支付的订单，异步通知和查询同时到达、通知重复发送时只修改一次
+    """
+    if trade_status in TRADE_PAID:
+        OrderInfo.objects.filter(order_id=order.order_id, status=OrderInfo.ORDER_STATUS_ENUM['UNPAID']).update(
+            trade_id=trade_no, status=OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT'], update_time=timezone.now())
+        status = PAID
+    elif trade_status == TRADE_CLOSED:
+        status = CLOSED
+    else:
+        return PENDING
+
+    set_status(redis_conn, order.order_id, order.user_id, status)
+    return status
+
+
+def query(redis_conn, order):
+    """查询支付宝的交易状态，返回支付状态；支付宝没有响应时当作还在等待支付"""
+    try:
+        response = alipay_client().api_alipay_trade_query(order.order_id)
+    except Exception:
+        return PENDING
+
+    code = response.get('code')
+    if code == '10000':
+        return apply_trade(redis_conn, order, response.get('trade_status'), response.get('trade_no'))
+
+    # 40004：交易还没有创建（用户还没有打开支付页面）
+    return PENDING
+
+
+def poll(order_id, redis_conn=None):
+    """celery任务查询一次支付结果，已经收到异步通知时不再请求支付宝，返回支付状态，订单不存在时返回None"""
+    if redis_conn is None:
+        redis_conn = get_redis_connection('default')
+
+    status = get_status(redis_conn, order_id)
+    if status is not None and status['status'] != PENDING:
+        return status['status']
+
+    try:
+        order = OrderInfo.objects.get(order_id=order_id, pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
+    except OrderInfo.DoesNotExist:
+        return None
+
+    if order.status != OrderInfo.ORDER_STATUS_ENUM['UNPAID']:
+        set_status(redis_conn, order_id, order.user_id, PAID)
+        return PAID
+
+    return query(redis_conn, order)
+
+
+def verify_notify(data):
+    """验证异步通知的签名，返回通知的参数，验证失败时返回None"""
+    data = dict(data)
+    signature = data.pop('sign', None)
+    if not signature:
+        return None
+
+    try:
+        verified = alipay_client().verify(dict(data), signature)
+    except Exception:
+        return None
+
+    if not verified or data.get('app_id') != settings.ALIPAY_APPID:
+        return None
+    return data
+
+
+def handle_notify(redis_conn, data):
+    """处理已经验证签名的异步通知，订单不存在或者金额不一致时返回False"""
+    try:
+        order = OrderInfo.objects.get(order_id=data.get('out_trade_no'),
+                                      pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
+    except OrderInfo.DoesNotExist:
+        return False
+
+    try:
+        total_amount = Decimal(data.get('total_amount'))
+    except (TypeError, InvalidOperation):
+        return False
+    if total_amount != order.total_amount:
+        return False
+
+    apply_trade(redis_conn, order, data.get('trade_status'), data.get('trade_no'))
+    return True
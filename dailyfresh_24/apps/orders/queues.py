@@ -0,0 +1,85 @@
+"""redis中等待写入MySQL的订单队列的消费者，秒杀(orders.flash_sale)和异步下单(orders.checkout)共用
+
+每个队列有三个key：
+<queue>         list，等待处理的订单（json）
+<processing>    list，正在处理的订单，任务中断时下一次重新处理
+<lock>          同一个队列同时只有一个任务在处理，value是持有者的随机标识
+
+任务持有锁，每次从队列中取出一批订单放入处理中列表，处理完以后删除处理中列表；
+每一批之后延长锁，锁已经过期（被其他任务接手）时立即结束
+"""
+import json
+import time
+import uuid
+
+from utils.redis_scripts import get_script
+
+# 处理任务的锁的有效期（秒），任务中断时锁过期，下一次任务重新处理中断的订单
+LOCK_TTL = 60
+
+# 从队列中取出一批订单放入处理中列表 KEYS: 订单队列, 处理中列表  ARGV: 数量
+TAKE_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+return items
+"""
+
+# 延长锁的有效期，只延长自己持有的锁 KEYS: 锁  ARGV: 持有者, 有效期
+EXTEND_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# 释放锁，只释放自己持有的锁 KEYS: 锁  ARGV: 持有者
+UNLOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def consume(redis_conn, queue_key, processing_key, lock_key, process_batch, batch_size):
+    """按批处理队列中的订单，直到队列为空，返回 (成功的数量, 失败的数量)；其他任务正在处理时直接返回
+
+    process_batch(redis_conn, orders) 处理一批订单（json解析以后的字典），返回 (成功的数量, 失败的数量)，
+    需要能够重复处理同一批订单：已经写入的订单跳过
+    """
+    token = uuid.uuid4().hex
+    if not redis_conn.set(lock_key, token, nx=True, ex=LOCK_TTL):
+        return 0, 0
+
+    succeeded = failed = 0
+    started = time.time()
+    try:
+        # 上一次任务中断时留在处理中列表的订单，先重新处理
+        items = redis_conn.lrange(processing_key, 0, -1)
+        while True:
+            if not items:
+                items = get_script(redis_conn, TAKE_LUA)(keys=[queue_key, processing_key], args=[batch_size],
+                                                         client=redis_conn)
+            if not items:
+                break
+
+            ok, error = process_batch(redis_conn, [json.loads(item.decode()) for item in items])
+            succeeded += ok
+            failed += error
+
+            # 锁已经过期时，处理中列表可能已经被其他任务接手，不再删除，直接结束
+            if not get_script(redis_conn, EXTEND_LUA)(keys=[lock_key], args=[token, LOCK_TTL], client=redis_conn):
+                break
+            redis_conn.delete(processing_key)
+            items = None
+
+            # 每个任务最多执行LOCK_TTL / 2，剩下的订单留给下一次任务
+            if time.time() - started > LOCK_TTL / 2:
+                break
+    finally:
+        get_script(redis_conn, UNLOCK_LUA)(keys=[lock_key], args=[token], client=redis_conn)
+
+    return succeeded, failed
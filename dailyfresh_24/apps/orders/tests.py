@@ -1,3 +1,289 @@
+import base64
+import json
+import os
+import tempfile
+import threading
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from urllib.parse import parse_qsl, urlparse
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from goods import snapshots
+from orders import checkout, flash_sale, order_counts, payment
+from orders.models import OrderInfo, OrderGoods
+from orders.views import AlipayNotifyView, CheckPayView, UserOrderView
+from users.models import User, Address
+from utils.testing import RedisTestMixin, create_skus
 
 # Create your tests here.
+
+
+def create_order_fixtures(username, orders=1, lines=1):
+    """创建用户、地址、商品和待支付的支付宝订单，返回 (用户, 订单列表)"""
+    user = User.objects.create(username=username)
+    address = Address.objects.create(user=user, receive_name='测试', receive_mobile='13800000000',
+                                     detail_addr='测试地址', zip_code='100000')
+    skus = create_skus(lines)
+
+    order_list = [OrderInfo(order_id='%s_%s' % (username, i), user=user, address=address, total_count=lines,
+                            total_amount=Decimal('10.00') * lines + 10, trans_cost=Decimal('10.00'),
+                            pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY'])
+                  for i in range(orders)]
+    OrderInfo.objects.bulk_create(order_list)
+    OrderGoods.objects.bulk_create([OrderGoods(order=order, sku=sku, count=1, price=sku.price)
+                                    for order in order_list for sku in skus])
+    return user, order_list
+
+
+class OrderQueriesTest(RedisTestMixin, TestCase):
+    """渲染用户订单页面，检查数据库查询次数，防止订单页面退化成每个订单、每个商品查询一次"""
+
+    # 订单、订单商品、商品各一次查询
+    MAX_QUERIES = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.orders = create_order_fixtures('order_queries', orders=9, lines=3)
+
+    def render(self, page):
+        """渲染订单页面，返回数据库查询次数"""
+        request = RequestFactory().get(reverse('orders:info', kwargs={'page': page}))
+        request.user = self.user
+
+        with CaptureQueriesContext(connection) as queries:
+            response = UserOrderView.as_view()(request, page=str(page))
+
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_count_cache_miss(self):
+        """订单数量缓存失效时，多一次COUNT查询"""
+        order_counts.invalidate([self.user.id])
+        self.assertLessEqual(self.render(1), self.MAX_QUERIES + 1)
+
+    def test_queries_independent_of_page(self):
+        """订单数量缓存命中时，第一页和最后一页的查询次数相同，和用户的订单总数无关"""
+        self.render(1)
+        self.assertLessEqual(self.render(1), self.MAX_QUERIES)
+        self.assertLessEqual(self.render((len(self.orders) + 1) // 2), self.MAX_QUERIES)
+
+
+class FakeGateway(object):
+    """本地模拟的支付宝网关：实现交易查询接口（alipay.trade.query），生成签名的异步通知
+
+    使用应用自己的私钥签名，测试期间支付宝公钥换成这个私钥对应的公钥
+    """
+
+    def __init__(self, private_key):
+        self.private_key = private_key
+        # 交易 {out_trade_no: (trade_no, trade_status)}
+        self.trades = {}
+        self.queries = 0
+
+    def sign(self, message):
+        signer = PKCS1_v1_5.new(self.private_key)
+        return base64.b64encode(signer.sign(SHA256.new(message.encode()))).decode()
+
+    def query_response(self, params):
+        """交易查询接口的响应，签名的是alipay_trade_query_response的json原文"""
+        self.queries += 1
+        out_trade_no = json.loads(params['biz_content'])['out_trade_no']
+        trade = self.trades.get(out_trade_no)
+        if trade is None:
+            result = {'code': '40004', 'msg': 'Business Failed', 'sub_code': 'ACQ.TRADE_NOT_EXIST'}
+        else:
+            result = {'code': '10000', 'msg': 'Success', 'out_trade_no': out_trade_no,
+                      'trade_no': trade[0], 'trade_status': trade[1]}
+        body = json.dumps(result)
+        return '{"alipay_trade_query_response":%s,"sign":"%s"}' % (body, self.sign(body))
+
+    def notify_data(self, order, trade_status, total_amount=None):
+        """异步通知的参数，按照参数名排序拼接以后签名，sign和sign_type不参与签名"""
+        data = {
+            'app_id': settings.ALIPAY_APPID,
+            'out_trade_no': order.order_id,
+            'trade_no': 'FAKE%s' % order.order_id,
+            'trade_status': trade_status,
+            'total_amount': str(order.total_amount if total_amount is None else total_amount),
+        }
+        message = '&'.join('%s=%s' % (key, data[key]) for key in sorted(data))
+        data['sign'] = self.sign(message)
+        data['sign_type'] = 'RSA2'
+        return data
+
+    def serve(self):
+        """在后台线程中启动http服务，返回 (服务, 网关地址)"""
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond(dict(parse_qsl(urlparse(self.path).query)))
+
+            def do_POST(self):
+                params = dict(parse_qsl(urlparse(self.path).query))
+                length = int(self.headers.get('Content-Length') or 0)
+                params.update(parse_qsl(self.rfile.read(length).decode()))
+                self.respond(params)
+
+            def respond(self, params):
+                body = gateway.query_response(params).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json;charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, 'http://127.0.0.1:%s/gateway.do' % server.server_port
+
+
+class PaymentFlowTest(RedisTestMixin, TestCase):
+    """使用本地模拟的支付宝网关测试支付流程：查询支付结果、异步通知验签、查询支付状态的接口"""
+
+    @classmethod
+    def setUpClass(cls):
+        super(PaymentFlowTest, cls).setUpClass()
+        with open(settings.APP_PRIVATE_KEY_PATH) as file:
+            private_key = RSA.importKey(file.read())
+        public_key_file = tempfile.NamedTemporaryFile('wb', suffix='.pem', delete=False)
+        public_key_file.write(private_key.publickey().exportKey())
+        public_key_file.close()
+        cls.public_key_path = public_key_file.name
+        cls.gateway = FakeGateway(private_key)
+        cls.server, cls.gateway_url = cls.gateway.serve()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        os.remove(cls.public_key_path)
+        super(PaymentFlowTest, cls).tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, orders = create_order_fixtures('payment')
+        cls.order = orders[0]
+
+    def setUp(self):
+        super(PaymentFlowTest, self).setUp()
+        self.gateway.trades.clear()
+        self.gateway_settings = override_settings(ALIPAY_GATEWAY=self.gateway_url,
+                                                  ALIPAY_PUBLIC_KEY_PATH=self.public_key_path)
+        self.gateway_settings.enable()
+        # 不发送真正的celery任务
+        self.poll_payment = mock.patch('orders.views.poll_payment').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.gateway_settings.disable()
+        super(PaymentFlowTest, self).tearDown()
+
+    def notify(self, data):
+        """发送异步通知，返回响应的内容"""
+        request = RequestFactory().post(reverse('orders:pay_notify'), data)
+        return AlipayNotifyView.as_view()(request).content.decode()
+
+    def check_pay(self):
+        """请求查询支付状态的接口，返回code"""
+        request = RequestFactory().get(reverse('orders:checkpay'), {'order_id': self.order.order_id})
+        request.user = self.user
+        response = CheckPayView.as_view()(request)
+        return json.loads(response.content.decode())['code']
+
+    def assertPaid(self, paid):
+        """检查数据库和redis中的支付状态"""
+        order = OrderInfo.objects.get(order_id=self.order.order_id)
+        if paid:
+            self.assertEqual(order.status, OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT'])
+            status = payment.get_status(self.redis_conn, self.order.order_id)
+            self.assertEqual(status and status['status'], payment.PAID)
+        else:
+            self.assertEqual(order.status, OrderInfo.ORDER_STATUS_ENUM['UNPAID'])
+
+    def test_query(self):
+        """没有异步通知时，查询支付宝得到支付结果"""
+        order_id = self.order.order_id
+        self.assertEqual(payment.poll(order_id, self.redis_conn), payment.PENDING)
+
+        self.gateway.trades[order_id] = ('FAKE%s' % order_id, 'WAIT_BUYER_PAY')
+        self.assertEqual(payment.poll(order_id, self.redis_conn), payment.PENDING)
+        self.assertEqual(self.check_pay(), 5)
+        self.assertTrue(self.poll_payment.apply_async.called)
+
+        self.gateway.trades[order_id] = ('FAKE%s' % order_id, 'TRADE_SUCCESS')
+        self.assertEqual(payment.poll(order_id, self.redis_conn), payment.PAID)
+        self.assertPaid(True)
+
+        # 已经有支付结果以后不再请求支付宝
+        queries = self.gateway.queries
+        payment.poll(order_id, self.redis_conn)
+        self.assertEqual(self.gateway.queries, queries)
+        self.assertEqual(self.check_pay(), 0)
+
+    def test_notify(self):
+        """异步通知：验证签名、金额，修改订单状态，重复的通知只修改一次"""
+        data = self.gateway.notify_data(self.order, 'TRADE_SUCCESS')
+        data['sign'] = self.gateway.notify_data(self.order, 'TRADE_CLOSED')['sign']
+        self.assertEqual(self.notify(data), 'failure')
+        self.assertPaid(False)
+
+        data = self.gateway.notify_data(self.order, 'TRADE_SUCCESS', total_amount=self.order.total_amount + 1)
+        self.assertEqual(self.notify(data), 'failure')
+        self.assertPaid(False)
+
+        data = self.gateway.notify_data(self.order, 'TRADE_SUCCESS')
+        self.assertEqual(self.notify(data), 'success')
+        self.assertPaid(True)
+        self.assertEqual(self.notify(data), 'success')
+        self.assertEqual(self.check_pay(), 0)
+
+    def test_pending_does_not_wake_waiters(self):
+        """等待支付时不放入通知，查询接口不会立即返回；支付完成时才唤醒"""
+        order_id = self.order.order_id
+        payment.set_status(self.redis_conn, order_id, self.user.id, payment.PENDING)
+        self.assertEqual(self.redis_conn.llen(payment.NOTIFY_KEY % order_id), 0)
+
+        payment.set_status(self.redis_conn, order_id, self.user.id, payment.PAID)
+        self.assertEqual(self.redis_conn.llen(payment.NOTIFY_KEY % order_id), 1)
+
+
+class FlashSaleTest(RedisTestMixin, TestCase):
+    """秒杀订单写入MySQL"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, orders = create_order_fixtures('flash_sale')
+        cls.address = orders[0].address
+        cls.sku = orders[0].ordergoods_set.get().sku
+
+    def reserve(self, order_id, price):
+        """按照快照下单，快照中的价格是price"""
+        sku = snapshots.get(self.sku.id)
+        sku.count = 1
+        sku.price = price
+        reserved, schedule = flash_sale.reserve(self.redis_conn, order_id, self.user.id, self.address.id,
+                                                OrderInfo.PAY_METHODS_ENUM['ALIPAY'], [sku])
+        self.assertTrue(reserved)
+
+    def test_price_from_mysql(self):
+        """快照中的价格过期时，按照MySQL中当前的价格写入订单"""
+        flash_sale.start([self.sku.id], self.redis_conn)
+        self.reserve('flash_sale_new', Decimal('1.00'))
+
+        self.assertEqual(flash_sale.persist(self.redis_conn), (1, 0))
+        order = OrderInfo.objects.get(order_id='flash_sale_new')
+        self.assertEqual(order.ordergoods_set.get().price, self.sku.price)
+        self.assertEqual(order.total_amount, self.sku.price + checkout.TRANS_COST)
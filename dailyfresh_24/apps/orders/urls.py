@@ -1,4 +1,5 @@
 from django.conf.urls import url
+from django.views.decorators.csrf import csrf_exempt
 from orders import views
 
 
@@ -10,13 +11,19 @@ urlpatterns = [
     # 订单提交
     url(r'^commit$', views.CommitOrderView.as_view(), name='commit'),
 
+    # 异步下单的结果 http://127.0.0.1:8000/orders/commit/status?ticket=排队号
+    url(r'^commit/status$', views.CommitStatusView.as_view(), name='commit_status'),
+
     # 全部订单
     url(r'^(?P<page>\d+)$', views.UserOrderView.as_view(), name='info'),
 
     # 支付宝支付
     url(r'^pay$', views.PayView.as_view(), name='pay'),
 
-    # 订单状态
+    # 支付宝异步通知，支付宝的请求没有csrf token
+    url(r'^pay/notify$', csrf_exempt(views.AlipayNotifyView.as_view()), name='pay_notify'),
+
+    # 支付结果（轮询）
     url(r'^checkpay$', views.CheckPayView.as_view(), name='checkpay'),
 
     # 评论页
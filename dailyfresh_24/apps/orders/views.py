@@ -1,16 +1,23 @@
+import copy
+
 from django.shortcuts import render, redirect
 from django.views.generic import View
 from utils.views import LoginRequiredMixin, LoginRequiredJSONMixin, TransactionAtomicMiXin
+from utils.transactions import after_commit
 from django.core.urlresolvers import reverse
 from goods.models import GoodsSKU
+from goods import snapshots
+from goods.contexts import clear_detail_context
+from goods import last_modified, reviews, stock
+from cart import operations
 from django_redis import get_redis_connection
 from users.models import Address
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from orders.models import OrderGoods, OrderInfo
-from django.utils import timezone
+from orders import checkout, flash_sale, order_counts, order_ids, payment
+from celery_tasks.tasks import persist_flash_orders, poll_payment, process_checkout_shard
 from django.db import transaction
 from django.core.paginator import Paginator, EmptyPage
-from alipay import AliPay
 from django.conf import settings
 # Create your views here.
 
@@ -49,6 +56,9 @@ class CommentView(LoginRequiredMixin, View):
         total_count = request.POST.get('total_count')
         total_count = int(total_count)
 
+        # 记录评论过的商品
+        comment_sku_ids = []
+
         for i in range(1, total_count + 1):
             sku_id = request.POST.get('sku_%d' % i)
             content = request.POST.get('content_%d' % i, '')
@@ -61,6 +71,15 @@ class CommentView(LoginRequiredMixin, View):
             order_goods.comment = content
             order_goods.save()
 
+            comment_sku_ids.append(order_goods.sku_id)
+
+        # 刷新商品的评论数量和最新评论
+        reviews.refresh(comment_sku_ids)
+
+        # 评论展示在商品详情页中，删除详情页缓存
+        clear_detail_context(comment_sku_ids)
+        last_modified.touch_details(comment_sku_ids)
+
         order.status = OrderInfo.ORDER_STATUS_ENUM['FINISHED']
 
         order.save()
@@ -69,54 +88,61 @@ class CommentView(LoginRequiredMixin, View):
 
 
 class CheckPayView(LoginRequiredJSONMixin, View):
-    """对接支付宝查询的接口"""
+    """查询支付结果的接口，浏览器间隔几秒轮询"""
     def get(self, request):
-        """查询订单状态，保存支付宝返回的支付宝维护的订单id（trade_id），修改订单的状态为待评价"""
+        """读取redis中的支付状态，还在等待支付时最多等待payment.LONG_POLL_TIMEOUT秒，不请求支付宝
+
+        支付结果由支付宝异步通知AlipayNotifyView和celery任务poll_payment写入
+        """
 
         # 接收订单的id
         order_id = request.GET.get('order_id')
         # 校验order_id
         if not order_id:
             return JsonResponse({'code': 2,'message': '缺少订单id'})
-        try:
-            order = OrderInfo.objects.get(order_id=order_id,
-                                          user=request.user,
-                                          status=OrderInfo.ORDER_STATUS_ENUM['UNPAID'],
-                                          pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY']
-                                          )
-        except OrderInfo.DoesNotExist:
-            return JsonResponse({'code': 3, 'message':'订单不存在'})
-
-        # 创建alipay对象
-        alipay = AliPay(
-            appid=settings.ALIPAY_APPID,
-            app_notify_url=None,
-            app_private_key_path=settings.APP_PRIVATE_KEY_PATH,
-            alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH,
-            sign_type="RSA2",
-            debug=True
-        )
-        while True:
-            # 调用查询接口
-            response = alipay.api_alipay_trade_query(order_id)
-
-            # 读取code.trade_status,判断订单状态
-            code = response.get('code')
-            trade_status = response.get('trade_status')
-
-            # 判断订单状态
-            if code == '10000' and trade_status == 'TRADE_SUCCESS':
-                order.trade_id = response.get('trade_no')
-                order.status = OrderInfo.ORDER_STATUS_ENUM['UNCOMMENT']
-                order.save()
-
-                return JsonResponse({'code': 0,'message': '支付成功'})
-
-            elif code == '40004' or (code == '10000' and trade_status == 'WAIT_BUYER_PAY'):
-                continue
 
-            else:
-                return JsonResponse({'code': 4,'message': '支付失败'})
+        redis_conn = get_redis_connection('default')
+        status = payment.get_status(redis_conn, order_id)
+        if status is None or status['user_id'] != request.user.id:
+            # redis中没有支付状态（已经过期或者不是这个用户的订单），查询数据库
+            try:
+                order = OrderInfo.objects.get(order_id=order_id,
+                                              user=request.user,
+                                              pay_method=OrderInfo.PAY_METHODS_ENUM['ALIPAY']
+                                              )
+            except OrderInfo.DoesNotExist:
+                return JsonResponse({'code': 3, 'message':'订单不存在'})
+
+            if order.status != OrderInfo.ORDER_STATUS_ENUM['UNPAID']:
+                return JsonResponse({'code': 0, 'message': '支付成功'})
+
+            payment.set_status(redis_conn, order_id, request.user.id, payment.PENDING)
+            if payment.start_polling(redis_conn, order_id):
+                poll_payment.apply_async((order_id, 0), countdown=payment.poll_delay(0))
+
+        status = payment.wait_status(redis_conn, order_id)
+        if status is None or status['status'] == payment.PENDING:
+            # 浏览器收到以后继续查询
+            return JsonResponse({'code': 5, 'message': '等待支付'})
+        elif status['status'] == payment.PAID:
+            return JsonResponse({'code': 0,'message': '支付成功'})
+        else:
+            return JsonResponse({'code': 4,'message': '支付失败'})
+
+
+class AlipayNotifyView(View):
+    """支付宝异步通知"""
+    def post(self, request):
+        """验证签名，修改订单状态，处理成功时响应success，否则支付宝会重新通知"""
+        data = payment.verify_notify(request.POST.dict())
+        if data is None:
+            return HttpResponse('failure')
+
+        redis_conn = get_redis_connection('default')
+        if not payment.handle_notify(redis_conn, data):
+            return HttpResponse('failure')
+
+        return HttpResponse('success')
 
 
 class PayView(LoginRequiredJSONMixin, View):
@@ -140,24 +166,15 @@ class PayView(LoginRequiredJSONMixin, View):
         except OrderInfo.DoesNotExist:
             return JsonResponse({'code': 3, 'message': '订单不存在'})
 
-        # 创建alipay对象
-        alipay = AliPay(
-            appid=settings.ALIPAY_APPID,
-            app_notify_url=None,
-            app_private_key_path=settings.APP_PRIVATE_KEY_PATH,
-            alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH,
-            sign_type="RSA2",
-            debug=True
-        )
-
-        # 调用支付宝的支付接口
-        order_string = alipay.api_alipay_trade_page_pay(
-            out_trade_no=order_id,
-            total_amount=str(order.total_amount),
-            subject='天天生鲜',
-            return_url=None,
-            notify_url=None
-        )
+        # 调用支付宝的支付接口，支付完成后支付宝异步通知notify_url
+        # 进程内共享支付宝客户端，重复点击支付时使用缓存的签名
+        order_string = payment.page_pay_string(order)
+
+        # 等待支付结果：没有收到异步通知时由celery查询支付宝
+        redis_conn = get_redis_connection('default')
+        payment.set_status(redis_conn, order_id, request.user.id, payment.PENDING)
+        if payment.start_polling(redis_conn, order_id):
+            poll_payment.apply_async((order_id, 0), countdown=payment.poll_delay(0))
 
         # 生成打开支付宝的url
         url = settings.ALIPAY_URL + "?" + order_string
@@ -166,6 +183,18 @@ class PayView(LoginRequiredJSONMixin, View):
         return JsonResponse({'code':0, 'message':'支付成功', 'url':url})
 
 
+class CountedPaginator(Paginator):
+    """总数由调用者提供（例如缓存的数量），分页时不再查询COUNT(*)"""
+
+    def __init__(self, object_list, per_page, count):
+        super(CountedPaginator, self).__init__(object_list, per_page)
+        self._known_count = count
+
+    @property
+    def count(self):
+        return self._known_count
+
+
 class UserOrderView(LoginRequiredMixin, View):
     """用户订单页面"""
 
@@ -174,12 +203,23 @@ class UserOrderView(LoginRequiredMixin, View):
 
         user = request.user
 
-        # 查询所有订单数据
+        # 查询订单数据：先在数据库中分页，只查询当前页的订单，再一次查询出这些订单的商品
+        # 查询次数只和每页的订单数量有关，和用户的订单总数无关
+        orders = user.orderinfo_set.all().order_by('-create_time').prefetch_related('ordergoods_set__sku')
 
-        orders = user.orderinfo_set.all().order_by('-create_time')
+        # 分页，订单总数使用缓存
+        page = int(page)
+        paginator = CountedPaginator(orders, 2, order_counts.get_count(user.id))
+
+        try:
+            page_orders = paginator.page(page)
+        except EmptyPage:
+            # 如果传入的页数不存在，就默认给第一页
+            page_orders = paginator.page(1)
+            page = 1
 
-        # 遍历所有的订单
-        for order in orders:
+        # 遍历当前页的订单
+        for order in page_orders:
 
             # 给订单动态绑定：订单状态
             order.status_name = OrderInfo.ORDER_STATUS[order.status]
@@ -189,27 +229,14 @@ class UserOrderView(LoginRequiredMixin, View):
 
             order.skus = []
 
-            # 查询订单中所有的商品
-            order_skus = order.ordergoods_set.all()
-
-            # 遍历订单中所有的商品
-            for order_sku in order_skus:
-                sku = order_sku.sku
+            # 遍历订单中所有的商品（已经预先查询）
+            for order_sku in order.ordergoods_set.all():
+                # 预先查询的商品在多个订单中是同一个对象，复制以后再绑定数量
+                sku = copy.copy(order_sku.sku)
                 sku.count = order_sku.count
                 sku.amount = sku.price * sku.count
                 order.skus.append(sku)
 
-        # 分页
-        page = int(page)
-
-        try:
-            paginator = Paginator(orders, 2)
-            page_orders = paginator.page(page)
-        except EmptyPage:
-            # 如果传入的页数不存在，就默认给第一页
-            page_orders = paginator.page(1)
-            page = 1
-
         # 页数
         page_list = paginator.page_range
 
@@ -224,6 +251,43 @@ class UserOrderView(LoginRequiredMixin, View):
         return render(request, 'user_center_order.html', context)
 
 
+class CommitStatusView(LoginRequiredJSONMixin, View):
+    """异步下单、秒杀下单的结果"""
+    def get(self, request):
+        """根据排队号（异步下单）或者订单号（秒杀下单）查询订单是否已经创建"""
+        redis_conn = get_redis_connection('default')
+
+        order_id = request.GET.get('order_id')
+        if order_id:
+            return self.flash_sale_status(redis_conn, request.user, order_id)
+
+        ticket = request.GET.get('ticket')
+        if not ticket:
+            return JsonResponse({'code': 2, 'message': '缺少排队号'})
+
+        result = checkout.ticket_status(redis_conn, ticket)
+        if result is None or result['user_id'] != request.user.id:
+            return JsonResponse({'code': 3, 'message': '排队号不存在'})
+
+        if result['status'] == 'queued':
+            return JsonResponse({'code': 0, 'message': '订单排队中', 'status': 'queued'})
+
+        return JsonResponse({'code': result['code'], 'message': result['message'], 'status': result['status'],
+                             'order_id': result['order_id']})
+
+    def flash_sale_status(self, redis_conn, user, order_id):
+        """秒杀订单写入MySQL的结果，写入失败时商品已经放回购物车"""
+        result = flash_sale.order_status(redis_conn, order_id)
+        if result is None or result['user_id'] != user.id:
+            return JsonResponse({'code': 3, 'message': '订单不存在'})
+
+        if result['status'] == 'pending':
+            return JsonResponse({'code': 0, 'message': '订单排队中', 'status': 'queued'})
+        if result['status'] == 'failed':
+            return JsonResponse({'code': 6, 'message': '库存不足', 'status': 'failed', 'order_id': order_id})
+        return JsonResponse({'code': 0, 'message': '下单成功', 'status': 'success', 'order_id': order_id})
+
+
 class CommitOrderView(LoginRequiredJSONMixin, TransactionAtomicMiXin, View):
     """订单提交"""
     def post(self, request):
@@ -256,99 +320,43 @@ class CommitOrderView(LoginRequiredJSONMixin, TransactionAtomicMiXin, View):
         # 操作redis
         redis_conn = get_redis_connection('default')
 
-        # 手动生成order_id
-        order_id = timezone.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+        # 截取出sku_ids列表，按照id排序：所有请求都按照相同的顺序锁定商品行，避免死锁
+        try:
+            sku_ids = sorted(set(int(sku_id) for sku_id in sku_ids.split(',')))
+        except ValueError:
+            return JsonResponse({'code': 5, 'message': '商品不存在'})
+
+        # 一次查询出所有商品的数量和参加秒杀的商品(redis)
+        pipe = redis_conn.pipeline()
+        pipe.hmget(operations.cart_key(user.id), sku_ids)
+        pipe.smembers(flash_sale.SKUS_KEY)
+        counts, flash_ids = pipe.execute()
+        if None in counts:
+            return JsonResponse({'code': 5, 'message': '商品不在购物车中'})
+        counts = [int(count) for count in counts]
+
+        # 秒杀商品在redis中扣减库存，异步写入MySQL
+        flash_ids = set(int(sku_id) for sku_id in flash_ids)
+        if flash_ids & set(sku_ids):
+            if not flash_ids.issuperset(sku_ids):
+                return JsonResponse({'code': 9, 'message': '秒杀商品需要单独下单'})
+            return self.commit_flash_sale(redis_conn, user, address, pay_method, sku_ids, counts)
+
+        # 生成order_id：时间有序，同一个用户同一秒多次下单、多个进程同时下单都不会重复
+        order_id = order_ids.new_order_id()
+
+        # 异步下单：只做简单的校验，订单放入队列，不占用web进程等待数据库
+        if getattr(settings, 'ASYNC_CHECKOUT', False):
+            return self.commit_async(redis_conn, user, address, pay_method, sku_ids, counts, order_id)
 
         # 在操作数据库前创建事务保存点
         save_point = transaction.savepoint()
 
         try:
-            # 创建OrederInfo
-            order = OrderInfo.objects.create(
-                order_id=order_id,
-                user=user,
-                address=address,
-                total_amount=0,
-                trans_cost=10,
-                pay_method=pay_method,
-            )
-
-            # 截取出sku_ids列表
-            sku_ids = sku_ids.split(',')
-
-            # 定义临时变量
-            total_count = 0
-            total_sku_amount = 0
-
-            # 遍历sku_ids
-            for sku_id in sku_ids:
-                # 循环取出sku，判断商品是否存在
-                for i in range(3):
-                    try:
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except GoodsSKU.DoesNotExist:
-
-                        # 回滚异常
-                        transaction.savepoint_rollback(save_point)
-
-                        return JsonResponse({'code': 5, 'message': '商品不存在'})
-
-                    # 获取商品数量，判断库存(redis)
-                    sku_count = redis_conn.hget('cart_%s' % user.id, sku_id)
-                    sku_count = int(sku_count)
-
-                    # 验证库存
-                    if sku_count > sku.stock:
-
-                        # 回滚异常
-                        transaction.savepoint_rollback(save_point)
-
-                        return JsonResponse({'code': 6, 'message': '库存不足'})
-
-                    # 计算小计
-                    amount = sku_count * sku.price
-
-                    # 减少sku库存
-                    # sku.stock -= sku_count
-
-                    # 增加sku销量
-                    # sku.sales += sku_count
-                    # sku.save()
-
-                    # 减少库存,增加销量
-                    origin_stock = sku.stock
-                    new_stock = origin_stock - sku_count
-                    new_sales = sku.sales + sku_count
-
-                    # 更新库存和销量
-                    result = GoodsSKU.objects.filter(id=sku_id, stock=origin_stock).update(stock=new_stock,sales=new_sales)
-                    if 0 == result and i < 2:
-                        continue
-                    elif 0 == result and i == 2:
-                        transaction.savepoint_rollback(save_point)
-                        return JsonResponse({'code': 8,'message': '下单失败'})
-
-                    # 保存订单商品数据OrderGoods(能执行到这里说明无异常)
-                    # 先创建商品订单信息
-                    OrderGoods.objects.create(
-                        order=order,
-                        sku=sku,
-                        count=sku_count,
-                        price=sku.price
-                    )
-
-                    # 计算总数和总金额
-                    total_count += sku_count
-                    total_sku_amount += amount
-
-                    # 下单成功，跳出循环
-                    break
-
-            # 修改订单信息里面的总数和总金额(OrderInfo)
-            order.total_count = total_count
-            order.total_amount = total_sku_amount + 10
-            order.save()
-
+            sales = checkout.create_order(order_id, user.id, address.id, pay_method, sku_ids, counts)
+        except checkout.CheckoutError as e:
+            transaction.savepoint_rollback(save_point)
+            return JsonResponse({'code': e.code, 'message': e.message})
         except Exception:
             transaction.savepoint_rollback(save_point)
             return JsonResponse({'code': 7, 'message': '下单失败'})
@@ -356,16 +364,66 @@ class CommitOrderView(LoginRequiredJSONMixin, TransactionAtomicMiXin, View):
         # 没有异常，就手动提交
         transaction.savepoint_commit(save_point)
 
+        # 同步商品快照、库存镜像和销量排行：等到视图的事务提交以后，
+        # 否则其他请求可能在提交之前读到旧的库存和销量，重新写入缓存
+        after_commit(checkout.order_created, redis_conn, sales)
+        after_commit(order_counts.invalidate, [user.id])
 
         # 订单生成后删除购物车(hdel)
         # for sku_id in sku_ids:
         #     redis_conn.hdel('cart_%s' % user.id, sku_id)
 
-        redis_conn.hdel('cart_%s' % user.id, *sku_ids)
+        after_commit(operations.remove, redis_conn, user.id, sku_ids)
 
         # 响应结果
         return JsonResponse({'code': 0, 'message': '下单成功'})
 
+    def commit_async(self, redis_conn, user, address, pay_method, sku_ids, counts, order_id):
+        """异步下单：商品和库存只在redis中校验，订单按商品分片放入队列，立即返回排队号"""
+        sku_dict = snapshots.get_many(sku_ids)
+        if len(sku_dict) != len(sku_ids):
+            return JsonResponse({'code': 5, 'message': '商品不存在'})
+
+        # 库存镜像明显不足时直接返回，最终以创建订单时数据库中的库存为准
+        stocks = stock.get_many(sku_ids, redis_conn)
+        for sku_id, sku_count in zip(sku_ids, counts):
+            if stocks.get(sku_id, 0) < sku_count:
+                return JsonResponse({'code': 6, 'message': '库存不足'})
+
+        ticket, shard, schedule = checkout.enqueue(redis_conn, order_id, user.id, address.id, pay_method,
+                                                   sku_ids, counts)
+        if schedule:
+            process_checkout_shard.delay(shard)
+
+        # 下单失败时商品会放回购物车
+        operations.remove(redis_conn, user.id, sku_ids)
+
+        return JsonResponse({'code': 0, 'message': '订单排队中', 'ticket': ticket, 'pending': True})
+
+    def commit_flash_sale(self, redis_conn, user, address, pay_method, sku_ids, counts):
+        """秒杀下单：一次Lua脚本扣减redis中的库存并且订单入队，不操作MySQL，订单由celery批量写入"""
+        sku_dict = snapshots.get_many(sku_ids)
+        if len(sku_dict) != len(sku_ids):
+            return JsonResponse({'code': 5, 'message': '商品不存在'})
+
+        skus = []
+        for sku_id, sku_count in zip(sku_ids, counts):
+            sku = sku_dict[sku_id]
+            sku.count = sku_count
+            skus.append(sku)
+
+        order_id = order_ids.new_order_id()
+        reserved, schedule = flash_sale.reserve(redis_conn, order_id, user.id, address.id, pay_method, skus)
+        if not reserved:
+            return JsonResponse({'code': 6, 'message': '库存不足'})
+        if schedule:
+            persist_flash_orders.delay()
+
+        operations.remove(redis_conn, user.id, sku_ids)
+
+        # 订单写入MySQL以后才会出现在用户订单中
+        return JsonResponse({'code': 0, 'message': '下单成功', 'order_id': order_id, 'pending': True})
+
 
 class PlaceOrderView(LoginRequiredMixin, View):
     """订单确认"""
@@ -381,6 +439,11 @@ class PlaceOrderView(LoginRequiredMixin, View):
         if not sku_ids:
             return redirect(reverse('cart:info'))
 
+        # 一次查询出所有的商品
+        sku_dict = snapshots.get_many(sku_ids)
+        if len(sku_dict) != len(set(sku_ids)):
+            return redirect(reverse('cart:info'))
+
         # 商品的数量从redis中获取
         redis_conn = get_redis_connection('default')
         user_id = request.user.id
@@ -389,17 +452,16 @@ class PlaceOrderView(LoginRequiredMixin, View):
         skus = []
         total_count = 0
         total_sku_amount = 0
-        trans_cost = 10
+        trans_cost = checkout.TRANS_COST
         # 校验count参数：用于区分用户是从哪进入订单确认页面的
         if count is None:
             # 如果是从购物车页面过来的
-            cart_dict = redis_conn.hgetall('cart_%s' % user_id)
+            cart_dict = operations.get_cart(redis_conn, user_id)
 
             # 查询商品数据
             for sku_id in sku_ids:
-                try:
-                    sku = GoodsSKU.objects.get(id=sku_id)
-                except GoodsSKU.DoesNotExist:
+                sku = sku_dict.get(int(sku_id))
+                if sku is None:
                     return redirect(reverse('cart:info'))
 
                 sku_count = cart_dict[sku_id.encode()]
@@ -423,9 +485,8 @@ class PlaceOrderView(LoginRequiredMixin, View):
             # 如果是从商品详情页面请求过来的
             # 查询商品数据
             for sku_id in sku_ids:
-                try:
-                    sku = GoodsSKU.objects.get(id=sku_id)
-                except GoodsSKU.DoesNotExist:
+                sku = sku_dict.get(int(sku_id))
+                if sku is None:
                     return redirect(reverse('cart:info'))
 
                 # 商品的数量是从request中获取，并try校验
@@ -434,8 +495,9 @@ class PlaceOrderView(LoginRequiredMixin, View):
                 except Exception:
                     return redirect(reverse('goods:detail', args=(sku_id,)))
 
-                # 判断库存
-                if sku_count > sku.stock:
+                # 当用户点击立即购买，进入该页面时，将商品存储到redis中，同时判断库存（redis的库存镜像）
+                success, sku_count, cart_num = operations.set_count(redis_conn, user_id, sku_id, sku_count, sku.stock)
+                if not success:
                     return redirect(reverse('goods:detail', args=(sku_id,)))
 
                 # 计算小计
@@ -449,9 +511,6 @@ class PlaceOrderView(LoginRequiredMixin, View):
                 total_count += sku_count
                 total_sku_amount += sku_amount
 
-                # 当用户点击立即购买，进入该页面时，将商品存储到redis中
-                redis_conn.hset('cart_%s' % user_id, sku_id, sku_count)
-
         # 计算实付款
         total_amount = trans_cost + total_sku_amount
 
@@ -29,4 +29,8 @@ class Address(BaseModel):
     zip_code = models.CharField(max_length=6, verbose_name="邮政编码")
 
     class Meta:
-        db_table = "df_address"
\ No newline at end of file
+        db_table = "df_address"
+        # 查询用户最新的地址
+        index_together = [
+            ('user', 'create_time'),
+        ]
\ No newline at end of file
@@ -12,7 +12,8 @@ from itsdangerous import SignatureExpired
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django_redis import get_redis_connection
-from goods.models import GoodsSKU
+from goods import snapshots
+from cart import archive, operations, owners
 from utils.views import LoginRequiredMixin
 import json
 
@@ -34,15 +35,13 @@ class UserInfoView(LoginRequiredMixin, View):
 
         # 查询最近浏览
         redis_conn = get_redis_connection('default')
-        # 调用对应的方法，查询出redis列表中保持sku_id
-        sku_ids = redis_conn.lrange('history_%s' % user.id, 0, 4)
-        # 遍历sku_id
-        # 定义临时容器
-        sku_list = []
-        for sku_id in sku_ids:
-            # 查询出sku_id对应的GoodsSKU
-            sku = GoodsSKU.objects.get(id=sku_id)
-            sku_list.append(sku)
+        # 调用对应的方法，查询出redis列表中保持sku_id，同时重新计算过期时间
+        pipe = redis_conn.pipeline()
+        pipe.lrange('history_%s' % user.id, 0, 4)
+        pipe.expire('history_%s' % user.id, operations.USER_TTL)
+        sku_ids = pipe.execute()[0]
+        # 一次查询出所有sku_id对应的商品，保持浏览的先后顺序
+        sku_list = list(snapshots.get_many(sku_ids).values())
 
         # 构造上下文
         context = {
@@ -156,31 +155,27 @@ class LoginView(View):
         else:
             request.session.set_expiry(60*60*24*10) # 状态保持10天
 
-        # 在界面跳转之前，将cookie中的购物车信息合并到redis中
-        # 查询cookie中购物车信息
-        cart_json = request.COOKIES.get('cart')
-        if cart_json is not None:
-            cart_dict_cookie = json.loads(cart_json)
-        else:
-            cart_dict_cookie = {}
-
-        # 查询redis中的购物车信息
+        # 长时间没有使用、已经归档到数据库的购物车，恢复到redis中
         redis_conn = get_redis_connection('default')
-        cart_dict_redis = redis_conn.hgetall('cart_%s' % user.id)
-
-        # 遍历cart_dict_cookie，取出其中的sku_id和count信息，存储到redis中国
-        for sku_id, count in cart_dict_cookie.items():
-            # sku_id是字符串，count是int类型
-            sku_id = sku_id.encode()  # 将sku_id转bytes类型
-            if sku_id in cart_dict_redis:
-                orgin_count = cart_dict_redis[sku_id]
-                count += int(orgin_count)
-
-            # 保存合并数据到cart_dict_redis中
-            cart_dict_redis[sku_id] = count
-
-        if cart_dict_redis:
-            redis_conn.hmset('cart_%s' % user.id, cart_dict_redis)
+        archive.restore(redis_conn, user.id)
+
+        # 在界面跳转之前，将未登录时的购物车合并到用户的购物车中
+        # 只读取未登录时的购物车（通常只有几个商品），合并在redis中一次完成，数量不超过库存
+        token = owners.get_token(request)
+        if token is not None:
+            source = operations.anonymous_owner(token)
+            cart_dict = redis_conn.hgetall(operations.cart_key(source))
+            if cart_dict:
+                # 已经删除的商品库存当作0，不合并
+                sku_dict = snapshots.get_many(cart_dict.keys())
+                stocks = {}
+                for sku_id in cart_dict:
+                    sku = sku_dict.get(int(sku_id))
+                    stocks[int(sku_id)] = sku.stock if sku is not None else 0
+                operations.merge(redis_conn, source, user.id, stocks)
+
+        # 以前保存在cookie中的购物车直接合并到用户的购物车中，合并以后再删除cookie
+        owners.migrate_legacy(request, redis_conn)
 
         # 在界面跳转以前，需要判断用户登陆以后需要跳转的页面
         # 如果有next就跳转到next指向的地方，否则跳转到主页
@@ -196,7 +191,8 @@ class LoginView(View):
                 response = redirect(next)
 
         # 删除cookie
-        response.delete_cookie('cart')
+        response.delete_cookie(owners.COOKIE_NAME)
+        owners.set_cookie(request, response)
 
         return response
 
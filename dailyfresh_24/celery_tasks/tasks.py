@@ -1,7 +1,13 @@
-from celery import Celery
+from celery import Celery, group
+from datetime import timedelta
 from django.core.mail import send_mail
 from django.conf import settings
-from goods.models import GoodsCategory, Goods, GoodsSKU, IndexPromotionBanner, IndexGoodsBanner, IndexCategoryGoodsBanner
+from django_redis import get_redis_connection
+from goods.contexts import build_index_context
+from goods.models import GoodsSKU
+from goods import static_html, stock
+from cart import archive
+from orders import checkout, flash_sale, payment
 from django.template import loader
 import os
 
@@ -10,6 +16,32 @@ import os
 # 参数2"： 指定任务队列（borker）， 可以作为任务队列的有多种，此处以redis数据库为例
 celery_app = Celery('celery_tasks.tasks', broker='redis://127.0.0.1:6379/4')
 
+# 定时任务，需要启动 celery -A celery_tasks.tasks beat
+celery_app.conf.update(
+    CELERYBEAT_SCHEDULE={
+        # 库存镜像和MySQL对账
+        'reconcile-stock': {
+            'task': 'celery_tasks.tasks.reconcile_stock',
+            'schedule': timedelta(minutes=10),
+        },
+        # 秒杀订单写入MySQL的兜底：下单时已经安排了任务，这里只处理任务中断、没有安排上的订单
+        'persist-flash-orders': {
+            'task': 'celery_tasks.tasks.persist_flash_orders',
+            'schedule': timedelta(seconds=30),
+        },
+        # 异步下单的兜底：处理没有安排任务或者任务中断的分片
+        'process-checkout-queues': {
+            'task': 'celery_tasks.tasks.process_checkout_queues',
+            'schedule': timedelta(seconds=5),
+        },
+        # 整理购物车：删除失效商品，归档长时间没有使用的购物车
+        'compact-carts': {
+            'task': 'celery_tasks.tasks.compact_carts',
+            'schedule': timedelta(days=1),
+        },
+    },
+)
+
 # 生产任务
 @celery_app.task
 def send_active_email(to_email, user_name, token):
@@ -27,31 +59,10 @@ def send_active_email(to_email, user_name, token):
 @celery_app.task
 def generate_static_index_html():
     """异步生成静态主页"""
-    categorys = GoodsCategory.objects.all()
-
-    # 查询图片轮播信息 需求：根据index从小到大排序
-    goods_banners = IndexGoodsBanner.objects.all().order_by('index')
-
-    # 查询商品活动信息
-    promotionbanners = IndexPromotionBanner.objects.all().order_by('index')
-
-    # 查询主页分类列表信息
-    for category in categorys:
-        title_banners = IndexCategoryGoodsBanner.objects.filter(category=category, display_type=0)
-        category.title_banners = title_banners
-
-        image_banners = IndexCategoryGoodsBanner.objects.filter(category=category, display_type=1)
-        category.image_banners = image_banners
-    # 查询购物车信息
-    cart_num = 70
+    # 和主页视图使用同样的数据
+    context = build_index_context()
 
-    # 构造上下文
-    context = {
-        'categorys': categorys,
-        'goods_banners': goods_banners,
-        'promotionbanners': promotionbanners,
-        'cart_num': cart_num
-    }
+    # 购物车数量和登陆状态由cart_count.js异步加载
 
     # 获取模板
     template = loader.get_template('static_index.html')
@@ -67,3 +78,91 @@ def generate_static_index_html():
         file.write(html_data)
 
 
+@celery_app.task
+def generate_static_list_html(category_id, page_num, sort):
+    """异步生成一个静态列表页"""
+    static_html.render_list_page(category_id, page_num, sort)
+
+
+@celery_app.task
+def generate_static_detail_html(sku_id):
+    """异步生成一个静态详情页"""
+    static_html.render_detail_page(sku_id)
+
+
+def dispatch_static_html(list_pages, detail_ids):
+    """把页面的渲染任务分发给多个worker并行执行"""
+    tasks = [generate_static_list_html.s(*page) for page in sorted(list_pages)]
+    tasks += [generate_static_detail_html.s(sku_id) for sku_id in sorted(detail_ids)]
+    if tasks:
+        group(tasks).apply_async()
+
+
+@celery_app.task
+def update_static_sku_html(sku_id, category_id, goods_id, created=False):
+    """商品新增、修改、删除以后，只重新生成受影响的静态列表页和详情页"""
+    list_pages, detail_ids = static_html.pages_for_sku(sku_id, category_id, goods_id, created)
+    dispatch_static_html(list_pages, detail_ids)
+
+
+@celery_app.task
+def update_static_goods_html(goods_id):
+    """商品SPU修改以后，重新生成它下面所有SKU的静态详情页"""
+    detail_ids = GoodsSKU.objects.filter(goods_id=goods_id).values_list('id', flat=True)
+    dispatch_static_html([], detail_ids)
+
+
+@celery_app.task
+def generate_static_catalog_html():
+    """全量生成所有的静态列表页和详情页"""
+    list_pages, detail_ids = static_html.all_pages()
+    dispatch_static_html(list_pages, detail_ids)
+
+
+@celery_app.task
+def reconcile_stock():
+    """定时和MySQL对账，修正redis中的库存镜像"""
+    fixed, removed = stock.reconcile()
+    return {'fixed': fixed, 'removed': removed}
+
+
+@celery_app.task
+def compact_carts():
+    """定时整理redis中的购物车"""
+    return archive.compact()
+
+
+@celery_app.task
+def persist_flash_orders():
+    """把redis中的秒杀订单批量写入MySQL，写入失败的订单放回购物车"""
+    succeeded, failed = flash_sale.persist()
+
+    # 其他任务正在写入、超时退出时队列中还有订单，稍后继续
+    if flash_sale.schedule(get_redis_connection('default')):
+        persist_flash_orders.apply_async(countdown=1)
+    return {'succeeded': succeeded, 'failed': failed}
+
+
+@celery_app.task
+def process_checkout_shard(shard):
+    """按批创建一个分片中排队的订单"""
+    succeeded, failed = checkout.process_shard(shard)
+    return {'succeeded': succeeded, 'failed': failed}
+
+
+@celery_app.task
+def process_checkout_queues():
+    """每个分片一个任务，由多个worker并行处理"""
+    group(process_checkout_shard.s(shard) for shard in range(checkout.NUM_SHARDS)).apply_async()
+
+
+@celery_app.task
+def poll_payment(order_id, attempt=0):
+    """查询支付宝的支付结果，还在等待支付时按照指数退避安排下一次查询"""
+    redis_conn = get_redis_connection('default')
+    status = payment.poll(order_id, redis_conn)
+    if status == payment.PENDING and attempt + 1 < payment.POLL_MAX_ATTEMPTS:
+        poll_payment.apply_async((order_id, attempt + 1), countdown=payment.poll_delay(attempt + 1))
+    else:
+        payment.stop_polling(redis_conn, order_id)
+    return status
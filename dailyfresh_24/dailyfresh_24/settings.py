@@ -201,4 +201,12 @@ HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
 ALIPAY_APPID = '2016091100487884'
 APP_PRIVATE_KEY_PATH = os.path.join(BASE_DIR, 'apps/orders/app_private_key.pem')
 ALIPAY_PUBLIC_KEY_PATH = os.path.join(BASE_DIR, 'apps/orders/alipay_public_key.pem')
-ALIPAY_URL = 'https://openapi.alipaydev.com/gateway.do'
\ No newline at end of file
+ALIPAY_URL = 'https://openapi.alipaydev.com/gateway.do'
+# 支付宝异步通知的地址，需要支付宝能够访问；访问不到时由celery任务查询支付结果
+ALIPAY_NOTIFY_URL = 'http://127.0.0.1:8000/orders/pay/notify'
+# 支付宝网关，None表示使用SDK默认的网关，检查支付流程时指向本地模拟的网关
+ALIPAY_GATEWAY = None
+
+# 异步下单：提交订单时只做简单的校验，订单放入redis队列，由celery按分片批量创建，前端轮询/orders/commit/status
+# 需要启动celery worker和beat
+ASYNC_CHECKOUT = False
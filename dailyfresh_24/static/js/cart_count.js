@@ -0,0 +1,38 @@
+// 商品页面（主页、列表页、详情页）对所有用户都是相同的内容，可以整页缓存
+// 登陆状态、购物车数量、csrf_token这些和用户相关的信息，在页面加载以后异步获取
+$(function(){
+
+	// 读取cookie中的csrftoken，填充到表单中
+	function fill_csrf_token() {
+		var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]*)/);
+		if (match) {
+			$('input[name=csrfmiddlewaretoken]').val(decodeURIComponent(match[1]));
+		}
+	}
+
+	fill_csrf_token();
+
+	// 详情页需要记录浏览记录
+	var req_data = {};
+	var sku_id = $('#add_cart').attr('sku_id');
+	if (sku_id) {
+		req_data.sku_id = sku_id;
+	}
+
+	$.get('/cart/count', req_data, function (response_data) {
+		if (0 == response_data.code) {
+			// 展示购物车数量
+			$('#show_count').html(response_data.cart_num);
+
+			// 展示登陆状态
+			if (response_data.username) {
+				$('#login_info em').text(response_data.username);
+				$('#login_btn').hide();
+				$('#login_info').show();
+			}
+		}
+
+		// 第一次访问时，csrftoken在这次请求中才写入cookie
+		fill_csrf_token();
+	});
+});
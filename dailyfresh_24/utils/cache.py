@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """进程内的LRU缓存，带过期时间，多线程安全（uwsgi开启了多线程）"""
+
+    def __init__(self, size, ttl):
+        """size：最多缓存的条数  ttl：每条数据的有效期（秒）"""
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """读取缓存，不存在或者过期时返回None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+
+            # 最近使用的放到末尾
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """写入缓存，超出容量时淘汰最久没有使用的数据"""
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """删除缓存"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
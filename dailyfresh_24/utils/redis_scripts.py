@@ -0,0 +1,13 @@
+"""redis中的Lua脚本：每个进程只注册一次，调用时使用EVALSHA，redis中没有脚本时自动重新加载"""
+
+# 注册后的脚本对象 {脚本: Script}
+_scripts = {}
+
+
+def get_script(redis_conn, lua):
+    """获取注册后的脚本对象"""
+    script = _scripts.get(lua)
+    if script is None:
+        script = redis_conn.register_script(lua)
+        _scripts[lua] = script
+    return script
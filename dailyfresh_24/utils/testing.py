@@ -0,0 +1,67 @@
+"""测试的公共工具
+
+- 测试使用的redis：缓存、购物车、库存镜像等都写入单独的redis数据库，每个测试前后清空，不会碰到线上的key
+- create_skus：创建分类、SPU和商品的测试数据
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.test.utils import override_settings
+from django_redis import get_redis_connection
+
+from goods.models import GoodsCategory, Goods, GoodsSKU
+
+# 测试使用的redis数据库
+TEST_REDIS_URL = getattr(settings, 'TEST_REDIS_URL', 'redis://127.0.0.1:6379/15')
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': TEST_REDIS_URL,
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        }
+    }
+}
+
+
+class RedisTestMixin(object):
+    """测试期间get_redis_connection('default')和django缓存都指向测试的redis数据库
+
+    和TestCase一起使用：class XxxTest(RedisTestMixin, TestCase)
+    """
+
+    def setUp(self):
+        self._redis_settings = override_settings(CACHES=TEST_CACHES)
+        self._redis_settings.enable()
+        self.redis_conn = get_redis_connection('default')
+        self.redis_conn.flushdb()
+        super(RedisTestMixin, self).setUp()
+
+    def tearDown(self):
+        super(RedisTestMixin, self).tearDown()
+        self.redis_conn.flushdb()
+        self._redis_settings.disable()
+
+
+def create_skus(count, categorys=1, goods=1, **fields):
+    """创建categorys个分类、goods个SPU，每个分类count个商品，返回按照id排序的商品列表
+
+    分类中第i个商品属于第 i % goods 个SPU；fields覆盖商品的默认字段，值是函数时参数是i
+    """
+    category_list = [GoodsCategory.objects.create(name='分类%s' % i, logo='logo', image='category/test.jpg')
+                     for i in range(categorys)]
+    # bulk_create不触发信号，不会访问redis
+    Goods.objects.bulk_create([Goods(name='商品%s' % i) for i in range(goods)])
+    goods_list = list(Goods.objects.order_by('-id')[:goods])[::-1]
+
+    skus = []
+    for category in category_list:
+        for i in range(count):
+            values = {'name': '商品%s' % i, 'title': '简介', 'unit': '500g', 'price': Decimal('10.00'),
+                      'stock': 100, 'default_image': 'goods/test.jpg'}
+            for name, value in fields.items():
+                values[name] = value(i) if callable(value) else value
+            skus.append(GoodsSKU(category=category, goods=goods_list[i % goods], **values))
+    GoodsSKU.objects.bulk_create(skus)
+    return list(GoodsSKU.objects.filter(category__in=category_list).order_by('id'))
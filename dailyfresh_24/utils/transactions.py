@@ -0,0 +1,66 @@
+"""事务提交以后再执行的操作（django 1.8还没有transaction.on_commit）
+
+清除缓存、同步redis、发送celery任务都要等到事务提交以后：
+在事务中执行时，其他请求可能在提交之前读到旧数据并重新写入缓存，celery任务也可能读到还没有提交的数据
+
+after_commit(func, *args, **kwargs) 不在事务中时立即执行，否则等到最外层的事务提交以后执行。
+等待中的操作挂在数据库连接上：替换连接的commit/rollback/savepoint_rollback/close，
+任何地方的transaction.atomic（视图、celery任务、管理命令、shell）提交时执行，回滚时丢弃
+"""
+from django.db import transaction
+
+
+def _install(conn):
+    """替换连接的提交、回滚方法，每个连接只替换一次"""
+    if hasattr(conn, 'after_commit_pending'):
+        return
+    # [(保存点集合, func, args, kwargs)]
+    conn.after_commit_pending = []
+
+    commit = conn.commit
+    rollback = conn.rollback
+    savepoint_rollback = conn.savepoint_rollback
+    close = conn.close
+
+    def commit_and_run():
+        commit()
+        if not conn.in_atomic_block:
+            _run_pending(conn)
+
+    def rollback_and_discard():
+        rollback()
+        del conn.after_commit_pending[:]
+
+    def savepoint_rollback_and_discard(sid):
+        # 回滚到保存点，丢弃这个保存点之后加入的操作
+        savepoint_rollback(sid)
+        conn.after_commit_pending[:] = [item for item in conn.after_commit_pending if sid not in item[0]]
+
+    def close_and_discard():
+        # 事务中关闭连接，数据库会回滚事务
+        del conn.after_commit_pending[:]
+        close()
+
+    conn.commit = commit_and_run
+    conn.rollback = rollback_and_discard
+    conn.savepoint_rollback = savepoint_rollback_and_discard
+    conn.close = close_and_discard
+
+
+def _run_pending(conn):
+    """执行等待中的操作，执行的过程中加入的操作也会执行"""
+    pending = conn.after_commit_pending
+    while pending:
+        sids, func, args, kwargs = pending.pop(0)
+        func(*args, **kwargs)
+
+
+def after_commit(func, *args, **kwargs):
+    """事务提交以后执行func，不在事务中时立即执行"""
+    conn = transaction.get_connection()
+    if not conn.in_atomic_block:
+        func(*args, **kwargs)
+        return
+
+    _install(conn)
+    conn.after_commit_pending.append((set(conn.savepoint_ids), func, args, kwargs))
@@ -2,6 +2,10 @@ from django.contrib.auth.decorators import login_required
 from functools import wraps
 from django.http import JsonResponse
 from django.db import transaction
+from django.core.cache import cache
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+import hashlib
 
 
 # 自定义装饰器
@@ -51,4 +55,68 @@ class TransactionAtomicMiXin(object):
     def as_view(cls, **initkwargs):
         view = super(TransactionAtomicMiXin, cls).as_view(**initkwargs)
 
-        return transaction.atomic(view)
\ No newline at end of file
+        return transaction.atomic(view)
+
+
+def conditional_page(last_modified_func, timeout=3600, cache_params=None):
+    """条件请求和整页缓存的装饰器，用于和用户无关的页面
+
+    last_modified_func(request, *args, **kwargs)返回页面数据的最后修改时间，返回None时直接执行视图
+    - 浏览器携带的If-Modified-Since/If-None-Match还有效时，直接响应304，不执行视图也不渲染模板
+    - 否则按照（页面路径, 查询参数, 最后修改时间）缓存整个响应，数据修改以后缓存自动失效
+
+    cache_params {参数名: 允许的值}：只有这些参数参与缓存的key，其他参数不影响页面内容，直接忽略；
+    参数的值不在允许的范围内时不缓存，任意的查询参数不会在缓存中留下key
+    """
+    cache_params = cache_params or {}
+    def get_last_modified(request, *args, **kwargs):
+        # 同一个请求中只计算一次
+        if not hasattr(request, '_page_last_modified'):
+            request._page_last_modified = last_modified_func(request, *args, **kwargs)
+        return request._page_last_modified
+
+    def get_etag(request, *args, **kwargs):
+        # Last-Modified只精确到秒，ETag使用微秒级的时间戳
+        last_modified = get_last_modified(request, *args, **kwargs)
+        if last_modified is None:
+            return None
+        return '%x' % int(last_modified.timestamp() * 1000000)
+
+    def get_cache_key(request):
+        # 返回None时不缓存
+        parts = [request.path]
+        for name in sorted(cache_params):
+            value = request.GET.get(name)
+            if value is None:
+                continue
+            if value not in cache_params[name]:
+                return None
+            parts.append('%s=%s' % (name, value))
+        return hashlib.md5('&'.join(parts).encode()).hexdigest()
+
+    def decorator(view_func):
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            last_modified = get_last_modified(request, *args, **kwargs)
+            if last_modified is None:
+                return view_func(request, *args, **kwargs)
+
+            path_hash = get_cache_key(request)
+            if path_hash is None:
+                return view_func(request, *args, **kwargs)
+            key = 'page_%s_%s' % (path_hash, get_etag(request, *args, **kwargs))
+
+            response = cache.get(key)
+            if response is None:
+                response = view_func(request, *args, **kwargs)
+                if response.status_code == 200:
+                    cache.set(key, response, timeout)
+
+            # 浏览器和nginx每次都要重新验证，没有修改时得到的是304
+            patch_cache_control(response, public=True, max_age=0)
+            return response
+
+        return condition(etag_func=get_etag, last_modified_func=get_last_modified)(wrapper)
+
+    return decorator